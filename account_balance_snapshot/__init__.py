@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from . import models
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+{
+    'name': 'Account Balance Snapshot',
+    'summary': """
+        Monthly snapshot of account balances to speed up
+        initial and ending balance computations""",
+    'version': '10.0.1.0.0',
+    'category': 'Accounting & Finance',
+    'author': 'ACSONE SA/NV,'
+              'Odoo Community Association (OCA)',
+    'website': 'https://github.com/OCA/account-financial-reporting',
+    'license': 'AGPL-3',
+    'depends': [
+        'account',
+    ],
+    'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
+    ],
+    'installable': True,
+}
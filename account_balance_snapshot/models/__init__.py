@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from . import account_balance_snapshot
+from . import account_move
+from . import res_company
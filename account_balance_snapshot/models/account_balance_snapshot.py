@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+from odoo.addons import decimal_precision as dp
+from odoo.osv import expression
+
+_logger = logging.getLogger(__name__)
+
+
+def _month_start(date):
+    """ First day of the month of a date """
+    d = fields.Date.from_string(date)
+    return fields.Date.to_string(d.replace(day=1))
+
+
+def _next_month_start(date):
+    """ First day of the month of a date, if it is the first day of a month,
+    otherwise first day of the next month """
+    d = fields.Date.from_string(date)
+    if d.day != 1:
+        d = d.replace(day=1) + relativedelta(months=1)
+    return fields.Date.to_string(d)
+
+
+def _month_after(date):
+    """ First day of the month after the month of a date """
+    d = fields.Date.from_string(date)
+    return fields.Date.to_string(d.replace(day=1) + relativedelta(months=1))
+
+
+def _month_ranges(months):
+    """ Merge sorted first days of months into [date_from, date_to) ranges
+    of consecutive months """
+    ranges = []
+    for month in months:
+        if ranges and ranges[-1][1] == month:
+            ranges[-1][1] = _month_after(month)
+        else:
+            ranges.append([month, _month_after(month)])
+    return [tuple(r) for r in ranges]
+
+
+class AccountBalanceSnapshot(models.Model):
+    """ Monthly totals of journal items by company, account, partner
+    and move state.
+
+    The snapshot covers the journal items of a company dated before
+    the balance_snapshot_date of the company. It is completed by a
+    scheduled action up to the beginning of the current month. Creating,
+    modifying or deleting a journal item of a past month logs that month
+    in account.balance.snapshot.invalidation: its totals are not read
+    until the scheduled action computes them again.
+
+    Reports obtain sums of journal items with _get_move_line_subquery(),
+    which reads whole months from the snapshot and only the remaining
+    days from account_move_line.
+    """
+
+    _name = 'account.balance.snapshot'
+    _description = 'Account balance snapshot'
+    _log_access = False
+    _order = 'date, account_id'
+
+    company_id = fields.Many2one(
+        comodel_name='res.company',
+        required=True,
+        index=True,
+        ondelete='cascade')
+    account_id = fields.Many2one(
+        comodel_name='account.account',
+        required=True,
+        index=True,
+        ondelete='cascade')
+    partner_id = fields.Many2one(
+        comodel_name='res.partner',
+        index=True,
+        ondelete='cascade')
+    move_state = fields.Selection(
+        [('draft', 'Unposted'),
+         ('posted', 'Posted')],
+        required=True)
+    date = fields.Date(
+        required=True,
+        index=True,
+        help='First day of the month')
+    debit = fields.Float(digits=dp.get_precision('Account'))
+    credit = fields.Float(digits=dp.get_precision('Account'))
+    balance = fields.Float(digits=dp.get_precision('Account'))
+
+    @api.model
+    def _cron_compute_snapshot(self):
+        self.compute_snapshot()
+
+    @api.model
+    def compute_snapshot(self, companies=None):
+        """ Complete the snapshot of companies (all companies by default)
+        up to the beginning of the current month. """
+        if companies is None:
+            companies = self.env['res.company'].search([])
+        snapshot_to = _month_start(fields.Date.context_today(self))
+        for company in companies:
+            self._compute_company_snapshot(company, snapshot_to)
+
+    def _compute_company_snapshot(self, company, snapshot_to):
+        cr = self.env.cr
+        # lock the company, so concurrent computations of its snapshot
+        # wait for this one and then fail with a serialization error
+        # instead of inserting the same totals twice
+        cr.execute("SELECT id FROM res_company WHERE id = %s FOR UPDATE",
+                   (company.id, ))
+        company.invalidate_cache(['balance_snapshot_date'], company.ids)
+        snapshot_from = company.balance_snapshot_date
+        # invalidations logged by concurrent transactions are not seen,
+        # so they remain for the next computation
+        cr.execute("""
+SELECT
+    id,
+    date
+FROM
+    account_balance_snapshot_invalidation
+WHERE
+    company_id = %s
+AND
+    date < %s
+        """, (company.id, snapshot_to))
+        invalidations = cr.fetchall()
+        extend = not snapshot_from or snapshot_from < snapshot_to
+        # the invalidated months not covered by the extension
+        ranges = _month_ranges(sorted(set(
+            date for _, date in invalidations
+            if snapshot_from and date < snapshot_from)))
+        if extend:
+            if ranges and ranges[-1][1] == snapshot_from:
+                ranges[-1] = (ranges[-1][0], snapshot_to)
+            else:
+                ranges.append((snapshot_from, snapshot_to))
+        for range_from, range_to in ranges:
+            self._compute_company_snapshot_range(
+                company, range_from, range_to)
+        if invalidations:
+            cr.execute("""
+DELETE FROM
+    account_balance_snapshot_invalidation
+WHERE
+    id IN %s
+            """, (tuple(i for i, _ in invalidations), ))
+        if extend:
+            cr.execute("UPDATE res_company SET balance_snapshot_date = %s "
+                       "WHERE id = %s", (snapshot_to, company.id))
+            company.invalidate_cache(['balance_snapshot_date'], company.ids)
+
+    def _compute_company_snapshot_range(self, company, date_from, date_to):
+        """ Compute the snapshot of a company for the months from date_from
+        (included, or from the beginning if None) to date_to (excluded) """
+        cr = self.env.cr
+        _logger.info("Computing balance snapshot of %s from %s to %s",
+                     company.name, date_from, date_to)
+        query_delete = """
+DELETE FROM
+    account_balance_snapshot
+WHERE
+    company_id = %s
+AND
+    date < %s
+        """
+        query_delete_params = (company.id, date_to)
+        if date_from:
+            query_delete += """
+AND
+    date >= %s
+            """
+            query_delete_params += (date_from, )
+        cr.execute(query_delete, query_delete_params)
+        query_insert = """
+INSERT INTO
+    account_balance_snapshot
+    (
+    company_id,
+    account_id,
+    partner_id,
+    move_state,
+    date,
+    debit,
+    credit,
+    balance
+    )
+SELECT
+    ml.company_id,
+    ml.account_id,
+    ml.partner_id,
+    m.state,
+    DATE_TRUNC('month', ml.date)::date,
+    SUM(ml.debit),
+    SUM(ml.credit),
+    SUM(ml.balance)
+FROM
+    account_move_line ml
+INNER JOIN
+    account_move m ON ml.move_id = m.id
+WHERE
+    ml.company_id = %s
+AND
+    ml.date < %s
+        """
+        query_insert_params = (company.id, date_to)
+        if date_from:
+            query_insert += """
+AND
+    ml.date >= %s
+            """
+            query_insert_params += (date_from, )
+        query_insert += """
+GROUP BY
+    ml.company_id,
+    ml.account_id,
+    ml.partner_id,
+    m.state,
+    DATE_TRUNC('month', ml.date)
+        """
+        cr.execute(query_insert, query_insert_params)
+
+    @api.model
+    def _invalidate_snapshot(self, dates_by_company):
+        """ Invalidate the months of dates in the snapshot of companies.
+
+        The months are logged with plain inserts, so journal items
+        of past months posted concurrently do not wait for each other.
+
+        :param dates_by_company: {company_id: set of dates}
+        """
+        current_month = _month_start(fields.Date.context_today(self))
+        values = set()
+        for company_id, dates in dates_by_company.items():
+            for date in dates:
+                month = _month_start(date)
+                if month >= current_month:
+                    # the snapshot never covers the current month
+                    continue
+                values.add((company_id, month))
+        if not values:
+            return
+        self.env.cr.execute("""
+INSERT INTO
+    account_balance_snapshot_invalidation
+    (
+    company_id,
+    date
+    )
+VALUES
+    """ + ', '.join(['(%s, %s)'] * len(values)),
+            tuple(v for value in sorted(values) for v in value))
+
+    @api.model
+    def _get_invalid_months(self, company, date_from, date_to):
+        """ Return the sorted first days of the invalidated months of the
+        snapshot of a company, from date_from (included, or from the
+        beginning if None) to date_to (excluded) """
+        query = """
+SELECT DISTINCT
+    date
+FROM
+    account_balance_snapshot_invalidation
+WHERE
+    company_id = %s
+AND
+    date < %s
+        """
+        params = (company.id, date_to)
+        if date_from:
+            query += """
+AND
+    date >= %s
+            """
+            params += (date_from, )
+        self.env.cr.execute(query, params)
+        return sorted(r[0] for r in self.env.cr.fetchall())
+
+    @api.model
+    def _can_read_company(self, company):
+        """ Whether the current user can read all the journal items of a
+        company, so sums read from the snapshot, which can not apply record
+        rules, are those the user would obtain from the journal items.
+
+        This is the case when the record rules of account.move.line only
+        restrict the company of journal items, and accept that company.
+        """
+        domain = self.env['ir.rule']._compute_domain(
+            'account.move.line', 'read')
+        if not domain:
+            return True
+        company_domain = []
+        for leaf in domain:
+            if expression.is_leaf(leaf) and tuple(leaf) not in (
+                    expression.TRUE_LEAF, expression.FALSE_LEAF):
+                if leaf[0] != 'company_id':
+                    return False
+                leaf = ('id', leaf[1], leaf[2])
+            company_domain.append(leaf)
+        return bool(self.env['res.company'].sudo().search_count(
+            [('id', '=', company.id)] + company_domain))
+
+    @api.model
+    def _get_move_line_subquery(self, company, date_from, date_to,
+                                only_posted):
+        """ Return a subquery and its parameters, selecting the journal items
+        of a company dated from date_from (included, or from the beginning
+        if None) to date_to (excluded), optionally only posted ones.
+
+        The subquery has the account_id, partner_id, date, debit, credit
+        and balance columns of account_move_line. Whole months covered by
+        the snapshot are read from the snapshot, with one row per
+        account, partner and month, dated on the first day of the month.
+        The remaining days and the invalidated months are read from
+        account_move_line.
+        """
+        snapshot_from = date_from and _next_month_start(date_from)
+        snapshot_to = None
+        if company.balance_snapshot_date:
+            snapshot_to = _month_start(
+                min(date_to, company.balance_snapshot_date))
+            if snapshot_from and snapshot_from >= snapshot_to:
+                snapshot_to = None
+        query = """
+            SELECT
+                ml.account_id,
+                ml.partner_id,
+                ml.date,
+                ml.debit,
+                ml.credit,
+                ml.balance
+            FROM
+                account_move_line ml
+        """
+        if only_posted:
+            query += """
+            INNER JOIN
+                account_move m ON ml.move_id = m.id AND m.state = 'posted'
+            """
+        query += """
+            WHERE
+                ml.company_id = %s
+            AND
+                ml.date < %s
+        """
+        params = (company.id, date_to)
+        if date_from:
+            query += """
+            AND
+                ml.date >= %s
+            """
+            params += (date_from, )
+        if not snapshot_to:
+            return query, params
+        invalid_months = self._get_invalid_months(
+            company, snapshot_from, snapshot_to)
+        # the months covered by the snapshot, except invalidated ones
+        if snapshot_from:
+            query += """
+            AND
+                (NOT (ml.date >= %s AND ml.date < %s)
+            """
+            params += (snapshot_from, snapshot_to)
+        else:
+            query += """
+            AND
+                (ml.date >= %s
+            """
+            params += (snapshot_to, )
+        for range_from, range_to in _month_ranges(invalid_months):
+            query += """
+                OR (ml.date >= %s AND ml.date < %s)
+            """
+            params += (range_from, range_to)
+        query += """
+                )
+        """
+        query += """
+            UNION ALL
+            SELECT
+                s.account_id,
+                s.partner_id,
+                s.date,
+                s.debit,
+                s.credit,
+                s.balance
+            FROM
+                account_balance_snapshot s
+            WHERE
+                s.company_id = %s
+            AND
+                s.date < %s
+        """
+        params += (company.id, snapshot_to)
+        if snapshot_from:
+            query += """
+            AND
+                s.date >= %s
+            """
+            params += (snapshot_from, )
+        if invalid_months:
+            query += """
+            AND
+                s.date NOT IN %s
+            """
+            params += (tuple(invalid_months), )
+        if only_posted:
+            query += """
+            AND
+                s.move_state = 'posted'
+            """
+        return query, params
+
+
+class AccountBalanceSnapshotInvalidation(models.Model):
+    """ Months of the snapshot of a company invalidated by changes
+    of journal items.
+
+    Invalidations are only inserted, one row per change, so concurrent
+    postings never update the same row, and they are deleted when
+    the scheduled action computes the totals of their month again.
+    """
+
+    _name = 'account.balance.snapshot.invalidation'
+    _description = 'Account balance snapshot invalidation'
+    _log_access = False
+    _order = 'date'
+
+    company_id = fields.Many2one(
+        comodel_name='res.company',
+        required=True,
+        index=True,
+        ondelete='cascade')
+    date = fields.Date(
+        required=True,
+        help='First day of the month')
+
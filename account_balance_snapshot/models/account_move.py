@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+# account.move.line fields stored in the balance snapshot
+SNAPSHOT_FIELDS = {
+    'account_id',
+    'balance',
+    'company_id',
+    'credit',
+    'date',
+    'debit',
+    'move_id',
+    'partner_id',
+}
+
+
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    @api.multi
+    def write(self, vals):
+        if 'state' in vals or 'date' in vals:
+            self.mapped('line_ids')._invalidate_balance_snapshot()
+        res = super(AccountMove, self).write(vals)
+        if 'date' in vals:
+            self.mapped('line_ids')._invalidate_balance_snapshot()
+        return res
+
+    @api.multi
+    def button_cancel(self):
+        # the state is reset to draft with a sql query
+        self.mapped('line_ids')._invalidate_balance_snapshot()
+        return super(AccountMove, self).button_cancel()
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    @api.model
+    def create(self, vals):
+        line = super(AccountMoveLine, self).create(vals)
+        line._invalidate_balance_snapshot()
+        return line
+
+    @api.multi
+    def write(self, vals):
+        snapshot_changed = bool(SNAPSHOT_FIELDS.intersection(vals))
+        if snapshot_changed:
+            self._invalidate_balance_snapshot()
+        res = super(AccountMoveLine, self).write(vals)
+        if snapshot_changed:
+            self._invalidate_balance_snapshot()
+        return res
+
+    @api.multi
+    def unlink(self):
+        self._invalidate_balance_snapshot()
+        return super(AccountMoveLine, self).unlink()
+
+    @api.multi
+    def _invalidate_balance_snapshot(self):
+        """ Invalidate the months of the lines in the balance snapshot
+        of their company. """
+        dates_by_company = {}
+        for line in self:
+            company_id = line.company_id.id
+            if not company_id or not line.date:
+                continue
+            dates_by_company.setdefault(company_id, set()).add(line.date)
+        if dates_by_company:
+            self.env['account.balance.snapshot'].sudo().\
+                _invalidate_snapshot(dates_by_company)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from odoo import fields, models
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    balance_snapshot_date = fields.Date(
+        string='Balance snapshot date',
+        readonly=True,
+        copy=False,
+        help='Balances of journal items dated before this date '
+             'are available in the account balance snapshot.')
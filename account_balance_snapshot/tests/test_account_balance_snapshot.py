@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import datetime
+
+from odoo import fields
+import odoo.tests.common as common
+
+
+class TestAccountBalanceSnapshot(common.TransactionCase):
+
+    def setUp(self):
+        super(TestAccountBalanceSnapshot, self).setUp()
+        self.snapshot_model = self.env['account.balance.snapshot']
+        self.account_model = self.env['account.account']
+        self.move_model = self.env['account.move']
+        # use past years only, so all moves are before the current month
+        self.year = datetime.date.today().year - 1
+        self.company = self.env['res.company'].create({
+            'name': 'Snapshot Company'})
+        self.partner = self.env['res.partner'].create({
+            'name': 'Snapshot Partner'})
+        type_ar = self.browse_ref('account.data_account_type_receivable')
+        self.account_ar = self.account_model.create({
+            'company_id': self.company.id,
+            'code': '400AR',
+            'name': 'Receivable',
+            'user_type_id': type_ar.id,
+            'reconcile': True})
+        type_in = self.browse_ref('account.data_account_type_revenue')
+        self.account_in = self.account_model.create({
+            'company_id': self.company.id,
+            'code': '700IN',
+            'name': 'Income',
+            'user_type_id': type_in.id})
+        self.journal = self.env['account.journal'].create({
+            'company_id': self.company.id,
+            'name': 'Sale journal',
+            'code': 'VEN',
+            'type': 'sale',
+            'update_posted': True})
+        self._create_move(datetime.date(self.year - 1, 12, 1), 100)
+        self._create_move(datetime.date(self.year, 1, 15), 300)
+        self._create_move(datetime.date(self.year, 3, 10), 500)
+        self._create_move(datetime.date(self.year, 3, 20), 700, post=False)
+
+    def _create_move(self, date, amount, post=True):
+        move = self.move_model.create({
+            'journal_id': self.journal.id,
+            'date': fields.Date.to_string(date),
+            'line_ids': [(0, 0, {
+                'name': '/',
+                'debit': amount,
+                'account_id': self.account_ar.id,
+                'partner_id': self.partner.id,
+            }), (0, 0, {
+                'name': '/',
+                'credit': amount,
+                'account_id': self.account_in.id,
+            })]})
+        if post:
+            move.post()
+        return move
+
+    def _sums(self, date_from, date_to, only_posted):
+        query, params = self.snapshot_model._get_move_line_subquery(
+            self.company, date_from, date_to, only_posted)
+        self.env.cr.execute("""
+            SELECT account_id, partner_id, SUM(debit), SUM(credit)
+            FROM (""" + query + """) ml
+            GROUP BY account_id, partner_id
+        """, params)
+        return {(r[0], r[1]): (r[2], r[3])
+                for r in self.env.cr.fetchall()}
+
+    def _all_sums(self):
+        res = []
+        for date_from, date_to in [
+                (None, '%s-01-01' % self.year),
+                (None, '%s-03-15' % self.year),
+                ('%s-01-01' % self.year, '%s-03-15' % self.year),
+                ('%s-01-20' % self.year, '%s-04-01' % self.year),
+                ('%s-02-01' % self.year, '%s-03-01' % self.year),
+                ('%s-03-01' % self.year, '%s-03-02' % self.year)]:
+            for only_posted in (True, False):
+                res.append(self._sums(date_from, date_to, only_posted))
+        return res
+
+    def test_compute_snapshot(self):
+        self.assertFalse(self.company.balance_snapshot_date)
+        expected = self._all_sums()
+        self.snapshot_model.compute_snapshot(self.company)
+        self.assertEquals(
+            self.company.balance_snapshot_date,
+            fields.Date.to_string(datetime.date.today().replace(day=1)))
+        snapshots = self.snapshot_model.search([
+            ('company_id', '=', self.company.id),
+            ('account_id', '=', self.account_ar.id)])
+        self.assertEquals(
+            sorted((s.date, s.move_state, s.debit) for s in snapshots),
+            [('%s-12-01' % (self.year - 1), 'posted', 100),
+             ('%s-01-01' % self.year, 'posted', 300),
+             ('%s-03-01' % self.year, 'draft', 700),
+             ('%s-03-01' % self.year, 'posted', 500)])
+        self.assertEquals(self._all_sums(), expected)
+
+    def _invalid_months(self):
+        return self.snapshot_model._get_invalid_months(
+            self.company, None, self.company.balance_snapshot_date)
+
+    def test_invalidate_snapshot(self):
+        self.snapshot_model.compute_snapshot(self.company)
+        snapshot_date = self.company.balance_snapshot_date
+        move = self._create_move(datetime.date(self.year, 2, 5), 1000)
+        # only the month of the move is invalidated
+        self.assertEquals(self.company.balance_snapshot_date, snapshot_date)
+        self.assertEquals(self._invalid_months(), ['%s-02-01' % self.year])
+        self.assertTrue(self.snapshot_model.search([
+            ('company_id', '=', self.company.id),
+            ('date', '>=', '%s-02-01' % self.year)]))
+        self.assertEquals(self._sums(None, '%s-03-01' % self.year, True),
+                          {(self.account_ar.id, self.partner.id): (1400, 0),
+                           (self.account_in.id, None): (0, 1400)})
+        expected = self._all_sums()
+        self.snapshot_model.compute_snapshot(self.company)
+        self.assertFalse(self._invalid_months())
+        self.assertEquals(self._all_sums(), expected)
+        # cancelling a move invalidates its month
+        move.button_cancel()
+        self.assertEquals(self._invalid_months(), ['%s-02-01' % self.year])
+        self.assertEquals(self._sums(None, '%s-03-01' % self.year, True),
+                          {(self.account_ar.id, self.partner.id): (400, 0),
+                           (self.account_in.id, None): (0, 400)})
+        self.snapshot_model.compute_snapshot(self.company)
+        self.assertFalse(self._invalid_months())
+        self.assertEquals(self._sums(None, '%s-03-01' % self.year, True),
+                          {(self.account_ar.id, self.partner.id): (400, 0),
+                           (self.account_in.id, None): (0, 400)})
+
+    def test_can_read_company(self):
+        self.assertTrue(self.snapshot_model._can_read_company(self.company))
+        user = self.env['res.users'].create({
+            'name': 'Snapshot User',
+            'login': 'snapshot_user',
+            'company_id': self.company.id,
+            'company_ids': [(6, 0, self.company.ids)],
+            'groups_id': [(6, 0, [self.ref('account.group_account_user')])],
+        })
+        snapshot_model = self.snapshot_model.sudo(user)
+        self.assertTrue(snapshot_model._can_read_company(self.company))
+        self.assertFalse(snapshot_model._can_read_company(
+            self.env.ref('base.main_company')))
+        # other record rules can not be applied to the snapshot
+        self.env['ir.rule'].create({
+            'name': 'Sale journal items only',
+            'model_id': self.ref('account.model_account_move_line'),
+            'domain_force': "[('journal_id.type', '=', 'sale')]",
+        })
+        self.assertFalse(snapshot_model._can_read_company(self.company))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+import psycopg2
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class AbstractReport(models.AbstractModel):
+    """ Report data models, stored in UNLOGGED tables.
+
+    Report data are computed with INSERT ... SELECT queries into the
+    tables of transient models, and deleted when the transient records
+    are vacuumed, so there is no point in writing them to the write-ahead
+    log. The tables of the models inheriting this one (and their many2many
+    relation tables) are UNLOGGED: computing a large report does not write
+    its data twice, nor send it to the standby servers. After a crash of
+    the database server, UNLOGGED tables are emptied, which only loses the
+    reports being displayed at that time.
+
+    Logged tables can not have foreign keys to UNLOGGED tables, so the
+    tables are logged while the module is updated, in case a new table
+    references them, and they are UNLOGGED again when the registry
+    is loaded.
+    """
+
+    _name = 'report_qweb_abstract'
+
+    @api.model
+    def _get_report_tables(self):
+        """ Return the tables of the models inheriting this one,
+        with their many2many relation tables """
+        tables = set()
+        for model_name in self.env['report_qweb_abstract']._inherit_children:
+            model = self.env[model_name]
+            if model._abstract or not model._auto:
+                continue
+            tables.add(model._table)
+            for field in model._fields.values():
+                if field.type == 'many2many' and field.store:
+                    tables.add(field.relation)
+        return tables
+
+    @api.model
+    def _set_tables_unlogged(self, tables, unlogged=True):
+        """ Make tables UNLOGGED (or logged).
+
+        A table can be made UNLOGGED only when the other tables
+        referencing it are UNLOGGED, and logged only when the other tables
+        it references are logged, so the tables are altered in that order.
+        """
+        cr = self.env.cr
+        persistence = 'u' if unlogged else 'p'
+        while True:
+            # the tables to alter, with the tables they must wait for
+            cr.execute("""
+SELECT
+    c.relname,
+    ARRAY(
+        SELECT
+            o.relname
+        FROM
+            pg_constraint con
+        INNER JOIN
+            pg_class o
+                ON o.oid = CASE
+                    WHEN %(unlogged)s THEN con.conrelid
+                    ELSE con.confrelid
+                END
+        WHERE
+            con.contype = 'f'
+        AND
+            CASE
+                WHEN %(unlogged)s THEN con.confrelid
+                ELSE con.conrelid
+            END = c.oid
+        AND
+            o.oid != c.oid
+        AND
+            o.relpersistence != %(persistence)s
+    )
+FROM
+    pg_class c
+WHERE
+    c.relkind = 'r'
+AND
+    c.relname IN %(tables)s
+AND
+    c.relpersistence != %(persistence)s
+            """, {'unlogged': unlogged,
+                  'persistence': persistence,
+                  'tables': tuple(tables) or (None, )})
+            pending = cr.fetchall()
+            ready = [table for table, waited in pending if not waited]
+            if not ready:
+                if pending:
+                    _logger.warning(
+                        "Can not alter the persistence of tables %s, "
+                        "because of the foreign keys of tables %s",
+                        ', '.join(table for table, _ in pending),
+                        ', '.join(set(t for _, w in pending for t in w)))
+                return
+            for table in ready:
+                try:
+                    with cr.savepoint():
+                        cr.execute('ALTER TABLE "%s" SET %s' % (
+                            table, 'UNLOGGED' if unlogged else 'LOGGED'))
+                except psycopg2.Error as e:
+                    # SET (UN)LOGGED requires PostgreSQL 9.5
+                    _logger.warning("Can not alter the persistence of "
+                                    "table %s: %s", table, e)
+                    return
+
+    @api.model_cr_context
+    def _auto_init(self):
+        if not self._abstract:
+            self._set_tables_unlogged(self._get_report_tables(),
+                                      unlogged=False)
+        return super(AbstractReport, self)._auto_init()
+
+    @api.model_cr
+    def _register_hook(self):
+        res = super(AbstractReport, self)._register_hook()
+        # once for all inheriting models
+        if self._name == 'report_qweb_abstract':
+            self._set_tables_unlogged(self._get_report_tables())
+        return res
+
+
+class AbstractLedgerReport(models.AbstractModel):
+    """ Fields and helpers shared by the reports summing the move lines
+    of a company: the general ledger and the trial balance. """
+
+    _name = 'report_qweb_ledger_abstract'
+
+    company_id = fields.Many2one(comodel_name='res.company')
+
+    # Compute of unaffected earnings account
+    @api.depends('company_id')
+    def _compute_unaffected_earnings_account(self):
+        account_type = self.env.ref('account.data_unaffected_earnings')
+        self.unaffected_earnings_account = self.env['account.account'].search(
+            [
+                ('user_type_id', '=', account_type.id),
+                ('company_id', '=', self.company_id.id)
+            ])
+
+    unaffected_earnings_account = fields.Many2one(
+        comodel_name='account.account',
+        compute='_compute_unaffected_earnings_account',
+        store=True
+    )
+
+    def _use_balance_snapshot(self):
+        """ Whether sums of move lines can be read from the account balance
+        snapshot, when it is installed """
+        return 'account.balance.snapshot' in self.env and \
+            bool(self.company_id.balance_snapshot_date)
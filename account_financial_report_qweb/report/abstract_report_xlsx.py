@@ -165,15 +165,22 @@ class AbstractReportXslx(ReportXlsx):
     def write_line(self, line_object):
         """Write a line on current line using all defined columns field name.
         Columns are defined with `_get_report_columns` method.
+
+        The line is a record, or a dictionary of values read from the
+        database, where amounts may be NULL.
         """
         for col_pos, column in self.columns.iteritems():
-            value = getattr(line_object, column['field'])
+            if isinstance(line_object, dict):
+                value = line_object[column['field']]
+            else:
+                value = getattr(line_object, column['field'])
             cell_type = column.get('type', 'string')
             if cell_type == 'string':
                 self.sheet.write_string(self.row_pos, col_pos, value or '')
             elif cell_type == 'amount':
                 self.sheet.write_number(
-                    self.row_pos, col_pos, float(value), self.format_amount
+                    self.row_pos, col_pos, float(value or 0.0),
+                    self.format_amount
                 )
         self.row_pos += 1
 
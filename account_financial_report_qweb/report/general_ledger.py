@@ -2,8 +2,13 @@
 # © 2016 Julien Coux (Camptocamp)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import datetime
+
 from odoo import models, fields, api, _
 
+# number of move lines fetched at once by _iter_move_lines()
+FETCH_SIZE = 2000
+
 
 class GeneralLedgerReport(models.TransientModel):
     """ Here, we just define class fields.
@@ -22,6 +27,7 @@ class GeneralLedgerReport(models.TransientModel):
     """
 
     _name = 'report_general_ledger_qweb'
+    _inherit = ['report_qweb_abstract', 'report_qweb_ledger_abstract']
 
     # Filters fields, used for data computation
     date_from = fields.Date()
@@ -51,26 +57,11 @@ class GeneralLedgerReport(models.TransientModel):
         inverse_name='report_id'
     )
 
-    # Compute of unaffected earnings account
-    @api.depends('company_id')
-    def _compute_unaffected_earnings_account(self):
-        account_type = self.env.ref('account.data_unaffected_earnings')
-        self.unaffected_earnings_account = self.env['account.account'].search(
-            [
-                ('user_type_id', '=', account_type.id),
-                ('company_id', '=', self.company_id.id)
-            ])
-
-    unaffected_earnings_account = fields.Many2one(
-        comodel_name='account.account',
-        compute='_compute_unaffected_earnings_account',
-        store=True
-    )
-
 
 class GeneralLedgerReportAccount(models.TransientModel):
 
     _name = 'report_general_ledger_qweb_account'
+    _inherit = 'report_qweb_abstract'
     _order = 'code ASC'
 
     report_id = fields.Many2one(
@@ -112,6 +103,7 @@ class GeneralLedgerReportAccount(models.TransientModel):
 class GeneralLedgerReportPartner(models.TransientModel):
 
     _name = 'report_general_ledger_qweb_partner'
+    _inherit = 'report_qweb_abstract'
 
     report_account_id = fields.Many2one(
         comodel_name='report_general_ledger_qweb_account',
@@ -150,13 +142,15 @@ ORDER BY
         THEN 0
         ELSE 1
     END,
-    "report_general_ledger_qweb_partner"."name"
+    "report_general_ledger_qweb_partner"."name",
+    "report_general_ledger_qweb_partner"."id"
         """
 
 
 class GeneralLedgerReportMoveLine(models.TransientModel):
 
     _name = 'report_general_ledger_qweb_move_line'
+    _inherit = 'report_qweb_abstract'
 
     report_account_id = fields.Many2one(
         comodel_name='report_general_ledger_qweb_account',
@@ -198,7 +192,10 @@ class GeneralLedgerReportCompute(models.TransientModel):
     @api.multi
     def print_report(self, xlsx_report=False):
         self.ensure_one()
-        self.compute_data_for_report()
+        # the XLSX export computes the report when it is rendered,
+        # see _compute_data_for_xlsx_report()
+        if not xlsx_report:
+            self.compute_data_for_report()
         if xlsx_report:
             report_name = 'account_financial_report_qweb.' \
                           'report_general_ledger_xlsx'
@@ -214,134 +211,472 @@ class GeneralLedgerReportCompute(models.TransientModel):
                                 with_partners=True
                                 ):
         self.ensure_one()
+        # All passes read the move lines from the same temporary table,
+        # which holds only sums for most accounts without line details
+        table = self._create_move_line_table(
+            with_lines=with_line_details)
+        report = self.with_context(
+            report_general_ledger_qweb_move_lines=table)
+
         # Compute report data
-        self._inject_account_values()
+        report._inject_account_values()
 
         if with_partners:
-            self._inject_partner_values()
+            report._inject_partner_values()
             if not self.filter_partner_ids:
-                self._inject_partner_values(only_empty_partner=True)
+                report._inject_partner_values(only_empty_partner=True)
 
         # Add unaffected earnings account
         if (not self.filter_account_ids or
                 self.unaffected_earnings_account.id in
                 self.filter_account_ids.ids):
-            self._inject_unaffected_earnings_account_values()
+            report._inject_unaffected_earnings_account_values()
 
         # Call this function even if we don't want line details because,
         # we need to compute
         # at least the values for unaffected earnings account
         # In this case, only unaffected earnings account values are computed
         only_unaffected_earnings_account = not with_line_details
-        self._inject_line_not_centralized_values(
+        report._inject_line_not_centralized_values(
             only_unaffected_earnings_account=only_unaffected_earnings_account
         )
 
         if with_line_details:
-            self._inject_line_not_centralized_values(
+            report._inject_line_not_centralized_values(
                 is_account_line=False,
                 is_partner_line=True)
 
-            self._inject_line_not_centralized_values(
+            report._inject_line_not_centralized_values(
                 is_account_line=False,
                 is_partner_line=True,
                 only_empty_partner_line=True)
 
             if self.centralize:
-                self._inject_line_centralized_values()
+                report._inject_line_centralized_values()
 
         # Complete unaffected earnings account
         if (not self.filter_account_ids or
                 self.unaffected_earnings_account.id in
                 self.filter_account_ids.ids):
-            self._complete_unaffected_earnings_account_values()
+            report._complete_unaffected_earnings_account_values()
 
         if with_line_details:
             # Compute display flag
-            self._compute_has_second_currency()
+            report._compute_has_second_currency()
+
+        self.env.cr.execute('DROP TABLE ' + table)
 
         # Refresh cache because all data are computed with SQL requests
         self.refresh()
 
-    def _get_account_sub_subquery_sum_amounts(
-            self, include_initial_balance, date_included):
-        """ Return subquery used to compute sum amounts on accounts """
-        sub_subquery_sum_amounts = """
+    @api.multi
+    def _compute_data_for_xlsx_report(self):
+        """ Compute the accounts and partners of the report, without line
+        details, replacing those computed before.
+
+        The XLSX export calls it in the transaction which streams the move
+        lines with _iter_move_lines(), so the balances of accounts and
+        partners are computed from the same move lines.
+        """
+        self.ensure_one()
+        # partners and move lines are deleted in cascade
+        self.env.cr.execute(
+            "DELETE FROM report_general_ledger_qweb_account "
+            "WHERE report_id = %s", (self.id, ))
+        self.invalidate_cache()
+        self.compute_data_for_report(with_line_details=False)
+
+    @api.multi
+    def _iter_move_lines(self):
+        """ Iterate the move lines of the report, without storing them
+        in report_general_ledger_qweb_move_line.
+
+        The accounts and partners of the report must be computed in the
+        same transaction, eg with _compute_data_for_xlsx_report(), which
+        does not store the move lines.
+
+        Yields dictionaries with the columns of
+        report_general_ledger_qweb_move_line, in the order of the accounts
+        and partners of the report, and in the order of the move lines
+        of each one. Lines are fetched by batches of FETCH_SIZE from a
+        server-side cursor, so they are never all in memory.
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        query, params = self._get_move_lines_query()
+        cursor_name = 'report_general_ledger_qweb_%s' % self.id
+        cr.execute('DECLARE ' + cursor_name + ' NO SCROLL CURSOR FOR ' +
+                   query, params)
+        try:
+            while True:
+                cr.execute('FETCH %s FROM ' % FETCH_SIZE + cursor_name)
+                lines = cr.dictfetchall()
+                if not lines:
+                    break
+                for line in lines:
+                    yield line
+        finally:
+            cr.execute('CLOSE ' + cursor_name)
+
+    def _get_move_lines_query(self):
+        """ Return the query used by _iter_move_lines(), with its
+        parameters.
+
+        It runs the queries of _inject_line_not_centralized_values() and
+        _inject_line_centralized_values(), ordered like the accounts and
+        partners of the report, so the cumulative balances are computed
+        the same way.
+        """
+        # the move lines are read once, from a common table expression
+        table = self.env.context.get('report_general_ledger_qweb_move_lines')
+        if table:
+            with_query, params = '', ()
+        else:
+            table = 'report_move_lines'
+            query, params = self._get_move_line_slice_query(
+                with_initial=False)
+            with_query = 'WITH ' + table + ' AS (' + query + ')'
+        report = self.with_context(
+            report_general_ledger_qweb_move_lines=table)
+        columns = [
+            'move_line_id',
+            'date',
+            'entry',
+            'journal',
+            'account',
+            'partner',
+            'label',
+            'cost_center',
+            'matching_number',
+            'debit',
+            'credit',
+            'cumul_balance',
+            'currency_name',
+            'amount_currency',
+        ]
+        queries = []
+        for is_account_line, only_empty_partner_line in ((True, False),
+                                                         (False, False),
+                                                         (False, True)):
+            query, query_params = report._get_line_not_centralized_query(
+                is_account_line=is_account_line,
+                is_partner_line=not is_account_line,
+                only_empty_partner_line=only_empty_partner_line
+            )
+            if is_account_line:
+                report_ids = """
+    l.report_account_id,
+    NULL::integer AS report_partner_id,
+                """
+            else:
+                report_ids = """
+    NULL::integer AS report_account_id,
+    l.report_partner_id,
+                """
+            queries.append("""
+SELECT
+            """ + report_ids + ', '.join('l.' + c for c in columns) + """
+FROM
+    (""" + query + """) l
+            """)
+            params += query_params
+        if self.centralize:
+            query, query_params = report._get_line_centralized_query()
+            queries.append("""
+SELECT
+    l.report_account_id,
+    NULL::integer AS report_partner_id,
+    NULL::integer AS move_line_id,
+    l.date,
+    NULL AS entry,
+    NULL AS journal,
+    l.account,
+    NULL AS partner,
+    l.label,
+    NULL AS cost_center,
+    NULL AS matching_number,
+    l.debit,
+    l.credit,
+    l.cumul_balance,
+    NULL AS currency_name,
+    NULL::numeric AS amount_currency
+FROM
+    (""" + query + """) l
+            """)
+            params += query_params
+        query = with_query + """
+SELECT
+    ra.id AS report_account_id,
+    rp.id AS report_partner_id,
+        """ + ', '.join('lines.' + c for c in columns) + """
+FROM
+    (""" + " UNION ALL ".join(queries) + """) lines
+LEFT JOIN
+    report_general_ledger_qweb_partner rp
+        ON lines.report_partner_id = rp.id
+INNER JOIN
+    report_general_ledger_qweb_account ra
+        ON COALESCE(lines.report_account_id, rp.report_account_id) = ra.id
+ORDER BY
+    ra.code,
+    ra.id,
+    rp.partner_id IS NULL,
+    rp.name,
+    rp.id,
+    lines.date,
+    lines.move_line_id
+        """
+        return query, params
+
+    def _use_balance_snapshot(self):
+        # the snapshot has no cost centers
+        return super(GeneralLedgerReportCompute, self).\
+            _use_balance_snapshot() and not self.filter_cost_center_ids
+
+    def _get_move_line_slice_query(self, with_initial=True,
+                                   with_lines=True):
+        """ Return the query selecting the move lines read by the report,
+        with its parameters.
+
+        The move lines of the company dated from date_from to date_to,
+        optionally only posted ones and of the filtered cost centers, are
+        selected with the columns of account_move_line used by the report.
+
+        Without with_lines, only the move lines of the unaffected earnings
+        account are selected: those of the other accounts are summed by
+        account and partner, which is all the report needs when it does not
+        store line details.
+
+        With with_initial, they are followed by the sums of the move lines
+        dated before date_from, by account, partner and whether they are
+        dated before fy_start_date, read from the account balance snapshot
+        when possible. These rows have is_initial set, and no move line.
+        """
+        period_query, period_params = self._get_move_line_source_query(
+            self.date_from, fields.Date.to_string(
+                fields.Date.from_string(self.date_to) +
+                datetime.timedelta(1)))
+        lines_query = """
             SELECT
-                a.id AS account_id,
-                SUM(ml.debit) AS debit,
-                SUM(ml.credit) AS credit,
-                SUM(ml.balance) AS balance
+                ml.id AS move_line_id,
+                ml.move_id,
+                ml.journal_id,
+                ml.account_id,
+                ml.partner_id,
+                ml.date,
+                ml.ref,
+                ml.name,
+                ml.analytic_account_id,
+                ml.full_reconcile_id,
+                ml.debit,
+                ml.credit,
+                ml.balance,
+                ml.amount_currency,
+                FALSE AS is_initial,
+                FALSE AS is_before_fy_start
             FROM
-                accounts a
-            INNER JOIN
-                account_account_type at ON a.user_type_id = at.id
-            INNER JOIN
-                account_move_line ml
-                    ON a.id = ml.account_id
+                (""" + period_query + """) ml
         """
-
-        if date_included:
-            sub_subquery_sum_amounts += """
-                AND ml.date <= %s
-            """
+        unaffected_earnings_account_id = self.unaffected_earnings_account.id
+        if with_lines:
+            query, params = lines_query, period_params
         else:
-            sub_subquery_sum_amounts += """
-                AND ml.date < %s
+            query = """
+            SELECT
+                NULL::integer AS move_line_id,
+                NULL::integer AS move_id,
+                NULL::integer AS journal_id,
+                ml.account_id,
+                ml.partner_id,
+                NULL::date AS date,
+                NULL AS ref,
+                NULL AS name,
+                NULL::integer AS analytic_account_id,
+                NULL::integer AS full_reconcile_id,
+                SUM(ml.debit) AS debit,
+                SUM(ml.credit) AS credit,
+                SUM(ml.balance) AS balance,
+                NULL::numeric AS amount_currency,
+                FALSE AS is_initial,
+                FALSE AS is_before_fy_start
+            FROM
+                (""" + period_query + """) ml
             """
-
-        if not include_initial_balance:
-            sub_subquery_sum_amounts += """
-                AND at.include_initial_balance != TRUE AND ml.date >= %s
+            params = period_params
+            if unaffected_earnings_account_id:
+                query += """
+            WHERE
+                ml.account_id != %s
+                """
+                params += (unaffected_earnings_account_id, )
+            query += """
+            GROUP BY
+                4, 5
             """
+            if unaffected_earnings_account_id:
+                query += """
+            UNION ALL
+                """ + lines_query + """
+            WHERE
+                ml.account_id = %s
+                """
+                params += period_params + (unaffected_earnings_account_id, )
+        if not with_initial:
+            return query, params
+        if self._use_balance_snapshot():
+            initial_queries = []
+            initial_params = ()
+            for date_from, date_to in ((None, self.fy_start_date),
+                                       (self.fy_start_date, self.date_from)):
+                snapshot_query, snapshot_params = \
+                    self.env['account.balance.snapshot'].\
+                    _get_move_line_subquery(self.company_id, date_from,
+                                            date_to, self.only_posted_moves)
+                initial_queries.append(snapshot_query)
+                initial_params += snapshot_params
+            initial_query = ' UNION ALL '.join(initial_queries)
         else:
-            sub_subquery_sum_amounts += """
-                AND at.include_initial_balance = TRUE
-            """
-
+            initial_query, initial_params = \
+                self._get_move_line_source_query(None, self.date_from)
+        query += """
+            UNION ALL
+            SELECT
+                NULL::integer AS move_line_id,
+                NULL::integer AS move_id,
+                NULL::integer AS journal_id,
+                ml.account_id,
+                ml.partner_id,
+                NULL::date AS date,
+                NULL AS ref,
+                NULL AS name,
+                NULL::integer AS analytic_account_id,
+                NULL::integer AS full_reconcile_id,
+                SUM(ml.debit) AS debit,
+                SUM(ml.credit) AS credit,
+                SUM(ml.balance) AS balance,
+                NULL::numeric AS amount_currency,
+                TRUE AS is_initial,
+                ml.date < %s AS is_before_fy_start
+            FROM
+                (""" + initial_query + """) ml
+            GROUP BY
+                4, 5, 16
+        """
+        params += (self.fy_start_date, ) + initial_params
+        return query, params
+
+    def _get_move_line_source_query(self, date_from, date_to):
+        """ Return the query selecting the move lines of the company dated
+        from date_from (included, or from the beginning if None) to date_to
+        (excluded), optionally only posted ones and of the filtered cost
+        centers, with its parameters """
+        query = """
+                SELECT
+                    ml.*
+                FROM
+                    account_move_line ml
+        """
         if self.only_posted_moves:
-            sub_subquery_sum_amounts += """
-        INNER JOIN
-            account_move m ON ml.move_id = m.id AND m.state = 'posted'
+            query += """
+                INNER JOIN
+                    account_move m ON ml.move_id = m.id AND m.state = 'posted'
             """
+        query += """
+                WHERE
+                    ml.company_id = %s
+                AND
+                    ml.date < %s
+        """
+        params = (self.company_id.id, date_to)
+        if date_from:
+            query += """
+                AND
+                    ml.date >= %s
+            """
+            params += (date_from, )
         if self.filter_cost_center_ids:
-            sub_subquery_sum_amounts += """
-        INNER JOIN
-            account_analytic_account aa
-                ON
-                    ml.analytic_account_id = aa.id
-                    AND aa.id IN %s
+            query += """
+                AND
+                    ml.analytic_account_id IN %s
             """
-        sub_subquery_sum_amounts += """
-        GROUP BY
-            a.id
+            params += (tuple(self.filter_cost_center_ids.ids), )
+        return query, params
+
+    def _create_move_line_table(self, with_lines=True):
+        """ Store the move lines read by the report in a temporary table,
+        so the ledger is read only once, and return its name.
+
+        The sums and the move lines of the report are all computed from
+        this table, see _get_move_line_table(). Without with_lines, the
+        table holds sums instead of the move lines of most accounts,
+        see _get_move_line_slice_query().
+        """
+        cr = self.env.cr
+        table = 'report_general_ledger_qweb_ml_%s' % self.id
+        query, params = self._get_move_line_slice_query(
+            with_lines=with_lines)
+        cr.execute('DROP TABLE IF EXISTS ' + table)
+        cr.execute('CREATE TEMPORARY TABLE ' + table + ' ON COMMIT DROP AS ' +
+                   query, params)
+        cr.execute('ANALYZE ' + table)
+        return table
+
+    def _get_move_line_table(self, with_initial=True):
+        """ Return the table, or the subquery, of the move lines read by
+        the report (see _get_move_line_slice_query()).
+
+        It is the table named by the report_general_ledger_qweb_move_lines
+        key of the context, like the temporary table created by
+        compute_data_for_report(), or else a subquery.
+        """
+        table = self.env.context.get('report_general_ledger_qweb_move_lines')
+        if table:
+            return table
+        query, params = self._get_move_line_slice_query(
+            with_initial=with_initial)
+        return '(' + self.env.cr.mogrify(query, params) + ')'
+
+    def _get_sum_amounts_columns(self):
+        """ Return the columns of the subqueries used to compute initial
+        and final sum amounts, in one scan of the move lines """
+        return """
+                SUM(
+                    CASE WHEN ml.is_initial THEN ml.debit END
+                ) AS initial_debit,
+                SUM(
+                    CASE WHEN ml.is_initial THEN ml.credit END
+                ) AS initial_credit,
+                SUM(
+                    CASE WHEN ml.is_initial THEN ml.balance END
+                ) AS initial_balance,
+                SUM(ml.debit) AS final_debit,
+                SUM(ml.credit) AS final_credit,
+                SUM(ml.balance) AS final_balance
         """
-        return sub_subquery_sum_amounts
 
-    def _get_final_account_sub_subquery_sum_amounts(self, date_included):
-        """ Return final subquery used to compute sum amounts on accounts """
+    def _get_account_subquery_sum_amounts(self):
+        """ Return subquery used to compute sum amounts on accounts.
+
+        Move lines are read from the start of the fiscal year for the
+        accounts whose balance is not brought forward.
+        """
         subquery_sum_amounts = """
             SELECT
-                sub.account_id AS account_id,
-                SUM(COALESCE(sub.debit, 0.0)) AS debit,
-                SUM(COALESCE(sub.credit, 0.0)) AS credit,
-                SUM(COALESCE(sub.balance, 0.0)) AS balance
+                a.id AS account_id,
+        """ + self._get_sum_amounts_columns() + """
             FROM
-            (
-        """
-        subquery_sum_amounts += self._get_account_sub_subquery_sum_amounts(
-            include_initial_balance=False, date_included=date_included
-        )
-        subquery_sum_amounts += """
-                UNION
-        """
-        subquery_sum_amounts += self._get_account_sub_subquery_sum_amounts(
-            include_initial_balance=True, date_included=date_included
-        )
-        subquery_sum_amounts += """
-            ) sub
+                accounts a
+            INNER JOIN
+                account_account_type at ON a.user_type_id = at.id
+            INNER JOIN
+                """ + self._get_move_line_table() + """ ml
+                    ON a.id = ml.account_id
+                    AND (
+                        at.include_initial_balance = TRUE
+                        OR NOT ml.is_before_fy_start
+                    )
             GROUP BY
-                sub.account_id
+                a.id
         """
         return subquery_sum_amounts
 
@@ -362,22 +697,11 @@ WITH
                 account_account a
             """
         if self.filter_partner_ids or self.filter_cost_center_ids:
+            # the move lines are already filtered on cost centers
             query_inject_account += """
             INNER JOIN
-                account_move_line ml ON a.id = ml.account_id
-            """
-        if self.filter_partner_ids:
-            query_inject_account += """
-            INNER JOIN
-                res_partner p ON ml.partner_id = p.id
-            """
-        if self.filter_cost_center_ids:
-            query_inject_account += """
-            INNER JOIN
-                account_analytic_account aa
-                    ON
-                        ml.analytic_account_id = aa.id
-                        AND aa.id IN %s
+                """ + self._get_move_line_table() + """ ml
+                    ON a.id = ml.account_id
             """
         query_inject_account += """
             WHERE
@@ -392,7 +716,7 @@ WITH
         if self.filter_partner_ids:
             query_inject_account += """
             AND
-                p.id IN %s
+                ml.partner_id IN %s
             """
         if self.filter_partner_ids or self.filter_cost_center_ids:
             query_inject_account += """
@@ -400,17 +724,11 @@ WITH
                 a.id
             """
 
-        init_subquery = self._get_final_account_sub_subquery_sum_amounts(
-            date_included=False
-        )
-        final_subquery = self._get_final_account_sub_subquery_sum_amounts(
-            date_included=True
-        )
+        subquery_sum_amounts = self._get_account_subquery_sum_amounts()
 
         query_inject_account += """
         ),
-    initial_sum_amounts AS ( """ + init_subquery + """ ),
-    final_sum_amounts AS ( """ + final_subquery + """ )
+    sum_amounts AS ( """ + subquery_sum_amounts + """ )
 INSERT INTO
     report_general_ledger_qweb_account
     (
@@ -435,40 +753,33 @@ SELECT
     a.id AS account_id,
     a.code,
     a.name,
-    COALESCE(i.debit, 0.0) AS initial_debit,
-    COALESCE(i.credit, 0.0) AS initial_credit,
-    COALESCE(i.balance, 0.0) AS initial_balance,
-    COALESCE(f.debit, 0.0) AS final_debit,
-    COALESCE(f.credit, 0.0) AS final_credit,
-    COALESCE(f.balance, 0.0) AS final_balance,
+    COALESCE(s.initial_debit, 0.0) AS initial_debit,
+    COALESCE(s.initial_credit, 0.0) AS initial_credit,
+    COALESCE(s.initial_balance, 0.0) AS initial_balance,
+    COALESCE(s.final_debit, 0.0) AS final_debit,
+    COALESCE(s.final_credit, 0.0) AS final_credit,
+    COALESCE(s.final_balance, 0.0) AS final_balance,
     a.is_partner_account
 FROM
     accounts a
-LEFT JOIN
-    initial_sum_amounts i ON a.id = i.account_id
-LEFT JOIN
-    final_sum_amounts f ON a.id = f.account_id
+INNER JOIN
+    sum_amounts s ON a.id = s.account_id
 WHERE
     (
-        i.debit IS NOT NULL AND i.debit != 0
-        OR i.credit IS NOT NULL AND i.credit != 0
-        OR i.balance IS NOT NULL AND i.balance != 0
-        OR f.debit IS NOT NULL AND f.debit != 0
-        OR f.credit IS NOT NULL AND f.credit != 0
-        OR f.balance IS NOT NULL AND f.balance != 0
+        s.initial_debit IS NOT NULL AND s.initial_debit != 0
+        OR s.initial_credit IS NOT NULL AND s.initial_credit != 0
+        OR s.initial_balance IS NOT NULL AND s.initial_balance != 0
+        OR s.final_debit IS NOT NULL AND s.final_debit != 0
+        OR s.final_credit IS NOT NULL AND s.final_credit != 0
+        OR s.final_balance IS NOT NULL AND s.final_balance != 0
     )
         """
         if self.hide_account_balance_at_0:
             query_inject_account += """
 AND
-    f.balance IS NOT NULL AND f.balance != 0
+    s.final_balance IS NOT NULL AND s.final_balance != 0
             """
-        query_inject_account_params = ()
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
+        query_inject_account_params = (
             self.company_id.id,
             self.unaffected_earnings_account.id,
         )
@@ -480,134 +791,41 @@ AND
             query_inject_account_params += (
                 tuple(self.filter_partner_ids.ids),
             )
-        query_inject_account_params += (
-            self.date_from,
-            self.fy_start_date,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
-            self.date_from,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
-            self.date_to,
-            self.fy_start_date,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
-            self.date_to,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
         query_inject_account_params += (
             self.id,
             self.env.uid,
         )
         self.env.cr.execute(query_inject_account, query_inject_account_params)
 
-    def _get_partner_sub_subquery_sum_amounts(
-            self, only_empty_partner, include_initial_balance, date_included
-    ):
-        """ Return subquery used to compute sum amounts on partners """
-        sub_subquery_sum_amounts = """
+    def _get_partner_subquery_sum_amounts(self, only_empty_partner):
+        """ Return subquery used to compute sum amounts on partners,
+        in one scan of the move lines, like on accounts """
+        subquery_sum_amounts = """
             SELECT
                 ap.account_id AS account_id,
                 ap.partner_id AS partner_id,
-                SUM(ml.debit) AS debit,
-                SUM(ml.credit) AS credit,
-                SUM(ml.balance) AS balance
+        """ + self._get_sum_amounts_columns() + """
             FROM
                 accounts_partners ap
             INNER JOIN
-                account_move_line ml
+                """ + self._get_move_line_table() + """ ml
                     ON ap.account_id = ml.account_id
-            """
-        if date_included:
-            sub_subquery_sum_amounts += """
-                    AND ml.date <= %s
-            """
-        else:
-            sub_subquery_sum_amounts += """
-                    AND ml.date < %s
-            """
+                    AND (
+                        ap.include_initial_balance = TRUE
+                        OR NOT ml.is_before_fy_start
+                    )
+        """
         if not only_empty_partner:
-            sub_subquery_sum_amounts += """
+            subquery_sum_amounts += """
                     AND ap.partner_id = ml.partner_id
             """
         else:
-            sub_subquery_sum_amounts += """
+            subquery_sum_amounts += """
                     AND ap.partner_id IS NULL AND ml.partner_id IS NULL
             """
-        if not include_initial_balance:
-            sub_subquery_sum_amounts += """
-                    AND ap.include_initial_balance != TRUE AND ml.date >= %s
-            """
-        else:
-            sub_subquery_sum_amounts += """
-                    AND ap.include_initial_balance = TRUE
-            """
-        if self.only_posted_moves:
-            sub_subquery_sum_amounts += """
-            INNER JOIN
-                account_move m ON ml.move_id = m.id AND m.state = 'posted'
-            """
-        if self.filter_cost_center_ids:
-            sub_subquery_sum_amounts += """
-        INNER JOIN
-            account_analytic_account aa
-                ON
-                    ml.analytic_account_id = aa.id
-                    AND aa.id IN %s
-            """
-        sub_subquery_sum_amounts += """
-            GROUP BY
-                ap.account_id, ap.partner_id
-        """
-        return sub_subquery_sum_amounts
-
-    def _get_final_partner_sub_subquery_sum_amounts(self, only_empty_partner,
-                                                    date_included):
-        """Return final subquery used to compute sum amounts on partners"""
-
-        subquery_sum_amounts = """
-
-            SELECT
-                sub.account_id AS account_id,
-                sub.partner_id AS partner_id,
-                SUM(COALESCE(sub.debit, 0.0)) AS debit,
-                SUM(COALESCE(sub.credit, 0.0)) AS credit,
-                SUM(COALESCE(sub.balance, 0.0)) AS balance
-            FROM
-            (
-        """
-        subquery_sum_amounts += self._get_partner_sub_subquery_sum_amounts(
-            only_empty_partner,
-            include_initial_balance=False,
-            date_included=date_included
-        )
-        subquery_sum_amounts += """
-            UNION
-        """
-        subquery_sum_amounts += self._get_partner_sub_subquery_sum_amounts(
-            only_empty_partner,
-            include_initial_balance=True,
-            date_included=date_included
-        )
         subquery_sum_amounts += """
-            ) sub
             GROUP BY
-                sub.account_id, sub.partner_id
+                ap.account_id, ap.partner_id
         """
         return subquery_sum_amounts
 
@@ -643,19 +861,10 @@ WITH
             INNER JOIN
                 account_account_type at ON a.user_type_id = at.id
             INNER JOIN
-                account_move_line ml ON a.id = ml.account_id
+                """ + self._get_move_line_table() + """ ml
+                    ON a.id = ml.account_id
             LEFT JOIN
                 res_partner p ON ml.partner_id = p.id
-                    """
-        if self.filter_cost_center_ids:
-            query_inject_partner += """
-            INNER JOIN
-                account_analytic_account aa
-                    ON
-                        ml.analytic_account_id = aa.id
-                        AND aa.id IN %s
-            """
-        query_inject_partner += """
             WHERE
                 ra.report_id = %s
             AND
@@ -683,13 +892,8 @@ WITH
                 p.id IN %s
             """
 
-        init_subquery = self._get_final_partner_sub_subquery_sum_amounts(
-            only_empty_partner,
-            date_included=False
-        )
-        final_subquery = self._get_final_partner_sub_subquery_sum_amounts(
-            only_empty_partner,
-            date_included=True
+        subquery_sum_amounts = self._get_partner_subquery_sum_amounts(
+            only_empty_partner
         )
 
         query_inject_partner += """
@@ -699,8 +903,7 @@ WITH
                 p.id,
                 at.include_initial_balance
         ),
-    initial_sum_amounts AS ( """ + init_subquery + """ ),
-    final_sum_amounts AS ( """ + final_subquery + """ )
+    sum_amounts AS ( """ + subquery_sum_amounts + """ )
 INSERT INTO
     report_general_ledger_qweb_partner
     (
@@ -722,103 +925,52 @@ SELECT
     NOW() AS create_date,
     ap.partner_id,
     ap.partner_name,
-    COALESCE(i.debit, 0.0) AS initial_debit,
-    COALESCE(i.credit, 0.0) AS initial_credit,
-    COALESCE(i.balance, 0.0) AS initial_balance,
-    COALESCE(f.debit, 0.0) AS final_debit,
-    COALESCE(f.credit, 0.0) AS final_credit,
-    COALESCE(f.balance, 0.0) AS final_balance
+    COALESCE(s.initial_debit, 0.0) AS initial_debit,
+    COALESCE(s.initial_credit, 0.0) AS initial_credit,
+    COALESCE(s.initial_balance, 0.0) AS initial_balance,
+    COALESCE(s.final_debit, 0.0) AS final_debit,
+    COALESCE(s.final_credit, 0.0) AS final_credit,
+    COALESCE(s.final_balance, 0.0) AS final_balance
 FROM
     accounts_partners ap
-LEFT JOIN
-    initial_sum_amounts i
-        ON
-            (
-        """
-        if not only_empty_partner:
-            query_inject_partner += """
-                ap.partner_id = i.partner_id
-            """
-        else:
-            query_inject_partner += """
-                ap.partner_id IS NULL AND i.partner_id IS NULL
-            """
-        query_inject_partner += """
-            )
-            AND ap.account_id = i.account_id
-LEFT JOIN
-    final_sum_amounts f
+INNER JOIN
+    sum_amounts s
         ON
             (
         """
         if not only_empty_partner:
             query_inject_partner += """
-                ap.partner_id = f.partner_id
+                ap.partner_id = s.partner_id
             """
         else:
             query_inject_partner += """
-                ap.partner_id IS NULL AND f.partner_id IS NULL
+                ap.partner_id IS NULL AND s.partner_id IS NULL
             """
         query_inject_partner += """
             )
-            AND ap.account_id = f.account_id
+            AND ap.account_id = s.account_id
 WHERE
     (
-        i.debit IS NOT NULL AND i.debit != 0
-        OR i.credit IS NOT NULL AND i.credit != 0
-        OR i.balance IS NOT NULL AND i.balance != 0
-        OR f.debit IS NOT NULL AND f.debit != 0
-        OR f.credit IS NOT NULL AND f.credit != 0
-        OR f.balance IS NOT NULL AND f.balance != 0
+        s.initial_debit IS NOT NULL AND s.initial_debit != 0
+        OR s.initial_credit IS NOT NULL AND s.initial_credit != 0
+        OR s.initial_balance IS NOT NULL AND s.initial_balance != 0
+        OR s.final_debit IS NOT NULL AND s.final_debit != 0
+        OR s.final_credit IS NOT NULL AND s.final_credit != 0
+        OR s.final_balance IS NOT NULL AND s.final_balance != 0
     )
         """
         if self.hide_account_balance_at_0:
             query_inject_partner += """
 AND
-    f.balance IS NOT NULL AND f.balance != 0
+    s.final_balance IS NOT NULL AND s.final_balance != 0
             """
-        query_inject_partner_params = ()
-        if self.filter_cost_center_ids:
-            query_inject_partner_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_partner_params += (
+        query_inject_partner_params = (
             self.id,
         )
         if self.filter_partner_ids:
             query_inject_partner_params += (
                 tuple(self.filter_partner_ids.ids),
             )
-        query_inject_partner_params += (
-            self.date_from,
-            self.fy_start_date,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_partner_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_partner_params += (
-            self.date_from,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_partner_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_partner_params += (
-            self.date_to,
-            self.fy_start_date,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_partner_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_partner_params += (
-            self.date_to,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_partner_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
         query_inject_partner_params += (
             self.env.uid,
         )
@@ -872,6 +1024,35 @@ INSERT INTO
     currency_name,
     amount_currency
     )
+        """
+        query_select_move_line, query_inject_move_line_params = \
+            self._get_line_not_centralized_query(
+                is_account_line=is_account_line,
+                is_partner_line=is_partner_line,
+                only_empty_partner_line=only_empty_partner_line,
+                only_unaffected_earnings_account=(
+                    only_unaffected_earnings_account)
+            )
+        query_inject_move_line += query_select_move_line
+        self.env.cr.execute(
+            query_inject_move_line,
+            query_inject_move_line_params
+        )
+
+    def _get_line_not_centralized_query(
+            self,
+            is_account_line=True,
+            is_partner_line=False,
+            only_empty_partner_line=False,
+            only_unaffected_earnings_account=False):
+        """ Return the query selecting the values of
+        report_general_ledger_qweb_move_line inserted by
+        _inject_line_not_centralized_values(), with its parameters.
+
+        The first column is report_account_id or report_partner_id,
+        followed by the other columns of the table.
+        """
+        query_inject_move_line = """
 SELECT
         """
         if is_account_line:
@@ -885,7 +1066,7 @@ SELECT
         query_inject_move_line += """
     %s AS create_uid,
     NOW() AS create_date,
-    ml.id AS move_line_id,
+    ml.move_line_id,
     ml.date,
     m.name AS entry,
     j.code AS journal,
@@ -912,28 +1093,22 @@ SELECT
     ml.debit,
     ml.credit,
         """
+        # running balances of the report accounts or partners, from their
+        # initial balance, so the lines are read only from date_from
         if is_account_line:
             query_inject_move_line += """
     ra.initial_balance + (
         SUM(ml.balance)
-        OVER (PARTITION BY a.code
-              ORDER BY a.code, ml.date, ml.id)
-    ) AS cumul_balance,
-            """
-        elif is_partner_line and not only_empty_partner_line:
-            query_inject_move_line += """
-    rp.initial_balance + (
-        SUM(ml.balance)
-        OVER (PARTITION BY a.code, p.name
-              ORDER BY a.code, p.name, ml.date, ml.id)
+        OVER (PARTITION BY ra.id
+              ORDER BY ml.date, ml.move_line_id)
     ) AS cumul_balance,
             """
-        elif is_partner_line and only_empty_partner_line:
+        elif is_partner_line:
             query_inject_move_line += """
     rp.initial_balance + (
         SUM(ml.balance)
-        OVER (PARTITION BY a.code
-              ORDER BY a.code, ml.date, ml.id)
+        OVER (PARTITION BY rp.id
+              ORDER BY ml.date, ml.move_line_id)
     ) AS cumul_balance,
             """
         query_inject_move_line += """
@@ -953,7 +1128,8 @@ INNER JOIN
             """
         query_inject_move_line += """
 INNER JOIN
-    account_move_line ml ON ra.account_id = ml.account_id
+    """ + self._get_move_line_table(with_initial=False) + """ ml
+        ON ra.account_id = ml.account_id AND NOT ml.is_initial
 INNER JOIN
     account_move m ON ml.move_id = m.id
 INNER JOIN
@@ -977,20 +1153,9 @@ LEFT JOIN
     account_full_reconcile fr ON ml.full_reconcile_id = fr.id
 LEFT JOIN
     res_currency c ON a.currency_id = c.id
-                    """
-        if self.filter_cost_center_ids:
-            query_inject_move_line += """
-INNER JOIN
-    account_analytic_account aa
-        ON
-            ml.analytic_account_id = aa.id
-            AND aa.id IN %s
-            """
-        else:
-            query_inject_move_line += """
 LEFT JOIN
     account_analytic_account aa ON ml.analytic_account_id = aa.id
-            """
+        """
         query_inject_move_line += """
 WHERE
     ra.report_id = %s
@@ -1014,15 +1179,6 @@ AND
 AND
     (a.centralized IS NULL OR a.centralized != TRUE)
             """
-        query_inject_move_line += """
-AND
-    ml.date BETWEEN %s AND %s
-        """
-        if self.only_posted_moves:
-            query_inject_move_line += """
-AND
-    m.state = 'posted'
-        """
         if only_empty_partner_line:
             query_inject_move_line += """
 AND
@@ -1033,41 +1189,28 @@ AND
         if is_account_line:
             query_inject_move_line += """
 ORDER BY
-    a.code, ml.date, ml.id
+    a.code, ml.date, ml.move_line_id
             """
         elif is_partner_line and not only_empty_partner_line:
             query_inject_move_line += """
 ORDER BY
-    a.code, p.name, ml.date, ml.id
+    a.code, p.name, ml.date, ml.move_line_id
             """
         elif is_partner_line and only_empty_partner_line:
             query_inject_move_line += """
 ORDER BY
-    a.code, ml.date, ml.id
+    a.code, ml.date, ml.move_line_id
             """
 
         query_inject_move_line_params = (
             self.env.uid,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_move_line_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_move_line_params += (
             self.id,
         )
         if only_unaffected_earnings_account:
             query_inject_move_line_params += (
                 self.unaffected_earnings_account.id,
             )
-        query_inject_move_line_params += (
-            self.date_from,
-            self.date_to,
-        )
-        self.env.cr.execute(
-            query_inject_move_line,
-            query_inject_move_line_params
-        )
+        return query_inject_move_line, query_inject_move_line_params
 
     def _inject_line_centralized_values(self):
         """ Inject report values for report_general_ledger_qweb_move_line.
@@ -1075,6 +1218,33 @@ ORDER BY
         Only centralized accounts are computed.
         """
         query_inject_move_line_centralized = """
+INSERT INTO
+    report_general_ledger_qweb_move_line
+    (
+    report_account_id,
+    create_uid,
+    create_date,
+    date,
+    account,
+    label,
+    debit,
+    credit,
+    cumul_balance
+    )
+        """
+        query_select_move_line, query_inject_move_line_centralized_params = \
+            self._get_line_centralized_query()
+        query_inject_move_line_centralized += query_select_move_line
+        self.env.cr.execute(
+            query_inject_move_line_centralized,
+            query_inject_move_line_centralized_params
+        )
+
+    def _get_line_centralized_query(self):
+        """ Return the query selecting the values of
+        report_general_ledger_qweb_move_line inserted by
+        _inject_line_centralized_values(), with its parameters. """
+        query_inject_move_line_centralized = """
 WITH
     move_lines AS
         (
@@ -1090,50 +1260,19 @@ WITH
             FROM
                 report_general_ledger_qweb_account ra
             INNER JOIN
-                account_move_line ml ON ra.account_id = ml.account_id
-            INNER JOIN
-                account_move m ON ml.move_id = m.id
+                """ + self._get_move_line_table(with_initial=False) + """ ml
+                    ON ra.account_id = ml.account_id AND NOT ml.is_initial
             INNER JOIN
                 account_account a ON ml.account_id = a.id
-        """
-        if self.filter_cost_center_ids:
-            query_inject_move_line_centralized += """
-            INNER JOIN
-                account_analytic_account aa
-                    ON
-                        ml.analytic_account_id = aa.id
-                        AND aa.id IN %s
-            """
-        query_inject_move_line_centralized += """
             WHERE
                 ra.report_id = %s
             AND
                 a.centralized = TRUE
-            AND
-                ml.date BETWEEN %s AND %s
         """
-        if self.only_posted_moves:
-            query_inject_move_line_centralized += """
-            AND
-                m.state = 'posted'
-            """
         query_inject_move_line_centralized += """
             GROUP BY
                 ra.id, ml.account_id, a.code, 2
         )
-INSERT INTO
-    report_general_ledger_qweb_move_line
-    (
-    report_account_id,
-    create_uid,
-    create_date,
-    date,
-    account,
-    label,
-    debit,
-    credit,
-    cumul_balance
-    )
 SELECT
     ra.id AS report_account_id,
     %s AS create_uid,
@@ -1145,7 +1284,7 @@ SELECT
     ml.credit AS credit,
     ra.initial_balance + (
         SUM(ml.balance)
-        OVER (PARTITION BY a.code ORDER BY ml.date)
+        OVER (PARTITION BY ra.id ORDER BY ml.date)
     ) AS cumul_balance
 FROM
     report_general_ledger_qweb_account ra
@@ -1163,22 +1302,13 @@ ORDER BY
     a.code, ml.date
         """
 
-        query_inject_move_line_centralized_params = ()
-        if self.filter_cost_center_ids:
-            query_inject_move_line_centralized_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_move_line_centralized_params += (
+        query_inject_move_line_centralized_params = (
             self.id,
-            self.date_from,
-            self.date_to,
             self.env.uid,
             self.id,
         )
-        self.env.cr.execute(
-            query_inject_move_line_centralized,
-            query_inject_move_line_centralized_params
-        )
+        return (query_inject_move_line_centralized,
+                query_inject_move_line_centralized_params)
 
     def _compute_has_second_currency(self):
         """ Compute "has_second_currency" flag which will used for display."""
@@ -1222,75 +1352,50 @@ WHERE id = %s
         params = (self.id,) * 3
         self.env.cr.execute(query_update_has_second_currency, params)
 
-    def _get_unaffected_earnings_account_sub_subquery_sum_amounts(
-            self, include_initial_balance
-    ):
+    def _get_unaffected_earnings_account_subquery_sum_amounts(self):
         """ Return subquery used to compute sum amounts on
-        unaffected earnings accounts """
-        sub_subquery_sum_amounts = """
+        unaffected earnings accounts.
+
+        The initial sums of the other accounts are added up with the
+        balances brought forward (only up to the start of the fiscal year
+        for the accounts whose balance is not brought forward) and the
+        balance of the accounts whose balance is not brought forward.
+        """
+        subquery_sum_amounts = """
         SELECT
-            SUM(ml.balance) AS balance
+            SUM(
+                CASE
+                    WHEN
+                        at.include_initial_balance = TRUE
+                        OR ml.is_before_fy_start
+                    THEN ml.balance
+                    ELSE 0.0
+                END
+                + CASE
+                    WHEN at.include_initial_balance = FALSE
+                    THEN ml.balance
+                    ELSE 0.0
+                END
+            ) AS balance
         FROM
             account_account a
         INNER JOIN
             account_account_type at ON a.user_type_id = at.id
         INNER JOIN
-            account_move_line ml
+            """ + self._get_move_line_table() + """ ml
                 ON a.id = ml.account_id
-                AND ml.date < %s
-        """
-
-        if not include_initial_balance:
-            sub_subquery_sum_amounts += """
-                AND NOT(at.include_initial_balance != TRUE AND ml.date >= %s)
-            """
-        else:
-            sub_subquery_sum_amounts += """
-                AND at.include_initial_balance = FALSE
-            """
-        if self.only_posted_moves:
-            sub_subquery_sum_amounts += """
-        INNER JOIN
-            account_move m ON ml.move_id = m.id AND m.state = 'posted'
-            """
-        if self.filter_cost_center_ids:
-            sub_subquery_sum_amounts += """
-        INNER JOIN
-            account_analytic_account aa
-                ON
-                    ml.analytic_account_id = aa.id
-                    AND aa.id IN %s
-            """
-        sub_subquery_sum_amounts += """
+                AND ml.is_initial
         WHERE
             a.company_id =%s
         AND a.id != %s
         """
-        return sub_subquery_sum_amounts
+        return subquery_sum_amounts
 
     def _inject_unaffected_earnings_account_values(self):
         """Inject the report values of the unaffected earnings account
         for report_general_ledger_qweb_account."""
-        subquery_sum_amounts = """
-            SELECT
-                SUM(COALESCE(sub.balance, 0.0)) AS balance
-            FROM
-            (
-        """
-        subquery_sum_amounts += \
-            self._get_unaffected_earnings_account_sub_subquery_sum_amounts(
-                include_initial_balance=False
-            )
-        subquery_sum_amounts += """
-                UNION
-        """
-        subquery_sum_amounts += \
-            self._get_unaffected_earnings_account_sub_subquery_sum_amounts(
-                include_initial_balance=True
-            )
-        subquery_sum_amounts += """
-            ) sub
-        """
+        subquery_sum_amounts = \
+            self._get_unaffected_earnings_account_subquery_sum_amounts()
         query_inject_account = """
         WITH
             initial_sum_amounts AS ( """ + subquery_sum_amounts + """ )
@@ -1323,25 +1428,6 @@ WHERE id = %s
         AND a.id = %s
                 """
         query_inject_account_params = (
-            self.date_from,
-            self.fy_start_date,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
-            self.company_id.id,
-            self.unaffected_earnings_account.id,
-        )
-        query_inject_account_params += (
-            self.date_from,
-        )
-        if self.filter_cost_center_ids:
-            query_inject_account_params += (
-                tuple(self.filter_cost_center_ids.ids),
-            )
-        query_inject_account_params += (
             self.company_id.id,
             self.unaffected_earnings_account.id,
         )
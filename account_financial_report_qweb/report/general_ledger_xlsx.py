@@ -4,6 +4,8 @@
 # Copyright 2016 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import itertools
+
 from . import abstract_report_xlsx
 from odoo.report import report_sxw
 from odoo import _
@@ -85,6 +87,19 @@ class GeneralLedgerXslx(abstract_report_xlsx.AbstractReportXslx):
         return 5
 
     def _generate_report_content(self, workbook, report):
+        # Accounts and partners are computed in this transaction,
+        # so their balances match the streamed move lines
+        report._compute_data_for_xlsx_report()
+
+        # Move lines are streamed from the database, in the order
+        # of accounts and partners, grouped by account or partner
+        lines = report._iter_move_lines()
+        groups = itertools.groupby(
+            lines,
+            lambda line: (line['report_account_id'],
+                          line['report_partner_id']))
+        group = next(groups, None)
+
         # For each account
         for account in report.account_ids:
             # Write account title
@@ -98,8 +113,8 @@ class GeneralLedgerXslx(abstract_report_xlsx.AbstractReportXslx):
                 self.write_initial_balance(account, _('Initial balance'))
 
                 # Display account move lines
-                for line in account.move_line_ids:
-                    self.write_line(line)
+                group = self._write_move_lines(
+                    groups, group, (account.id, None))
 
             else:
                 # For each partner
@@ -114,8 +129,8 @@ class GeneralLedgerXslx(abstract_report_xlsx.AbstractReportXslx):
                     self.write_initial_balance(partner, _('Initial balance'))
 
                     # Display account move lines
-                    for line in partner.move_line_ids:
-                        self.write_line(line)
+                    group = self._write_move_lines(
+                        groups, group, (account.id, partner.id))
 
                     # Display ending balance line for partner
                     self.write_ending_balance(partner, 'partner')
@@ -129,6 +144,19 @@ class GeneralLedgerXslx(abstract_report_xlsx.AbstractReportXslx):
             # 2 lines break
             self.row_pos += 2
 
+        # Close the database cursor
+        lines.close()
+
+    def _write_move_lines(self, groups, group, key):
+        """Write the move lines of group if it is the group of key
+        (report account id, report partner id), and return the next group
+        """
+        if group is None or group[0] != key:
+            return group
+        for line in group[1]:
+            self.write_line(line)
+        return next(groups, None)
+
     def write_ending_balance(self, my_object, type_object):
         """Specific function to write ending balance for General Ledger"""
         if type_object == 'partner':
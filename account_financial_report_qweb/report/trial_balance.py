@@ -2,7 +2,9 @@
 # © 2016 Julien Coux (Camptocamp)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import models, fields, api
+import datetime
+
+from odoo import models, fields, api, _
 
 
 class TrialBalanceReport(models.TransientModel):
@@ -17,6 +19,7 @@ class TrialBalanceReport(models.TransientModel):
     """
 
     _name = 'report_trial_balance_qweb'
+    _inherit = ['report_qweb_abstract', 'report_qweb_ledger_abstract']
 
     # Filters fields, used for data computation
     date_from = fields.Date()
@@ -29,12 +32,6 @@ class TrialBalanceReport(models.TransientModel):
     filter_partner_ids = fields.Many2many(comodel_name='res.partner')
     show_partner_details = fields.Boolean()
 
-    # General Ledger Report Data fields,
-    # used as base for compute the data reports
-    general_ledger_id = fields.Many2one(
-        comodel_name='report_general_ledger_qweb'
-    )
-
     # Data fields, used to browse report data
     account_ids = fields.One2many(
         comodel_name='report_trial_balance_qweb_account',
@@ -45,6 +42,7 @@ class TrialBalanceReport(models.TransientModel):
 class TrialBalanceReportAccount(models.TransientModel):
 
     _name = 'report_trial_balance_qweb_account'
+    _inherit = 'report_qweb_abstract'
     _order = 'code ASC'
 
     report_id = fields.Many2one(
@@ -78,6 +76,7 @@ class TrialBalanceReportAccount(models.TransientModel):
 class TrialBalanceReportPartner(models.TransientModel):
 
     _name = 'report_trial_balance_qweb_partner'
+    _inherit = 'report_qweb_abstract'
 
     report_account_id = fields.Many2one(
         comodel_name='report_trial_balance_qweb_account',
@@ -133,43 +132,190 @@ class TrialBalanceReportCompute(models.TransientModel):
         return self.env['report'].get_action(docids=self.ids,
                                              report_name=report_name)
 
-    def _prepare_report_general_ledger(self):
-        self.ensure_one()
-        return {
-            'date_from': self.date_from,
-            'date_to': self.date_to,
-            'only_posted_moves': self.only_posted_moves,
-            'hide_account_balance_at_0': self.hide_account_balance_at_0,
-            'company_id': self.company_id.id,
-            'filter_account_ids': [(6, 0, self.filter_account_ids.ids)],
-            'filter_partner_ids': [(6, 0, self.filter_partner_ids.ids)],
-            'fy_start_date': self.fy_start_date,
-        }
-
     @api.multi
     def compute_data_for_report(self):
         self.ensure_one()
-        # Compute General Ledger Report Data.
-        # The data of Trial Balance Report
-        # are based on General Ledger Report data.
-        model = self.env['report_general_ledger_qweb']
-        self.general_ledger_id = model.create(
-            self._prepare_report_general_ledger()
-        )
-        self.general_ledger_id.compute_data_for_report(
-            with_line_details=False, with_partners=self.show_partner_details
-        )
-
-        # Compute report data
+        # Compute report data, with the same sums as the General Ledger
+        # Report, but directly from the move lines
         self._inject_account_values()
         if self.show_partner_details:
             self._inject_partner_values()
         # Refresh cache because all data are computed with SQL requests
         self.refresh()
 
+    def _get_move_line_table(self):
+        """ Return the table, or the subquery on the account balance
+        snapshot, of the move lines summed by the report.
+
+        The subquery already filters posted moves, and selects the move
+        lines dated up to date_to. Snapshot months never overlap
+        fy_start_date or date_from, so the date of each row tells in which
+        sums it is counted.
+        """
+        if not self._use_balance_snapshot():
+            return 'account_move_line'
+        date_end = fields.Date.to_string(
+            fields.Date.from_string(self.date_to) + datetime.timedelta(1))
+        subqueries = []
+        for date_from, date_to in ((None, self.fy_start_date),
+                                   (self.fy_start_date, self.date_from),
+                                   (self.date_from, date_end)):
+            query, params = self.env['account.balance.snapshot'].\
+                _get_move_line_subquery(self.company_id, date_from, date_to,
+                                        self.only_posted_moves)
+            subqueries.append(self.env.cr.mogrify(query, params))
+        return '(' + ' UNION ALL '.join(subqueries) + ')'
+
+    def _get_subquery_sum_amounts(self, group_by_partner=False):
+        """ Return the subquery summing the move lines of the company by
+        account (and by partner of the payable and receivable accounts
+        with group_by_partner), with its parameters.
+
+        The move lines are read once, up to date_to. Like in the General
+        Ledger Report, the initial and final sums of the accounts whose
+        balance is not brought forward start at fy_start_date, and the
+        unaffected_earnings column sums what the move lines of each account
+        bring to the initial balance of the unaffected earnings account.
+        """
+        subquery_sum_amounts = """
+            SELECT
+                ml.account_id,
+        """
+        if group_by_partner:
+            subquery_sum_amounts += """
+                ml.partner_id,
+            """
+        subquery_sum_amounts += """
+                SUM(
+                    CASE
+                        WHEN ml.is_initial AND ml.is_brought_forward
+                        THEN ml.debit
+                    END
+                ) AS initial_debit,
+                SUM(
+                    CASE
+                        WHEN ml.is_initial AND ml.is_brought_forward
+                        THEN ml.credit
+                    END
+                ) AS initial_credit,
+                SUM(
+                    CASE
+                        WHEN ml.is_initial AND ml.is_brought_forward
+                        THEN ml.balance
+                    END
+                ) AS initial_balance,
+                SUM(
+                    CASE WHEN NOT ml.is_initial THEN ml.debit END
+                ) AS debit,
+                SUM(
+                    CASE WHEN NOT ml.is_initial THEN ml.credit END
+                ) AS credit,
+                SUM(
+                    CASE WHEN ml.is_brought_forward THEN ml.debit END
+                ) AS final_debit,
+                SUM(
+                    CASE WHEN ml.is_brought_forward THEN ml.credit END
+                ) AS final_credit,
+                SUM(
+                    CASE WHEN ml.is_brought_forward THEN ml.balance END
+                ) AS final_balance,
+                SUM(
+                    CASE
+                        WHEN
+                            ml.is_initial
+                            AND (
+                                ml.include_initial_balance = TRUE
+                                OR ml.is_before_fy_start
+                            )
+                        THEN ml.balance
+                        ELSE 0.0
+                    END
+                    + CASE
+                        WHEN
+                            ml.is_initial
+                            AND ml.include_initial_balance = FALSE
+                        THEN ml.balance
+                        ELSE 0.0
+                    END
+                ) AS unaffected_earnings
+        """
+        params = ()
+        if self.filter_partner_ids and not group_by_partner:
+            subquery_sum_amounts += """,
+                BOOL_OR(ml.partner_id IN %s) AS has_filtered_partner
+            """
+            params += (tuple(self.filter_partner_ids.ids), )
+        subquery_sum_amounts += """
+            FROM
+                (
+                    SELECT
+                        ml.account_id,
+                        ml.partner_id,
+                        ml.debit,
+                        ml.credit,
+                        ml.balance,
+                        ml.date < %s AS is_initial,
+                        ml.date < %s AS is_before_fy_start,
+                        at.include_initial_balance,
+                        at.include_initial_balance = TRUE OR ml.date >= %s
+                            AS is_brought_forward
+                    FROM
+                        """ + self._get_move_line_table() + """ ml
+                    INNER JOIN
+                        account_account a ON ml.account_id = a.id
+                    INNER JOIN
+                        account_account_type at ON a.user_type_id = at.id
+        """
+        params += (
+            self.date_from,
+            self.fy_start_date,
+            self.fy_start_date,
+        )
+        if self.only_posted_moves and not self._use_balance_snapshot():
+            subquery_sum_amounts += """
+                    INNER JOIN
+                        account_move m
+                            ON ml.move_id = m.id AND m.state = 'posted'
+            """
+        subquery_sum_amounts += """
+                    WHERE
+                        a.company_id = %s
+                    AND
+                        ml.date <= %s
+        """
+        params += (
+            self.company_id.id,
+            self.date_to,
+        )
+        if group_by_partner:
+            subquery_sum_amounts += """
+                    AND
+                        a.internal_type IN ('payable', 'receivable')
+            """
+            if self.filter_partner_ids:
+                subquery_sum_amounts += """
+                    AND
+                        ml.partner_id IN %s
+                """
+                params += (tuple(self.filter_partner_ids.ids), )
+        subquery_sum_amounts += """
+                ) ml
+            GROUP BY
+                ml.account_id
+        """
+        if group_by_partner:
+            subquery_sum_amounts += """,
+                ml.partner_id
+            """
+        return subquery_sum_amounts, params
+
     def _inject_account_values(self):
         """Inject report values for report_trial_balance_qweb_account"""
+        subquery_sum_amounts, query_inject_account_params = \
+            self._get_subquery_sum_amounts()
         query_inject_account = """
+WITH
+    sum_amounts AS ( """ + subquery_sum_amounts + """ )
 INSERT INTO
     report_trial_balance_qweb_account
     (
@@ -188,28 +334,106 @@ SELECT
     %s AS report_id,
     %s AS create_uid,
     NOW() AS create_date,
-    rag.account_id,
-    rag.code,
-    rag.name,
-    rag.initial_balance AS initial_balance,
-    rag.final_debit - rag.initial_debit AS debit,
-    rag.final_credit - rag.initial_credit AS credit,
-    rag.final_balance AS final_balance
+    a.id AS account_id,
+    a.code,
+    a.name,
+    COALESCE(s.initial_balance, 0.0) AS initial_balance,
+    COALESCE(s.debit, 0.0) AS debit,
+    COALESCE(s.credit, 0.0) AS credit,
+    COALESCE(s.final_balance, 0.0) AS final_balance
 FROM
-    report_general_ledger_qweb_account rag
+    sum_amounts s
+INNER JOIN
+    account_account a ON s.account_id = a.id
 WHERE
-    rag.report_id = %s
+    (
+        s.initial_debit IS NOT NULL AND s.initial_debit != 0
+        OR s.initial_credit IS NOT NULL AND s.initial_credit != 0
+        OR s.initial_balance IS NOT NULL AND s.initial_balance != 0
+        OR s.final_debit IS NOT NULL AND s.final_debit != 0
+        OR s.final_credit IS NOT NULL AND s.final_credit != 0
+        OR s.final_balance IS NOT NULL AND s.final_balance != 0
+    )
         """
-        query_inject_account_params = (
+        query_inject_account_params += (
             self.id,
             self.env.uid,
-            self.general_ledger_id.id,
         )
+        if self.unaffected_earnings_account:
+            query_inject_account += """
+AND
+    a.id != %s
+            """
+            query_inject_account_params += (
+                self.unaffected_earnings_account.id,
+            )
+        if self.hide_account_balance_at_0:
+            query_inject_account += """
+AND
+    s.final_balance IS NOT NULL AND s.final_balance != 0
+            """
+        if self.filter_account_ids:
+            query_inject_account += """
+AND
+    a.id IN %s
+            """
+            query_inject_account_params += (
+                tuple(self.filter_account_ids.ids),
+            )
+        if self.filter_partner_ids:
+            query_inject_account += """
+AND
+    s.has_filtered_partner
+            """
+        # Add unaffected earnings account
+        if self.unaffected_earnings_account and (
+                not self.filter_account_ids or
+                self.unaffected_earnings_account in self.filter_account_ids):
+            query_inject_account += """
+UNION ALL
+SELECT
+    %s AS report_id,
+    %s AS create_uid,
+    NOW() AS create_date,
+    a.id AS account_id,
+    a.code,
+    a.name,
+    u.balance AS initial_balance,
+    COALESCE(s.debit, 0.0) AS debit,
+    COALESCE(s.credit, 0.0) AS credit,
+    u.balance + COALESCE(s.debit, 0.0) - COALESCE(s.credit, 0.0)
+        AS final_balance
+FROM
+    account_account a
+CROSS JOIN
+    (
+        SELECT
+            COALESCE(SUM(unaffected_earnings), 0.0) AS balance
+        FROM
+            sum_amounts
+        WHERE
+            account_id != %s
+    ) u
+LEFT JOIN
+    sum_amounts s ON a.id = s.account_id
+WHERE
+    a.id = %s
+            """
+            query_inject_account_params += (
+                self.id,
+                self.env.uid,
+                self.unaffected_earnings_account.id,
+                self.unaffected_earnings_account.id,
+            )
         self.env.cr.execute(query_inject_account, query_inject_account_params)
 
     def _inject_partner_values(self):
         """Inject report values for report_trial_balance_qweb_partner"""
+        subquery_sum_amounts, query_inject_partner_params = \
+            self._get_subquery_sum_amounts(group_by_partner=True)
         query_inject_partner = """
+WITH
+    sum_amounts AS ( """ + subquery_sum_amounts + """ )
 INSERT INTO
     report_trial_balance_qweb_partner
     (
@@ -227,25 +451,46 @@ SELECT
     ra.id AS report_account_id,
     %s AS create_uid,
     NOW() AS create_date,
-    rpg.partner_id,
-    rpg.name,
-    rpg.initial_balance AS initial_balance,
-    rpg.final_debit - rpg.initial_debit AS debit,
-    rpg.final_credit - rpg.initial_credit AS credit,
-    rpg.final_balance AS final_balance
+    s.partner_id,
+    COALESCE(
+        CASE
+            WHEN
+                NULLIF(p.name, '') IS NOT NULL
+                AND NULLIF(p.ref, '') IS NOT NULL
+            THEN p.name || ' (' || p.ref || ')'
+            ELSE p.name
+        END,
+        '""" + _('No partner allocated') + """'
+    ) AS name,
+    COALESCE(s.initial_balance, 0.0) AS initial_balance,
+    COALESCE(s.debit, 0.0) AS debit,
+    COALESCE(s.credit, 0.0) AS credit,
+    COALESCE(s.final_balance, 0.0) AS final_balance
 FROM
-    report_general_ledger_qweb_partner rpg
-INNER JOIN
-    report_general_ledger_qweb_account rag ON rpg.report_account_id = rag.id
+    sum_amounts s
 INNER JOIN
-    report_trial_balance_qweb_account ra ON rag.code = ra.code
+    report_trial_balance_qweb_account ra ON s.account_id = ra.account_id
+LEFT JOIN
+    res_partner p ON s.partner_id = p.id
 WHERE
-    rag.report_id = %s
-AND ra.report_id = %s
+    ra.report_id = %s
+AND
+    (
+        s.initial_debit IS NOT NULL AND s.initial_debit != 0
+        OR s.initial_credit IS NOT NULL AND s.initial_credit != 0
+        OR s.initial_balance IS NOT NULL AND s.initial_balance != 0
+        OR s.final_debit IS NOT NULL AND s.final_debit != 0
+        OR s.final_credit IS NOT NULL AND s.final_credit != 0
+        OR s.final_balance IS NOT NULL AND s.final_balance != 0
+    )
         """
-        query_inject_partner_params = (
+        if self.hide_account_balance_at_0:
+            query_inject_partner += """
+AND
+    s.final_balance IS NOT NULL AND s.final_balance != 0
+            """
+        query_inject_partner_params += (
             self.env.uid,
-            self.general_ledger_id.id,
             self.id,
         )
         self.env.cr.execute(query_inject_partner, query_inject_partner_params)
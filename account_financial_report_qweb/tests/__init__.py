@@ -4,6 +4,7 @@
 
 from . import abstract_test
 from . import test_aged_partner_balance
+from . import test_benchmark
 from . import test_general_ledger
 from . import test_open_items
 from . import test_trial_balance
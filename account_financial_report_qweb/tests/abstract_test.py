@@ -153,6 +153,29 @@ class AbstractTest(TransactionCase):
                     partner_ids[0].name
                 )
 
+    def test_04_unlogged_storage(self):
+        """Check that the report data are stored in UNLOGGED tables"""
+        abstract_report = self.env['report_qweb_abstract']
+        abstract_report._register_hook()
+        tables = abstract_report._get_report_tables()
+        self.assertIn(self.model._table, tables)
+        self.env.cr.execute(
+            "SELECT relname FROM pg_class "
+            "WHERE relname IN %s AND relpersistence != 'u'",
+            (tuple(tables), ))
+        self.assertFalse(self.env.cr.fetchall())
+
+        self.report.compute_data_for_report()
+        self.assertGreaterEqual(len(self.report.account_ids), 1)
+
+        # logged again before the tables are updated
+        abstract_report._set_tables_unlogged(tables, unlogged=False)
+        self.env.cr.execute(
+            "SELECT relname FROM pg_class "
+            "WHERE relname IN %s AND relpersistence != 'p'",
+            (tuple(tables), ))
+        self.assertFalse(self.env.cr.fetchall())
+
     def _partner_test_is_possible(self, filters):
         """
             :return:
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+import os
+import time
+import unittest
+
+from odoo.tests.common import TransactionCase
+
+_logger = logging.getLogger(__name__)
+
+
+@unittest.skipUnless(os.environ.get('ACCOUNT_FINANCIAL_REPORT_BENCHMARK'),
+                     'set ACCOUNT_FINANCIAL_REPORT_BENCHMARK to the number '
+                     'of moves to generate to run the benchmark')
+class TestBenchmark(TransactionCase):
+    """ Time the computation of reports on a generated ledger.
+
+    The benchmark only runs when the ACCOUNT_FINANCIAL_REPORT_BENCHMARK
+    environment variable is set to the number of moves to generate.
+    Timings are logged, and the tests only check the consistency of
+    the results, so they remain reliable on slow machines.
+    """
+
+    MOVES = int(os.environ.get('ACCOUNT_FINANCIAL_REPORT_BENCHMARK') or 0)
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.company = self.env.ref('base.main_company')
+        receivable_account = self.env['account.account'].search([
+            ('user_type_id.name', '=', 'Receivable'),
+            ('company_id', '=', self.company.id),
+        ], limit=1)
+        income_account = self.env['account.account'].search([
+            ('user_type_id.name', '=', 'Income'),
+            ('company_id', '=', self.company.id),
+        ], limit=1)
+        journal = self.env['account.journal'].search([
+            ('code', '=', 'MISC'),
+            ('company_id', '=', self.company.id),
+        ], limit=1)
+        partners = self.env['res.partner'].search([], limit=10)
+        for i in range(self.MOVES):
+            amount = 10.0 * (i % 7 + 1)
+            move = self.env['account.move'].create({
+                'journal_id': journal.id,
+                'partner_id': partners[i % len(partners)].id,
+                # over the previous and the current years
+                'date': '%s-%02d-%02d' % (2015 + i % 2, i % 12 + 1,
+                                          i % 28 + 1),
+                'line_ids': [
+                    (0, 0, {
+                        'name': 'benchmark',
+                        'debit': amount,
+                        'account_id': receivable_account.id}),
+                    (0, 0, {
+                        'name': 'benchmark',
+                        'credit': amount,
+                        'account_id': income_account.id}),
+                ]})
+            move.post()
+
+    def _time(self, label, f):
+        start = time.time()
+        res = f()
+        _logger.info('%s: %.3fs', label, time.time() - start)
+        return res
+
+    def test_benchmark_general_ledger(self):
+        for with_line_details in (True, False):
+            general_ledger = self.env['report_general_ledger_qweb'].create({
+                'date_from': '2016-01-01',
+                'date_to': '2016-12-31',
+                'fy_start_date': '2016-01-01',
+                'company_id': self.company.id,
+            })
+            self._time(
+                'general ledger of %s moves (line details: %s)' %
+                (self.MOVES, with_line_details),
+                lambda: general_ledger.compute_data_for_report(
+                    with_line_details=with_line_details))
+            rows = general_ledger.account_ids
+            rows = list(rows) + list(rows.mapped('partner_ids'))
+            self.assertTrue(rows)
+            for row in rows:
+                move_lines = row.move_line_ids
+                if not move_lines:
+                    continue
+                # running balances go from the initial to the final balance
+                self.assertAlmostEqual(
+                    row.initial_balance + sum(move_lines.mapped('debit')) -
+                    sum(move_lines.mapped('credit')), row.final_balance, 2)
+                self.assertAlmostEqual(
+                    move_lines.sorted(
+                        lambda l: (l.date, l.move_line_id.id)
+                    )[-1].cumul_balance, row.final_balance, 2)
+
+    def test_benchmark_trial_balance(self):
+        filters = {
+            'date_from': '2016-01-01',
+            'date_to': '2016-12-31',
+            'fy_start_date': '2016-01-01',
+            'company_id': self.company.id,
+        }
+        trial_balance = self.env['report_trial_balance_qweb'].create(
+            dict(filters, show_partner_details=True))
+        self._time('trial balance of %s moves' % self.MOVES,
+                   trial_balance.compute_data_for_report)
+        # what the trial balance computed before, from a general ledger
+        general_ledger = self.env['report_general_ledger_qweb'].create(
+            filters)
+        self._time('general ledger sums of %s moves' % self.MOVES,
+                   lambda: general_ledger.compute_data_for_report(
+                       with_line_details=False))
+        self.assertEqual(
+            sorted((account.account_id.id, round(account.final_balance, 2))
+                   for account in trial_balance.account_ids),
+            sorted((account.account_id.id, round(account.final_balance, 2))
+                   for account in general_ledger.account_ids))
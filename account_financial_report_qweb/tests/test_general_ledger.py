@@ -82,12 +82,13 @@ class TestGeneralLedgerReport(TransactionCase):
         income_debit,
         income_credit,
         unaffected_debit=0,
-        unaffected_credit=0
+        unaffected_credit=0,
+        partner=None
     ):
         move_name = 'expense accrual'
         journal = self.env['account.journal'].search([
             ('code', '=', 'MISC')])
-        partner = self.env.ref('base.res_partner_12')
+        partner = partner or self.env.ref('base.res_partner_12')
         move_vals = {
             'journal_id': journal.id,
             'partner_id': partner.id,
@@ -395,3 +396,218 @@ class TestGeneralLedgerReport(TransactionCase):
         self.assertEqual(lines['unaffected'].final_debit, 1000)
         self.assertEqual(lines['unaffected'].final_credit, 3000)
         self.assertEqual(lines['unaffected'].final_balance, -3000)
+
+    def test_04_streamed_move_lines(self):
+        self._add_move(
+            date=self.fy_date_start,
+            receivable_debit=1000,
+            receivable_credit=0,
+            income_debit=0,
+            income_credit=1000
+        )
+        self._add_move(
+            date=self.fy_date_end,
+            receivable_debit=0,
+            receivable_credit=400,
+            income_debit=400,
+            income_credit=0
+        )
+        company = self.env.ref('base.main_company')
+        report_model = self.env['report_general_ledger_qweb']
+        for centralize in (False, True):
+            filters = {
+                'date_from': self.fy_date_start,
+                'date_to': self.fy_date_end,
+                'only_posted_moves': True,
+                'company_id': company.id,
+                'fy_start_date': self.fy_date_start,
+                'centralize': centralize,
+            }
+
+            # Move lines stored in the report tables
+            general_ledger = report_model.create(filters)
+            general_ledger.compute_data_for_report()
+            expected = []
+            for account in general_ledger.account_ids:
+                lines = account.move_line_ids
+                for partner in account.partner_ids:
+                    lines += partner.move_line_ids
+                for line in lines:
+                    expected.append((
+                        account.account_id.id,
+                        line.report_partner_id.partner_id.id,
+                        line.move_line_id.id,
+                        line.date,
+                        line.label or False,
+                        round(line.debit, 2),
+                        round(line.credit, 2),
+                        round(line.cumul_balance, 2),
+                    ))
+            self.assertTrue(expected)
+
+            # Same move lines, streamed, replacing the computed report
+            account_count = len(general_ledger.account_ids)
+            general_ledger._compute_data_for_xlsx_report()
+            self.assertEqual(len(general_ledger.account_ids), account_count)
+            self.assertFalse(general_ledger.account_ids.mapped(
+                'partner_ids.move_line_ids'))
+            report_account_model = self.env[
+                'report_general_ledger_qweb_account']
+            report_partner_model = self.env[
+                'report_general_ledger_qweb_partner']
+            streamed = []
+            for line in general_ledger._iter_move_lines():
+                account = report_account_model.browse(
+                    line['report_account_id'])
+                partner = report_partner_model.browse(
+                    line['report_partner_id'] or [])
+                streamed.append((
+                    account.account_id.id,
+                    partner.partner_id.id,
+                    line['move_line_id'] or False,
+                    line['date'],
+                    line['label'] or False,
+                    round(line['debit'] or 0.0, 2),
+                    round(line['credit'] or 0.0, 2),
+                    round(line['cumul_balance'] or 0.0, 2),
+                ))
+            self.assertEqual(streamed, expected)
+
+    def _get_sum_amounts(self, domain):
+        move_lines = self.env['account.move.line'].search(domain)
+        return (
+            sum(move_lines.mapped('debit')),
+            sum(move_lines.mapped('credit')),
+            sum(move_lines.mapped('balance')),
+        )
+
+    def test_05_window_balances(self):
+        # A partner with the same name as the partner of the other moves
+        partner = self.env.ref('base.res_partner_12')
+        homonym = self.env['res.partner'].create({'name': partner.name})
+        for date, amount, move_partner in (
+                (self.previous_fy_date_end, 1000, partner),
+                (self.previous_fy_date_end, 500, homonym),
+                (self.fy_date_start, -300, partner),
+                (self.fy_date_start, -200, homonym),
+                (self.fy_date_end, -100, partner),
+        ):
+            self._add_move(
+                date=date,
+                receivable_debit=max(amount, 0),
+                receivable_credit=max(-amount, 0),
+                income_debit=max(-amount, 0),
+                income_credit=max(amount, 0),
+                partner=move_partner
+            )
+        company = self.env.ref('base.main_company')
+        general_ledger = self.env['report_general_ledger_qweb'].create({
+            'date_from': self.fy_date_start,
+            'date_to': self.fy_date_end,
+            'only_posted_moves': True,
+            'company_id': company.id,
+            'fy_start_date': self.fy_date_start,
+        })
+        general_ledger.compute_data_for_report()
+
+        # Same sums and running balances as the journal items
+        for account in general_ledger.account_ids:
+            if account.account_id == self.unaffected_account:
+                continue
+            for row in [account] + list(account.partner_ids):
+                domain = [
+                    ('account_id', '=', account.account_id.id),
+                    ('move_id.state', '=', 'posted'),
+                ]
+                if row._name == 'report_general_ledger_qweb_partner':
+                    domain.append(('partner_id', '=', row.partner_id.id))
+                user_type = account.account_id.user_type_id
+                if not user_type.include_initial_balance:
+                    domain.append(('date', '>=', self.fy_date_start))
+                initial = self._get_sum_amounts(
+                    domain + [('date', '<', self.fy_date_start)])
+                final = self._get_sum_amounts(
+                    domain + [('date', '<=', self.fy_date_end)])
+                for value, expected in zip(
+                        (row.initial_debit, row.initial_credit,
+                         row.initial_balance, row.final_debit,
+                         row.final_credit, row.final_balance),
+                        initial + final):
+                    self.assertAlmostEqual(value, expected, 2)
+                balance = row.initial_balance
+                for line in row.move_line_ids.sorted(
+                        lambda l: (l.date, l.move_line_id.id)):
+                    balance += line.debit - line.credit
+                    self.assertAlmostEqual(line.cumul_balance, balance, 2)
+                if row.move_line_ids:
+                    self.assertAlmostEqual(balance, row.final_balance, 2)
+
+        # Partners with the same name have their own running balances
+        receivable = general_ledger.account_ids.filtered(
+            lambda a: a.account_id == self.receivable_account)
+        for move_partner, cumul_balances in ((partner, [700, 600]),
+                                             (homonym, [300])):
+            row = receivable.partner_ids.filtered(
+                lambda p: p.partner_id == move_partner)
+            self.assertEqual(
+                row.move_line_ids.mapped('cumul_balance'), cumul_balances)
+
+    def test_06_move_line_table(self):
+        self._add_move(
+            date=self.previous_fy_date_end,
+            receivable_debit=1000,
+            receivable_credit=0,
+            income_debit=0,
+            income_credit=1000
+        )
+        self._add_move(
+            date=self.fy_date_end,
+            receivable_debit=0,
+            receivable_credit=400,
+            income_debit=400,
+            income_credit=0
+        )
+        company = self.env.ref('base.main_company')
+        filters = {
+            'date_from': self.fy_date_start,
+            'date_to': self.fy_date_end,
+            'only_posted_moves': True,
+            'company_id': company.id,
+            'fy_start_date': self.fy_date_start,
+        }
+        report_model = self.env['report_general_ledger_qweb']
+        general_ledger = report_model.create(filters)
+        general_ledger.compute_data_for_report()
+        expected = [(
+            account.account_id.id,
+            round(account.initial_balance, 2),
+            round(account.final_balance, 2),
+        ) for account in general_ledger.account_ids
+            if account.account_id != self.unaffected_account]
+        self.assertTrue(expected)
+
+        # The temporary table of move lines is dropped
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_class WHERE relname = %s",
+            ('report_general_ledger_qweb_ml_%s' % general_ledger.id, ))
+        self.assertFalse(self.env.cr.fetchall())
+
+        # Same accounts, reading the move lines from subqueries
+        general_ledger = report_model.create(filters)
+        general_ledger._inject_account_values()
+        general_ledger.invalidate_cache()
+        self.assertEqual([(
+            account.account_id.id,
+            round(account.initial_balance, 2),
+            round(account.final_balance, 2),
+        ) for account in general_ledger.account_ids], expected)
+
+        # Same accounts, storing only sums of the move lines
+        general_ledger = report_model.create(filters)
+        general_ledger.compute_data_for_report(with_line_details=False)
+        self.assertEqual([(
+            account.account_id.id,
+            round(account.initial_balance, 2),
+            round(account.final_balance, 2),
+        ) for account in general_ledger.account_ids
+            if account.account_id != self.unaffected_account], expected)
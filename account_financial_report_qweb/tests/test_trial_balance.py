@@ -5,6 +5,7 @@
 
 import time
 from . import abstract_test
+from odoo.tests.common import TransactionCase
 
 
 class TestTrialBalance(abstract_test.AbstractTest):
@@ -52,3 +53,120 @@ class TestTrialBalance(abstract_test.AbstractTest):
 
     def _partner_test_is_possible(self, filters):
         return 'show_partner_details' in filters
+
+
+class TestTrialBalanceReport(TransactionCase):
+
+    def setUp(self):
+        super(TestTrialBalanceReport, self).setUp()
+        self.company = self.env.ref('base.main_company')
+        self.partner = self.env.ref('base.res_partner_12')
+        self.receivable_account = self.env['account.account'].search([
+            ('user_type_id.name', '=', 'Receivable')
+            ], limit=1)
+        self.income_account = self.env['account.account'].search([
+            ('user_type_id.name', '=', 'Income')
+            ], limit=1)
+        self.unaffected_account = self.env['account.account'].search([
+            (
+                'user_type_id',
+                '=',
+                self.env.ref('account.data_unaffected_earnings').id
+            )], limit=1)
+        journal = self.env['account.journal'].search([
+            ('code', '=', 'MISC')])
+        # before the fiscal year, before date_from and in the period
+        for date, amount, unaffected_amount, post in (
+                ('2015-12-31', 1000, 0, True),
+                ('2016-03-15', 300, 100, True),
+                ('2016-09-01', -200, 0, True),
+                ('2016-10-01', 50, 0, False),
+        ):
+            move = self.env['account.move'].create({
+                'journal_id': journal.id,
+                'partner_id': self.partner.id,
+                'date': date,
+                'line_ids': [
+                    (0, 0, {
+                        'name': 'trial balance',
+                        'debit': max(amount, 0),
+                        'credit': max(-amount, 0),
+                        'account_id': self.receivable_account.id}),
+                    (0, 0, {
+                        'name': 'trial balance',
+                        'debit': max(-amount + unaffected_amount, 0),
+                        'credit': max(amount - unaffected_amount, 0),
+                        'account_id': self.income_account.id}),
+                    (0, 0, {
+                        'name': 'trial balance',
+                        'debit': 0,
+                        'credit': unaffected_amount,
+                        'account_id': self.unaffected_account.id}),
+                ]})
+            if post:
+                move.post()
+
+    def _get_general_ledger_values(self, filters):
+        """ Trial balance values, from the sums of a general ledger """
+        general_ledger = self.env['report_general_ledger_qweb'].create(
+            filters)
+        general_ledger.compute_data_for_report(with_line_details=False)
+        values = {}
+        for account in general_ledger.account_ids:
+            values[account.account_id.id] = [
+                round(account.initial_balance, 2),
+                round(account.final_debit - account.initial_debit, 2),
+                round(account.final_credit - account.initial_credit, 2),
+                round(account.final_balance, 2),
+                sorted([
+                    partner.partner_id.id,
+                    round(partner.initial_balance, 2),
+                    round(partner.final_debit - partner.initial_debit, 2),
+                    round(partner.final_credit - partner.initial_credit, 2),
+                    round(partner.final_balance, 2),
+                ] for partner in account.partner_ids),
+            ]
+        return values
+
+    def _get_trial_balance_values(self, filters):
+        trial_balance = self.env['report_trial_balance_qweb'].create(
+            dict(filters, show_partner_details=True))
+        trial_balance.compute_data_for_report()
+        values = {}
+        for account in trial_balance.account_ids:
+            values[account.account_id.id] = [
+                round(account.initial_balance, 2),
+                round(account.debit, 2),
+                round(account.credit, 2),
+                round(account.final_balance, 2),
+                sorted([
+                    partner.partner_id.id,
+                    round(partner.initial_balance, 2),
+                    round(partner.debit, 2),
+                    round(partner.credit, 2),
+                    round(partner.final_balance, 2),
+                ] for partner in account.partner_ids),
+            ]
+        return values
+
+    def test_01_general_ledger_sums(self):
+        base_filters = {
+            'date_from': '2016-07-01',
+            'date_to': '2016-12-31',
+            'fy_start_date': '2016-01-01',
+            'company_id': self.company.id,
+        }
+        for filters in (
+                {},
+                {'only_posted_moves': True},
+                {'hide_account_balance_at_0': True},
+                {'filter_account_ids': [
+                    (6, 0, (self.receivable_account +
+                            self.unaffected_account).ids)]},
+                {'filter_partner_ids': [(6, 0, self.partner.ids)]},
+        ):
+            filters = dict(base_filters, **filters)
+            values = self._get_trial_balance_values(filters)
+            self.assertTrue(values)
+            self.assertEqual(values, self._get_general_ledger_values(filters))
+        self.assertIn(self.unaffected_account.id, values)
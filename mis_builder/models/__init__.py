@@ -6,3 +6,6 @@ from . import mis_report
 from . import mis_report_instance
 from . import mis_report_style
 from . import aep
+from . import account_account
+from . import account_move
+from . import res_company
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models, tools
+
+from .kpi_matrix_cache import signal_ledger_change
+
+
+class AccountAccount(models.Model):
+    _inherit = 'account.account'
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_mis_sorted_codes(self, company_id):
+        """ Return the codes of all accounts of a company in ascending
+        order, and their ids, as two tuples.
+
+        The result is cached until accounts are created, deleted,
+        or their code or company is modified.
+        """
+        self.env.cr.execute(
+            "SELECT code, id FROM account_account WHERE company_id = %s",
+            (company_id, ))
+        rows = sorted(self.env.cr.fetchall())
+        return tuple(r[0] for r in rows), tuple(r[1] for r in rows)
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        signal_ledger_change(self.env.cr)
+        return super(AccountAccount, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'code' in vals or 'company_id' in vals:
+            self.clear_caches()
+        # account codes, names and types are used by reports
+        signal_ledger_change(self.env.cr)
+        return super(AccountAccount, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        signal_ledger_change(self.env.cr)
+        return super(AccountAccount, self).unlink()
+
+
+class AccountAccountType(models.Model):
+    _inherit = 'account.account.type'
+
+    @api.multi
+    def write(self, vals):
+        if 'include_initial_balance' in vals or 'type' in vals:
+            signal_ledger_change(self.env.cr)
+        return super(AccountAccountType, self).write(vals)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+from .kpi_matrix_cache import signal_ledger_change
+
+# account.move.line fields which change the balances of reports
+LEDGER_FIELDS = {
+    'account_id',
+    'amount_currency',
+    'analytic_account_id',
+    'balance',
+    'company_id',
+    'credit',
+    'date',
+    'debit',
+    'move_id',
+    'partner_id',
+}
+
+
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    @api.multi
+    def write(self, vals):
+        if 'state' in vals or 'date' in vals:
+            signal_ledger_change(self.env.cr)
+        return super(AccountMove, self).write(vals)
+
+    @api.multi
+    def button_cancel(self):
+        # the state is reset to draft with a sql query
+        signal_ledger_change(self.env.cr)
+        return super(AccountMove, self).button_cancel()
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    @api.model
+    def create(self, vals):
+        signal_ledger_change(self.env.cr)
+        return super(AccountMoveLine, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if LEDGER_FIELDS.intersection(vals):
+            signal_ledger_change(self.env.cr)
+        return super(AccountMoveLine, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        signal_ledger_change(self.env.cr)
+        return super(AccountMoveLine, self).unlink()
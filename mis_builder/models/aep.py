@@ -2,12 +2,16 @@
 # © 2014-2015 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+from bisect import bisect_left
+import copy
+import datetime
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from itertools import izip
 
 from odoo import fields
 from odoo.models import expression
+from odoo.tools.lru import LRU
 from odoo.tools.safe_eval import safe_eval
 from odoo.tools.float_utils import float_is_zero
 from .accounting_none import AccountingNone
@@ -42,9 +46,15 @@ class AccountingExpressionProcessor(object):
           to notify the processor that it can prepare to query (mainly
           search all accounts - children, consolidation - that will need to
           be queried;
+        * optionally, call do_queries_multi() with all periods to query
+          the database once for all periods;
         * for each period, call do_queries(), then call replace_expr() for each
           expression to replace accounting variables with their resulting value
-          for the given period.
+          for the given period;
+        * alternatively, call substitute_vars() once per expression to obtain
+          an expression where accounting variables are replaced by python
+          names, which can be compiled once and evaluated for each period
+          in a context updated with get_vars_values() after do_queries().
 
     How it works:
         * by accumulating the expressions before hand, it ensures to do the
@@ -67,6 +77,16 @@ class AccountingExpressionProcessor(object):
                          r"(?P<accounts>_[a-zA-Z0-9]+|\[.*?\])"
                          r"(?P<domain>\[.*?\])?")
 
+    # python name of accounting variables in substituted expressions;
+    # it must not contain double underscores to be accepted by safe_eval
+    _VAR_NAME = '_aep_{}'
+
+    # {variable text: (field, mode, account_codes, domain)}
+    # shared by all processors, since parsing does not depend on the company
+    _parsed_vars = LRU(8192)
+    # parse cache counters, for profiling
+    parse_stats = {'hits': 0, 'misses': 0}
+
     def __init__(self, company):
         self.company = company
         self.dp = company.currency_id.decimal_places
@@ -83,36 +103,114 @@ class AccountingExpressionProcessor(object):
         # a first query to get the initial balance and another
         # to get the variation, so it's a bit slower
         self.smart_end = True
+        # {var_name: (field, mode, account_codes, domain)}
+        self._vars = {}
+        # {(field, mode, account_codes, domain): var_name}
+        self._var_names = {}
+        # {expr: (substituted_expr, var_names)}
+        self._substituted_exprs = {}
+        # account code lists of parsed variables
+        self._parsed_account_codes = set()
+        # {account_codes: frozenset(account_ids)}, after done_parsing
+        self._account_ids_by_codes = {}
+        # {(date_from, date_to, target_move, filter): _data},
+        # populated by do_queries_multi()
+        self._data_by_period = {}
+        # whether the user can read the account balance snapshot
+        # of the company, computed on first use
+        self._snapshot_readable = None
+
+    @staticmethod
+    def _like_re(account_code):
+        """ Return a regular expression equivalent to a like pattern """
+        return re.compile(''.join(
+            '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+            for c in account_code
+        ) + '$', re.DOTALL)
+
+    @classmethod
+    def _resolve_account_code(cls, codes, ids, account_code):
+        """ Return the ids of the accounts matching an account code,
+        given the codes of all accounts in ascending order and their ids.
+        """
+        if account_code is None:
+            # None means we want all accounts
+            return ids
+        prefix = account_code.rstrip('%')
+        if prefix == account_code:
+            # exact code, even if it contains _, as codes without %
+            # are not like patterns
+            def match(code):
+                return code == prefix
+        elif '%' in prefix or '_' in prefix:
+            # a like pattern with wildcards other than a trailing %
+            like_re = cls._like_re(account_code)
+            return [i for c, i in izip(codes, ids) if like_re.match(c)]
+        else:
+            def match(code):
+                return code.startswith(prefix)
+        res = []
+        n = bisect_left(codes, prefix)
+        while n < len(codes) and match(codes[n]):
+            res.append(ids[n])
+            n += 1
+        return res
+
+    def with_env(self, env):
+        """Return a copy of this processor using another environment
+        (for instance with a cursor of another thread), sharing the
+        parsed expressions and the data queried with do_queries_multi().
+
+        This method must be executed after done_parsing().
+        """
+        res = copy.copy(self)
+        res.company = self.company.with_env(env)
+        return res
+
+    def get_account_ids_index(self):
+        """Return the account ids matching the account codes of each
+        parsed variable, in a dictionary that references no environment.
+
+        Another processor of the same company can use it with
+        set_account_ids_index() to build move line domains without
+        parsing all expressions and resolving their account codes again.
+
+        This method must be executed after done_parsing().
+        """
+        return dict(self._account_ids_by_codes)
+
+    def set_account_ids_index(self, account_ids_index):
+        """Use account ids obtained with get_account_ids_index()"""
+        self._account_ids_by_codes.update(account_ids_index)
 
     def _load_account_codes(self, account_codes):
+        """ Resolve account codes to account ids, using the codes of all
+        accounts of the company, which are loaded once and cached. """
         account_model = self.company.env['account.account']
-        exact_codes = set()
+        codes, ids = account_model._get_mis_sorted_codes(self.company.id)
         for account_code in account_codes:
             if account_code in self._account_ids_by_code:
                 continue
-            if account_code is None:
-                # None means we want all accounts
-                account_ids = account_model.\
-                    search([('company_id', '=', self.company.id)]).ids
-                self._account_ids_by_code[account_code].update(account_ids)
-            elif '%' in account_code:
-                account_ids = account_model.\
-                    search([('code', '=like', account_code),
-                            ('company_id', '=', self.company.id)]).ids
-                self._account_ids_by_code[account_code].update(account_ids)
-            else:
-                # search exact codes after the loop to do less queries
-                exact_codes.add(account_code)
-        for account in account_model.\
-                search([('code', 'in', list(exact_codes)),
-                        ('company_id', '=', self.company.id)]):
-            self._account_ids_by_code[account.code].add(account.id)
+            self._account_ids_by_code[account_code].update(
+                self._resolve_account_code(codes, ids, account_code))
 
     def _parse_match_object(self, mo):
         """Split a match object corresponding to an accounting variable
 
-        Returns field, mode, [account codes], (domain expression).
+        Returns field, mode, (account codes), (domain expression).
+
+        The result is cached by variable text, so each variable is
+        parsed once for all expressions, periods and processors.
         """
+        var = mo.group(0)
+        try:
+            res = self._parsed_vars[var]
+        except KeyError:
+            pass
+        else:
+            self.parse_stats['hits'] += 1
+            return res
+        self.parse_stats['misses'] += 1
         field, mode, account_codes, domain = mo.groups()
         if not mode:
             mode = self.MODE_VARIATION
@@ -123,12 +221,14 @@ class AccountingExpressionProcessor(object):
         else:
             account_codes = account_codes[1:-1]
         if account_codes.strip():
-            account_codes = [a.strip() for a in account_codes.split(',')]
+            account_codes = tuple(a.strip() for a in account_codes.split(','))
         else:
-            account_codes = [None]  # None means we want all accounts
+            account_codes = (None, )  # None means we want all accounts
         domain = domain or '[]'
         domain = tuple(safe_eval(domain))
-        return field, mode, account_codes, domain
+        res = (field, mode, account_codes, domain)
+        self._parsed_vars[var] = res
+        return res
 
     def parse_expr(self, expr):
         """Parse an expression, extracting accounting variables.
@@ -139,6 +239,7 @@ class AccountingExpressionProcessor(object):
         """
         for mo in self._ACC_RE.finditer(expr):
             _, mode, account_codes, domain = self._parse_match_object(mo)
+            self._parsed_account_codes.add(account_codes)
             if mode == self.MODE_END and self.smart_end:
                 modes = (self.MODE_INITIAL, self.MODE_VARIATION, self.MODE_END)
             else:
@@ -150,14 +251,18 @@ class AccountingExpressionProcessor(object):
     def done_parsing(self):
         """Load account codes and replace account codes by
         account ids in map."""
+        all_account_codes = set()
+        for account_codes in self._map_account_ids.values():
+            all_account_codes.update(account_codes)
+        self._load_account_codes(all_account_codes)
         for key, account_codes in self._map_account_ids.items():
-            # TODO _load_account_codes could be done
-            # for all account_codes at once (also in v8)
-            self._load_account_codes(account_codes)
             account_ids = set()
             for account_code in account_codes:
                 account_ids.update(self._account_ids_by_code[account_code])
             self._map_account_ids[key] = list(account_ids)
+        # index the accounts of each parsed variable
+        for account_codes in self._parsed_account_codes:
+            self._get_account_ids_for_codes(account_codes)
 
     @classmethod
     def has_account_var(cls, expr):
@@ -179,9 +284,7 @@ class AccountingExpressionProcessor(object):
         for mo in self._ACC_RE.finditer(expr):
             field, mode, account_codes, domain = self._parse_match_object(mo)
             aml_domain = list(domain)
-            account_ids = set()
-            for account_code in account_codes:
-                account_ids.update(self._account_ids_by_code[account_code])
+            account_ids = self._get_account_ids_for_codes(account_codes)
             if not account_id:
                 aml_domain.append(('account_id', 'in', tuple(account_ids)))
             else:
@@ -234,13 +337,103 @@ class AccountingExpressionProcessor(object):
             domain.append(('move_id.state', '=', 'posted'))
         return expression.normalize_domain(domain)
 
+    @staticmethod
+    def _get_data_key(date_from, date_to, target_move,
+                      additional_move_line_filter):
+        return (date_from, date_to, target_move,
+                repr(additional_move_line_filter or []))
+
+    def _compute_ends(self, data, ends):
+        """ Compute ending balances by summing initial and variation """
+        for key in ends:
+            domain, mode = key
+            initial_data = data[(domain, self.MODE_INITIAL)]
+            variation_data = data[(domain, self.MODE_VARIATION)]
+            account_ids = set(initial_data.keys()) | set(variation_data.keys())
+            for account_id in account_ids:
+                di, ci = initial_data.get(account_id,
+                                          (AccountingNone, AccountingNone))
+                dv, cv = variation_data.get(account_id,
+                                            (AccountingNone, AccountingNone))
+                data[key][account_id] = (di + dv, ci + cv)
+
+    def _use_snapshot(self, domain, additional_move_line_filter):
+        """ Whether initial and ending balances can be obtained from
+        the account balance snapshot, when it is installed and the record
+        rules of journal items only restrict the company of the user. """
+        if domain or additional_move_line_filter or \
+                'account.balance.snapshot' not in self.company.env or \
+                not self.company.balance_snapshot_date:
+            return False
+        if self._snapshot_readable is None:
+            # the snapshot sums do not apply the record rules
+            # of journal items
+            self._snapshot_readable = self.company.env[
+                'account.balance.snapshot']._can_read_company(self.company)
+        return self._snapshot_readable
+
+    def _query_snapshot(self, mode, date_from, date_to, target_move,
+                        account_ids):
+        """ Query sums of debit and credit by account for the initial,
+        ending or unallocated balance mode, using the account balance
+        snapshot to avoid reading the whole history of move lines. """
+        res = {}
+        if not account_ids:
+            return res
+        snapshot_model = self.company.env['account.balance.snapshot']
+        fy_date_from = fields.Date.to_string(
+            self.company.compute_fiscalyear_dates(
+                fields.Date.from_string(date_from))['date_from'])
+        if mode == self.MODE_END:
+            date_until = fields.Date.to_string(
+                fields.Date.from_string(date_to) + datetime.timedelta(1))
+        else:
+            date_until = date_from
+        # (include_initial_balance, date_from, date_to excluded)
+        if mode == self.MODE_UNALLOCATED:
+            ranges = [(False, None, fy_date_from)]
+        else:
+            ranges = [(True, None, date_until),
+                      (False, fy_date_from, date_until)]
+        cr = self.company.env.cr
+        for include_initial_balance, range_from, range_to in ranges:
+            subquery, params = snapshot_model._get_move_line_subquery(
+                self.company, range_from, range_to, target_move == 'posted')
+            cr.execute("""
+                SELECT ml.account_id, SUM(ml.debit), SUM(ml.credit)
+                FROM (""" + subquery + """) ml
+                INNER JOIN account_account a ON a.id = ml.account_id
+                INNER JOIN account_account_type at ON at.id = a.user_type_id
+                WHERE ml.account_id IN %s
+                AND at.include_initial_balance = %s
+                GROUP BY ml.account_id
+            """, params + (tuple(account_ids), include_initial_balance))
+            for account_id, debit, credit in cr.fetchall():
+                debit = debit or 0.0
+                credit = credit or 0.0
+                if mode in (self.MODE_INITIAL, self.MODE_UNALLOCATED) and \
+                        float_is_zero(debit-credit,
+                                      precision_rounding=self.dp):
+                    # in initial mode, ignore accounts with 0 balance
+                    continue
+                res[account_id] = (debit, credit)
+        return res
+
     def do_queries(self, date_from, date_to,
                    target_move='posted', additional_move_line_filter=None):
         """Query sums of debit and credit for all accounts and domains
         used in expressions.
 
+        If the period has been queried with do_queries_multi(),
+        the prefetched data is used and the database is not queried.
+
         This method must be executed after done_parsing().
         """
+        data_key = self._get_data_key(date_from, date_to, target_move,
+                                      additional_move_line_filter)
+        if data_key in self._data_by_period:
+            self._data = self._data_by_period[data_key]
+            return
         aml_model = self.company.env['account.move.line']
         # {(domain, mode): {account_id: (debit, credit)}}
         self._data = defaultdict(dict)
@@ -252,6 +445,12 @@ class AccountingExpressionProcessor(object):
                 # postpone computation of ending balance
                 ends.append((domain, mode))
                 continue
+            if mode != self.MODE_VARIATION and \
+                    self._use_snapshot(domain, additional_move_line_filter):
+                self._data[key] = self._query_snapshot(
+                    mode, date_from, date_to, target_move,
+                    self._map_account_ids[key])
+                continue
             if mode not in domain_by_mode:
                 domain_by_mode[mode] = \
                     self.get_aml_domain_for_dates(date_from, date_to,
@@ -273,18 +472,213 @@ class AccountingExpressionProcessor(object):
                     # in initial mode, ignore accounts with 0 balance
                     continue
                 self._data[key][acc['account_id'][0]] = (debit, credit)
-        # compute ending balances by summing initial and variation
-        for key in ends:
+        self._compute_ends(self._data, ends)
+
+    def do_queries_multi(self, periods, target_move='posted'):
+        """Query sums of debit and credit for all accounts and domains
+        used in expressions, for several periods at once.
+
+        :param periods: a list of (date_from, date_to,
+                        additional_move_line_filter) tuples
+
+        For each domain used in expressions, and each distinct additional
+        move line filter, one query computes the sums for all modes and
+        periods at once, using conditional aggregation on dates.
+        The result is kept by period, so subsequent calls to do_queries()
+        for these periods do not query the database.
+
+        This method must be executed after done_parsing().
+        """
+        # {filter_key: (additional_move_line_filter, [(date_from, date_to)])}
+        periods_by_filter = OrderedDict()
+        for date_from, date_to, additional_move_line_filter in periods:
+            data_key = self._get_data_key(date_from, date_to, target_move,
+                                          additional_move_line_filter)
+            if data_key in self._data_by_period:
+                continue
+            filter_key = data_key[-1]
+            if filter_key not in periods_by_filter:
+                periods_by_filter[filter_key] = \
+                    (additional_move_line_filter, [])
+            date_ranges = periods_by_filter[filter_key][1]
+            if (date_from, date_to) not in date_ranges:
+                date_ranges.append((date_from, date_to))
+        for additional_move_line_filter, date_ranges in \
+                periods_by_filter.values():
+            self._do_queries_multi(date_ranges, target_move,
+                                   additional_move_line_filter)
+
+    def _do_queries_multi(self, date_ranges, target_move,
+                          additional_move_line_filter):
+        aml_model = self.company.env['account.move.line']
+        table = '"%s"' % aml_model._table
+        # {(mode, date_range index): (sql condition, params)}
+        conditions = {}
+        keys_by_domain = defaultdict(list)
+        ends = []
+        snapshot_keys = []
+        for key in self._map_account_ids:
             domain, mode = key
-            initial_data = self._data[(domain, self.MODE_INITIAL)]
-            variation_data = self._data[(domain, self.MODE_VARIATION)]
-            account_ids = set(initial_data.keys()) | set(variation_data.keys())
-            for account_id in account_ids:
-                di, ci = initial_data.get(account_id,
-                                          (AccountingNone, AccountingNone))
-                dv, cv = variation_data.get(account_id,
+            if mode == self.MODE_END and self.smart_end:
+                # postpone computation of ending balance
+                ends.append(key)
+                continue
+            if mode != self.MODE_VARIATION and \
+                    self._use_snapshot(domain, additional_move_line_filter):
+                snapshot_keys.append(key)
+                continue
+            keys_by_domain[domain].append(key)
+            for i, (date_from, date_to) in enumerate(date_ranges):
+                if (mode, i) in conditions:
+                    continue
+                # target_move is applied once for all periods below
+                date_domain = self.get_aml_domain_for_dates(
+                    date_from, date_to, mode, 'all')
+                from_clause, where_clause, where_params = \
+                    aml_model._where_calc(date_domain).get_sql()
+                if from_clause != table:
+                    # the date domain needs joins (it has been customized),
+                    # so it can not be used as a condition: query by period
+                    for date_from, date_to in date_ranges:
+                        self.do_queries(date_from, date_to, target_move,
+                                        additional_move_line_filter)
+                        self._data_by_period[self._get_data_key(
+                            date_from, date_to, target_move,
+                            additional_move_line_filter)] = self._data
+                    return
+                conditions[(mode, i)] = \
+                    (where_clause or 'TRUE', where_params)
+        # {date_range index: {(domain, mode): {account_id: (debit, credit)}}}
+        datas = [defaultdict(dict) for _ in date_ranges]
+        for key in snapshot_keys:
+            for (date_from, date_to), data in izip(date_ranges, datas):
+                data[key] = self._query_snapshot(
+                    key[1], date_from, date_to, target_move,
+                    self._map_account_ids[key])
+        account_ids_by_key = {key: set(self._map_account_ids[key])
+                              for key in self._map_account_ids}
+        for domain, keys in keys_by_domain.items():
+            account_ids = set()
+            for key in keys:
+                account_ids.update(self._map_account_ids[key])
+            domain = list(domain)
+            domain.append(('account_id', 'in', list(account_ids)))
+            if target_move == 'posted':
+                domain.append(('move_id.state', '=', 'posted'))
+            if additional_move_line_filter:
+                domain.extend(additional_move_line_filter)
+            query = aml_model._where_calc(domain)
+            aml_model._apply_ir_rules(query, 'read')
+            from_clause, where_clause, where_params = query.get_sql()
+            # a pair of conditional sums for each mode and period
+            columns = []
+            select_sql = []
+            select_params = []
+            any_sql = []
+            any_params = []
+            for key in keys:
+                mode = key[1]
+                for i in range(len(date_ranges)):
+                    condition, condition_params = conditions[(mode, i)]
+                    columns.append((key, i))
+                    select_sql.append(
+                        "SUM(CASE WHEN {c} THEN {t}.debit END), "
+                        "SUM(CASE WHEN {c} THEN {t}.credit END)".
+                        format(c=condition, t=table))
+                    select_params.extend(condition_params)
+                    select_params.extend(condition_params)
+                    any_sql.append(condition)
+                    any_params.extend(condition_params)
+            sql = "SELECT {t}.account_id, {select} " \
+                  "FROM {from_clause} " \
+                  "WHERE {where} AND ({any}) " \
+                  "GROUP BY {t}.account_id".format(
+                      t=table,
+                      select=', '.join(select_sql),
+                      from_clause=from_clause,
+                      where=where_clause or 'TRUE',
+                      any=' OR '.join(any_sql))
+            aml_model.env.cr.execute(
+                sql, select_params + where_params + any_params)
+            for row in aml_model.env.cr.fetchall():
+                account_id = row[0]
+                for j, (key, i) in enumerate(columns):
+                    debit, credit = row[1 + 2 * j], row[2 + 2 * j]
+                    if debit is None:
+                        # no move line for this mode and period
+                        continue
+                    if account_id not in account_ids_by_key[key]:
+                        continue
+                    if key[1] in (self.MODE_INITIAL,
+                                  self.MODE_UNALLOCATED) and \
+                            float_is_zero(debit-credit,
+                                          precision_rounding=self.dp):
+                        # in initial mode, ignore accounts with 0 balance
+                        continue
+                    datas[i][key][account_id] = (debit, credit)
+        for (date_from, date_to), data in izip(date_ranges, datas):
+            self._compute_ends(data, ends)
+            self._data_by_period[self._get_data_key(
+                date_from, date_to, target_move,
+                additional_move_line_filter)] = data
+
+    def _get_account_ids_for_codes(self, account_codes):
+        """Return the set of account ids matching a list of account codes.
+
+        This method must be executed after done_parsing()
+        or set_account_ids_index().
+        """
+        account_codes = tuple(account_codes)
+        try:
+            return self._account_ids_by_codes[account_codes]
+        except KeyError:
+            pass
+        self._load_account_codes(account_codes)
+        account_ids = set()
+        for account_code in account_codes:
+            account_ids.update(self._account_ids_by_code[account_code])
+        account_ids = frozenset(account_ids)
+        self._account_ids_by_codes[account_codes] = account_ids
+        return account_ids
+
+    def _get_field_value(self, field, mode, debit, credit):
+        if field == 'bal':
+            v = debit - credit
+        elif field == 'deb':
+            v = debit
+        elif field == 'crd':
+            v = credit
+        # in initial balance mode, assume 0 is None
+        # as it does not make sense to distinguish 0 from "no data"
+        if v is not AccountingNone and \
+                mode in (self.MODE_INITIAL, self.MODE_UNALLOCATED) and \
+                float_is_zero(v, precision_rounding=self.dp):
+            v = AccountingNone
+        return v
+
+    def _get_var_value(self, field, mode, account_codes, domain,
+                       account_id=None):
+        """Compute the value of an accounting variable for the current
+        period, for all its accounts or for a single account_id.
+
+        This method must be executed after do_queries().
+        """
+        account_ids_data = self._data[(domain, mode)]
+        if account_id is None:
+            debit = credit = AccountingNone
+            for account_id in self._get_account_ids_for_codes(account_codes):
+                d, c = account_ids_data.get(account_id,
                                             (AccountingNone, AccountingNone))
-                self._data[key][account_id] = (di + dv, ci + cv)
+                debit += d
+                credit += c
+        elif account_id in self._get_account_ids_for_codes(account_codes):
+            debit, credit = \
+                account_ids_data.get(account_id,
+                                     (AccountingNone, AccountingNone))
+        else:
+            # the account is not involved in this variable
+            return AccountingNone
+        return self._get_field_value(field, mode, debit, credit)
 
     def replace_expr(self, expr):
         """Replace accounting variables in an expression by their amount.
@@ -295,27 +689,7 @@ class AccountingExpressionProcessor(object):
         """
         def f(mo):
             field, mode, account_codes, domain = self._parse_match_object(mo)
-            key = (domain, mode)
-            account_ids_data = self._data[key]
-            v = AccountingNone
-            for account_code in account_codes:
-                account_ids = self._account_ids_by_code[account_code]
-                for account_id in account_ids:
-                    debit, credit = \
-                        account_ids_data.get(account_id,
-                                             (AccountingNone, AccountingNone))
-                    if field == 'bal':
-                        v += debit - credit
-                    elif field == 'deb':
-                        v += debit
-                    elif field == 'crd':
-                        v += credit
-            # in initial balance mode, assume 0 is None
-            # as it does not make sense to distinguish 0 from "no data"
-            if v is not AccountingNone and \
-                    mode in (self.MODE_INITIAL, self.MODE_UNALLOCATED) and \
-                    float_is_zero(v, precision_rounding=self.dp):
-                v = AccountingNone
+            v = self._get_var_value(field, mode, account_codes, domain)
             return '(' + repr(v) + ')'
 
         return self._ACC_RE.sub(f, expr)
@@ -330,23 +704,8 @@ class AccountingExpressionProcessor(object):
         """
         def f(mo):
             field, mode, account_codes, domain = self._parse_match_object(mo)
-            key = (domain, mode)
-            account_ids_data = self._data[key]
-            debit, credit = \
-                account_ids_data.get(account_id,
-                                     (AccountingNone, AccountingNone))
-            if field == 'bal':
-                v = debit - credit
-            elif field == 'deb':
-                v = debit
-            elif field == 'crd':
-                v = credit
-            # in initial balance mode, assume 0 is None
-            # as it does not make sense to distinguish 0 from "no data"
-            if v is not AccountingNone and \
-                    mode in (self.MODE_INITIAL, self.MODE_UNALLOCATED) and \
-                    float_is_zero(v, precision_rounding=self.dp):
-                v = AccountingNone
+            v = self._get_var_value(field, mode, account_codes, domain,
+                                    account_id)
             return '(' + repr(v) + ')'
 
         account_ids = set()
@@ -354,16 +713,95 @@ class AccountingExpressionProcessor(object):
             for mo in self._ACC_RE.finditer(expr):
                 field, mode, account_codes, domain = \
                     self._parse_match_object(mo)
-                key = (domain, mode)
-                account_ids_data = self._data[key]
-                for account_code in account_codes:
-                    for account_id in self._account_ids_by_code[account_code]:
-                        if account_id in account_ids_data:
-                            account_ids.add(account_id)
+                account_ids.update(
+                    self._get_account_ids_for_codes(account_codes).
+                    intersection(self._data[(domain, mode)]))
 
         for account_id in account_ids:
             yield account_id, [self._ACC_RE.sub(f, expr) for expr in exprs]
 
+    def substitute_vars(self, expr):
+        """Replace accounting variables in an expression by python names.
+
+        Returns a tuple (substituted expression, list of variable names).
+        The same accounting variable always gets the same name, and the
+        result is cached, so the substituted expression does not depend on
+        the period and can be compiled once and evaluated for all periods.
+
+        Use get_vars_values() after do_queries() to obtain the values
+        of the variables for a period.
+        """
+        try:
+            return self._substituted_exprs[expr]
+        except KeyError:
+            pass
+        var_names = []
+
+        def f(mo):
+            field, mode, account_codes, domain = self._parse_match_object(mo)
+            var = (field, mode, account_codes, domain)
+            var_name = self._var_names.get(var)
+            if var_name is None:
+                var_name = self._VAR_NAME.format(len(self._vars))
+                self._vars[var_name] = var
+                self._var_names[var] = var_name
+            if var_name not in var_names:
+                var_names.append(var_name)
+            return var_name
+
+        res = (self._ACC_RE.sub(f, expr), var_names)
+        self._substituted_exprs[expr] = res
+        return res
+
+    def get_vars_values(self):
+        """Compute the values of all accounting variables
+        obtained with substitute_vars() so far.
+
+        Returns a dictionary {var_name: value}.
+
+        This method must be executed after do_queries().
+        """
+        return {var_name: self._get_var_value(*var)
+                for var_name, var in self._vars.items()}
+
+    def iter_vars_values_by_account_id(self, var_names):
+        """Compute the values of accounting variables,
+        iterating by accounts involved in the variables.
+
+        yields account_id, {var_name: value}
+
+        Values are looked up directly in the queried data, using the
+        accounts of each variable resolved once after done_parsing().
+        Variables not involving an account are AccountingNone for it.
+
+        This method must be executed after do_queries().
+        """
+        account_ids = set()
+        # [(var_name, field, mode, {account_id: (debit, credit)},
+        #   account ids of the variable)]
+        vars_data = []
+        for var_name in var_names:
+            field, mode, account_codes, domain = self._vars[var_name]
+            account_ids_data = self._data[(domain, mode)]
+            var_account_ids = self._get_account_ids_for_codes(account_codes)
+            account_ids.update(
+                var_account_ids.intersection(account_ids_data))
+            vars_data.append((var_name, field, mode,
+                              account_ids_data, var_account_ids))
+
+        for account_id in account_ids:
+            vars_values = {}
+            for var_name, field, mode, account_ids_data, var_account_ids in \
+                    vars_data:
+                if account_id in var_account_ids:
+                    debit, credit = account_ids_data.get(
+                        account_id, (AccountingNone, AccountingNone))
+                    vars_values[var_name] = \
+                        self._get_field_value(field, mode, debit, credit)
+                else:
+                    vars_values[var_name] = AccountingNone
+            yield account_id, vars_values
+
     @classmethod
     def _get_balances(cls, mode, company, date_from, date_to,
                       target_move='posted'):
@@ -3,13 +3,29 @@
 # © 2016 Akretion (<http://akretion.com>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import sys
+import traceback
+
 
 class DataError(Exception):
 
-    def __init__(self, name, msg):
+    def __init__(self, name, msg=None):
         self.name = name
         self.msg = msg
 
+    @classmethod
+    def from_exc(cls, name):
+        """ Create a DataError for the exception being handled.
+
+        Its message is the type and value of the exception. The traceback
+        is neither formatted nor kept: it would keep the frames of the
+        evaluation and their locals alive as long as the error is part
+        of a computed (and possibly cached) matrix.
+        """
+        exc_type, exc_value = sys.exc_info()[:2]
+        return cls(name, ''.join(
+            traceback.format_exception_only(exc_type, exc_value)))
+
 
 class NameDataError(DataError):
     pass
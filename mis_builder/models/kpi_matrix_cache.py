@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import copy
+import threading
+
+from odoo.sql_db import db_connect
+from odoo.tools import config
+from odoo.tools.lru import LRU
+
+LEDGER_VERSION_TABLE = 'mis_builder_ledger_version'
+
+
+class KpiMatrixCache(object):
+    """ A size-bounded cache of KpiMatrix.as_dict() results,
+    or of other computation results.
+
+    Keys must contain everything a result depends on, including the
+    ledger version stamp, so entries are never invalidated explicitly:
+    outdated entries are not found anymore, and the least recently used
+    ones are evicted when the cache is full.
+
+    Hits and misses are counted, for monitoring purposes.
+
+    Results are copied when they are stored and retrieved, unless
+    copy_results is False, for results that are never modified.
+    """
+
+    def __init__(self, size=256, copy_results=True):
+        self._lru = LRU(size)
+        self._lock = threading.Lock()
+        self._copy = copy_results
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return a copy of the result cached for key, or None """
+        try:
+            res = self._lru[key]
+        except KeyError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        if self._copy:
+            res = copy.deepcopy(res)
+        return res
+
+    def set(self, key, res):
+        if self._copy:
+            res = copy.deepcopy(res)
+        self._lru[key] = res
+
+    def clear(self):
+        self._lru.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._lru),
+        }
+
+
+kpi_matrix_cache = KpiMatrixCache(
+    int(config.get('mis_builder_cache_size', 256)))
+
+# partial results of periods of report instances, see
+# MisReport._get_period_partial()
+period_cache = KpiMatrixCache(
+    int(config.get('mis_builder_period_cache_size', 1024)),
+    copy_results=False)
+
+# accounts resolved by the processors of reports, see
+# MisReportInstance._get_drilldown_aep()
+drilldown_cache = KpiMatrixCache(
+    int(config.get('mis_builder_drilldown_cache_size', 64)),
+    copy_results=False)
+
+
+def create_ledger_version(cr):
+    """ Create the table holding the ledger version stamp """
+    cr.execute("SELECT relkind FROM pg_class WHERE relname = %s",
+               (LEDGER_VERSION_TABLE, ))
+    row = cr.fetchone()
+    if row and row[0] == 'r':
+        return
+    if row:
+        # the stamp was a sequence, which was not read from the snapshot
+        # of the transaction
+        cr.execute("DROP SEQUENCE " + LEDGER_VERSION_TABLE)
+    cr.execute("CREATE TABLE " + LEDGER_VERSION_TABLE + " ("
+               "id serial PRIMARY KEY, "
+               "weight bigint NOT NULL DEFAULT 1)")
+
+
+def get_ledger_version(cr):
+    """ Return the ledger version stamp
+
+    The stamp is the number of committed transactions which changed
+    the ledger, as seen by the current transaction. It is read from
+    the same snapshot as the journal items, so results are never
+    stored under a stamp which does not match their data.
+    """
+    cr.execute("SELECT COALESCE(SUM(weight), 0) FROM " +
+               LEDGER_VERSION_TABLE)
+    return cr.fetchone()[0]
+
+
+def compact_ledger_version(cr):
+    """ Replace the rows of the ledger version table by one row of the
+    same total weight, so the stamp remains quick to read. """
+    cr.execute("""
+        WITH deleted AS (
+            DELETE FROM """ + LEDGER_VERSION_TABLE + """ RETURNING weight
+        )
+        INSERT INTO """ + LEDGER_VERSION_TABLE + """ (weight)
+        SELECT SUM(weight) FROM deleted HAVING COUNT(*) > 0
+    """)
+
+
+def is_ledger_changed(cr):
+    """ Whether the current transaction changed journal items,
+    accounts or companies """
+    return getattr(cr, '_mis_ledger_changed', False)
+
+
+def signal_ledger_change(cr):
+    """ Change the ledger version stamp when the current transaction
+    is committed.
+
+    Each transaction inserts its own row, once, so concurrent
+    transactions changing the ledger do not wait for each other.
+    """
+    if is_ledger_changed(cr):
+        return
+    cr._mis_ledger_changed = True
+    cr.execute("INSERT INTO " + LEDGER_VERSION_TABLE +
+               " DEFAULT VALUES RETURNING id")
+    row_id = cr.fetchone()[0]
+
+    def committed():
+        cr._mis_ledger_changed = False
+        cr.execute("SELECT 1 FROM " + LEDGER_VERSION_TABLE +
+                   " WHERE id = %s", (row_id, ))
+        if cr.fetchone():
+            return
+        # the row was rolled back to a savepoint, but not necessarily
+        # the changes made after it
+        with db_connect(cr.dbname).cursor() as new_cr:
+            new_cr.execute("INSERT INTO " + LEDGER_VERSION_TABLE +
+                           " DEFAULT VALUES")
+
+    def rolled_back():
+        cr._mis_ledger_changed = False
+
+    cr.after('commit', committed)
+    cr.after('rollback', rolled_back)
@@ -2,9 +2,11 @@
 # © 2014-2016 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import ast
 from collections import defaultdict, OrderedDict
 import datetime
 import dateutil
+import heapq
 from itertools import izip
 import logging
 import re
@@ -14,6 +16,7 @@ import pytz
 
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
+from odoo.tools.lru import LRU
 from odoo.tools.safe_eval import safe_eval
 
 from .aep import AccountingExpressionProcessor as AEP
@@ -22,7 +25,7 @@ from .accounting_none import AccountingNone
 from .simple_array import SimpleArray
 from .mis_safe_eval import mis_safe_eval, DataError, NameDataError
 from .mis_report_style import (
-    TYPE_NUM, TYPE_PCT, TYPE_STR, CMP_DIFF, CMP_PCT, CMP_NONE
+    TYPE_NUM, TYPE_PCT, TYPE_STR, CMP_DIFF, CMP_PCT, CMP_NONE, StyleRegistry
 )
 
 _logger = logging.getLogger(__name__)
@@ -35,6 +38,21 @@ class AutoStruct(object):
             setattr(self, k, v)
 
 
+class ChainedDict(dict):
+    """ A dictionary that looks up missing keys in a base dictionary.
+
+    It is used as evaluation context to override a few variables
+    of a large locals dictionary without copying it.
+    """
+
+    def __init__(self, base, *args, **kwargs):
+        super(ChainedDict, self).__init__(*args, **kwargs)
+        self._base = base
+
+    def __missing__(self, key):
+        return self._base[key]
+
+
 class KpiMatrixRow(object):
 
     # TODO: ultimately, the kpi matrix will become ignorant of KPI's and
@@ -42,20 +60,21 @@ class KpiMatrixRow(object):
     #       It is already ignorant of period and only knowns about columns.
     #       This will require a correct abstraction for expanding row details.
 
+    __slots__ = ('_matrix', 'kpi', 'account_id', 'description',
+                 'parent_row', 'style_props')
+
     def __init__(self, matrix, kpi, account_id=None, parent_row=None):
         self._matrix = matrix
-        self.kpi = kpi
+        self.kpi = matrix._get_kpi_snapshot(kpi)
         self.account_id = account_id
         self.description = ''
         self.parent_row = parent_row
         if not self.account_id:
-            self.style_props = self._matrix._style_model.merge([
-                self.kpi.report_id.style_id,
-                self.kpi.style_id])
+            style_props = self.kpi.style_props
         else:
-            self.style_props = self._matrix._style_model.merge([
-                self.kpi.report_id.style_id,
-                self.kpi.auto_expand_accounts_style_id])
+            style_props = self.kpi.auto_expand_accounts_style_props
+        # detail rows of a kpi share their style
+        self.style_props = self._matrix.style_registry.intern(style_props)
 
     @property
     def label(self):
@@ -85,8 +104,20 @@ class KpiMatrixRow(object):
 
 
 class KpiMatrixCol(object):
+    """ A column of a KpiMatrix.
+
+    Cells are not stored as objects: each sub column has one array of
+    values, one of rendered values, one of style properties and one of
+    drilldown arguments, where the values of a row are at the position of
+    the row in the column. Cells are built from these arrays when they are
+    read, and store their rendered value back in its array.
+    """
 
-    def __init__(self, label, description, locals_dict, subkpis):
+    __slots__ = ('label', 'description', 'locals_dict', 'colspan',
+                 'subkpis', '_subcols', '_cell_class', '_rows', '_row_index')
+
+    def __init__(self, label, description, locals_dict, subkpis,
+                 cell_class=None):
         self.label = label
         self.description = description
         self.locals_dict = locals_dict
@@ -100,46 +131,105 @@ class KpiMatrixCol(object):
             for i, subkpi in enumerate(subkpis):
                 subcol = KpiMatrixSubCol(self, subkpi.description, '', i)
                 self._subcols.append(subcol)
-        self._cell_tuples_by_row = {}  # {row: (cells tuple)}
-
-    def _set_cell_tuple(self, row, cell_tuple):
-        self._cell_tuples_by_row[row] = cell_tuple
+        self._cell_class = cell_class or KpiMatrixCell
+        self._rows = []  # rows having values, in the order of the arrays
+        self._row_index = {}  # {row: position in the arrays}
+
+    def _set_values(self, row, vals, styles_props, drilldown_args):
+        """ Store the values of a row, with their style properties and
+        drilldown arguments, one for each sub column. """
+        i = self._row_index.get(row)
+        if i is None:
+            self._row_index[row] = len(self._rows)
+            self._rows.append(row)
+            for subcol, val, style_props, drilldown_arg in izip(
+                    self._subcols, vals, styles_props, drilldown_args):
+                subcol._vals.append(val)
+                subcol._vals_rendered.append(None)
+                subcol._styles_props.append(style_props)
+                subcol._drilldown_args.append(drilldown_arg)
+        else:
+            for subcol, val, style_props, drilldown_arg in izip(
+                    self._subcols, vals, styles_props, drilldown_args):
+                subcol._vals[i] = val
+                subcol._vals_rendered[i] = None
+                subcol._styles_props[i] = style_props
+                subcol._drilldown_args[i] = drilldown_arg
 
     def iter_subcols(self):
         return self._subcols
 
     def iter_cell_tuples(self):
-        return self._cell_tuples_by_row.values()
+        for i, row in enumerate(self._rows):
+            yield tuple(subcol._make_cell(row, i) for subcol in self._subcols)
 
     def get_cell_tuple_for_row(self, row):
-        return self._cell_tuples_by_row.get(row)
+        i = self._row_index.get(row)
+        if i is None:
+            return None
+        return tuple(subcol._make_cell(row, i) for subcol in self._subcols)
+
+    def get_vals_for_row(self, row):
+        """ Return the list of values of a row, or None """
+        i = self._row_index.get(row)
+        if i is None:
+            return None
+        return [subcol._vals[i] for subcol in self._subcols]
 
 
 class KpiMatrixSubCol(object):
 
+    __slots__ = ('col', 'label', 'description', 'index',
+                 '_vals', '_vals_rendered', '_styles_props',
+                 '_drilldown_args')
+
     def __init__(self, col, label, description, index=0):
         self.col = col
         self.label = label
         self.description = description
         self.index = index
+        self._vals = []
+        # rendered values, None until they are first rendered
+        self._vals_rendered = []
+        self._styles_props = []
+        self._drilldown_args = []
 
     @property
     def subkpi(self):
         if self.col.subkpis:
             return self.col.subkpis[self.index]
 
+    def _make_cell(self, row, i):
+        cell = self.col._cell_class(
+            row, self, self._vals[i], self._vals_rendered[i], None,
+            self._styles_props[i], self._drilldown_args[i])
+        cell._index = i
+        return cell
+
     def iter_cells(self):
-        for cell_tuple in self.col.iter_cell_tuples():
-            yield cell_tuple[self.index]
+        for i, row in enumerate(self.col._rows):
+            yield self._make_cell(row, i)
 
     def get_cell_for_row(self, row):
-        cell_tuple = self.col.get_cell_tuple_for_row(row)
-        if cell_tuple is None:
+        i = self.col._row_index.get(row)
+        if i is None:
             return None
-        return cell_tuple[self.index]
+        return self._make_cell(row, i)
 
 
 class KpiMatrixCell(object):
+    """ A cell of a KpiMatrix.
+
+    When val_rendered or val_comment are None, they are computed from
+    the value and the row when they are first used, so computing a
+    matrix whose strings are not displayed does not format them.
+    The rendered value of a cell built from a sub column is stored
+    in the sub column, so it is rendered once for all the cells
+    built for the same row.
+    """
+
+    __slots__ = ('row', 'subcol', 'val', '_val_rendered', '_val_comment',
+                 'style_props', 'drilldown_arg', '_index')
 
     def __init__(self, row, subcol,
                  val, val_rendered, val_comment,
@@ -148,10 +238,63 @@ class KpiMatrixCell(object):
         self.row = row
         self.subcol = subcol
         self.val = val
-        self.val_rendered = val_rendered
-        self.val_comment = val_comment
+        self._val_rendered = val_rendered
+        self._val_comment = val_comment
         self.style_props = style_props
         self.drilldown_arg = drilldown_arg
+        # position of the cell in the arrays of its sub column
+        self._index = None
+
+    @property
+    def val_rendered(self):
+        if self._val_rendered is None:
+            self._val_rendered = self._render()
+            if self._index is not None:
+                self.subcol._vals_rendered[self._index] = self._val_rendered
+        return self._val_rendered
+
+    @property
+    def val_comment(self):
+        if self._val_comment is None:
+            return self._make_comment()
+        return self._val_comment
+
+    def _render(self):
+        if isinstance(self.val, DataError):
+            return self.val.name
+        matrix = self.row._matrix
+        return matrix._style_model.render(
+            matrix.lang, self.row.style_props, self.row.kpi.type, self.val)
+
+    def _make_comment(self):
+        if isinstance(self.val, DataError):
+            return self.val.msg
+        kpi = self.row.kpi
+        subkpi = self.subcol.subkpi
+        if subkpi:
+            return u'{}.{} = {}'.format(
+                kpi.name,
+                subkpi.name,
+                kpi._get_expression_for_subkpi(subkpi))
+        return u'{} = {}'.format(kpi.name, kpi.expression)
+
+
+class KpiMatrixComparisonCell(KpiMatrixCell):
+    """ A cell of a comparison column, whose value is the delta
+    rendered with its own style properties. """
+
+    __slots__ = ()
+
+    def _render(self):
+        matrix = self.row._matrix
+        return matrix._style_model.render_num(
+            matrix.lang, self.val,
+            self.style_props.divider, self.style_props.dp,
+            self.style_props.prefix, self.style_props.suffix,
+            sign='+')
+
+    def _make_comment(self):
+        return None
 
 
 class KpiMatrix(object):
@@ -161,6 +304,7 @@ class KpiMatrix(object):
         lang_model = env['res.lang']
         self.lang = lang_model._lang_get(env.user.lang)
         self._style_model = env['mis.report.style']
+        self.style_registry = StyleRegistry(self._style_model)
         self._account_model = env['account.account']
         # data structures
         # { kpi: KpiMatrixRow }
@@ -174,12 +318,26 @@ class KpiMatrix(object):
         self._comparison_cols = defaultdict(list)
         # { account_id: account_name }
         self._account_names = {}
+        # the MisReportSnapshot of the kpis, see prepare_kpi_matrix()
+        self.snapshot = None
+
+    def _get_kpi_snapshot(self, kpi):
+        """ Return the KpiSnapshot of a kpi given as a KpiSnapshot or,
+        for compatibility, as a mis.report.kpi record. The snapshot of the
+        report of the record is loaded when a record is first given. """
+        if not isinstance(kpi, models.BaseModel):
+            return kpi
+        if self.snapshot is None:
+            self.snapshot = kpi.report_id._get_snapshot()
+        return self.snapshot.get_kpi(kpi.id)
 
     def declare_kpi(self, kpi):
         """ Declare a new kpi (row) in the matrix.
 
-        Invoke this first for all kpi, in display order.
+        Invoke this first for all kpi (KpiSnapshot, or mis.report.kpi
+        record), in display order.
         """
+        kpi = self._get_kpi_snapshot(kpi)
         self._kpi_rows[kpi] = KpiMatrixRow(self, kpi)
         self._detail_rows[kpi] = {}
 
@@ -193,6 +351,9 @@ class KpiMatrix(object):
         self._cols[col_key] = col
         return col
 
+    def get_col(self, col_key):
+        return self._cols[col_key]
+
     def declare_comparison(self, col_key, base_col_key):
         """ Declare a new comparison column.
 
@@ -217,6 +378,7 @@ class KpiMatrix(object):
 
         Invoke this after declaring the kpi and the column.
         """
+        kpi = self._get_kpi_snapshot(kpi)
         if not account_id:
             row = self._kpi_rows[kpi]
         else:
@@ -227,48 +389,36 @@ class KpiMatrix(object):
                 row = KpiMatrixRow(self, kpi, account_id, parent_row=kpi_row)
                 self._detail_rows[kpi][account_id] = row
         col = self._cols[col_key]
-        cell_tuple = []
         assert len(vals) == col.colspan
         assert len(drilldown_args) == col.colspan
-        for val, drilldown_arg, subcol in \
-                izip(vals, drilldown_args, col.iter_subcols()):
-            if isinstance(val, DataError):
-                val_rendered = val.name
-                val_comment = val.msg
-            else:
-                val_rendered = self._style_model.render(
-                    self.lang, row.style_props, kpi.type, val)
-                if subcol.subkpi:
-                    val_comment = u'{}.{} = {}'.format(
-                        row.kpi.name,
-                        subcol.subkpi.name,
-                        row.kpi._get_expression_for_subkpi(subcol.subkpi))
-                else:
-                    val_comment = u'{} = {}'.format(
-                        row.kpi.name,
-                        row.kpi.expression)
-            cell_style_props = row.style_props
-            if row.kpi.style_expression:
-                # evaluate style expression
-                try:
-                    style_name = mis_safe_eval(row.kpi.style_expression,
-                                               col.locals_dict)
-                except:
-                    _logger.error("Error evaluating style expression <%s>",
-                                  row.kpi.style_expression, exc_info=True)
-                if style_name:
-                    style = self._style_model.search(
-                        [('name', '=', style_name)])
-                    if style:
-                        cell_style_props = self._style_model.merge(
-                            [row.style_props, style[0]])
-                    else:
-                        _logger.error("Style '%s' not found.", style_name)
-            cell = KpiMatrixCell(row, subcol, val, val_rendered, val_comment,
-                                 cell_style_props, drilldown_arg)
-            cell_tuple.append(cell)
-        assert len(cell_tuple) == col.colspan
-        col._set_cell_tuple(row, cell_tuple)
+        cell_style_props = row.style_props
+        if row.kpi.style_expression:
+            # evaluate style expression, which does not depend on the
+            # sub column
+            style_name = mis_safe_eval(row.kpi.style_expression,
+                                       col.locals_dict)
+            if isinstance(style_name, DataError):
+                _logger.error("Error evaluating style expression <%s>: "
+                              "%s", row.kpi.style_expression,
+                              style_name.msg)
+            elif style_name:
+                cell_style_props = self.style_registry.merge_named(
+                    row.style_props, style_name) or cell_style_props
+        col._set_values(row, vals, [cell_style_props] * col.colspan,
+                        drilldown_args)
+
+    def iter_col_values(self, col_key):
+        """ Iterate the values set for a column.
+
+        yields (kpi, account_id, vals, drilldown_args) tuples, in the order
+        they have been set.
+        """
+        col = self._cols[col_key]
+        subcols = col.iter_subcols()
+        for i, row in enumerate(col._rows):
+            yield (row.kpi, row.account_id,
+                   [subcol._vals[i] for subcol in subcols],
+                   [subcol._drilldown_args[i] for subcol in subcols])
 
     def compute_comparisons(self):
         """ Compute comparisons.
@@ -288,41 +438,41 @@ class KpiMatrix(object):
                     format(col.label, base_col.label)
                 comparison_col = KpiMatrixCol(label, None, {},
                                               sorted(common_subkpis,
-                                                     key=lambda s: s.sequence))
+                                                     key=lambda s: s.sequence),
+                                              KpiMatrixComparisonCell)
+                col_mask = [not common_subkpis or subcol.subkpi in
+                            common_subkpis for subcol in col.iter_subcols()]
+                base_col_mask = [not common_subkpis or subcol.subkpi in
+                                 common_subkpis
+                                 for subcol in base_col.iter_subcols()]
                 for row in self.iter_rows():
-                    cell_tuple = col.get_cell_tuple_for_row(row)
-                    base_cell_tuple = base_col.get_cell_tuple_for_row(row)
-                    if cell_tuple is None and base_cell_tuple is None:
+                    vals = col.get_vals_for_row(row)
+                    base_vals = base_col.get_vals_for_row(row)
+                    if vals is None and base_vals is None:
                         continue
-                    if cell_tuple is None:
+                    if vals is None:
                         vals = [AccountingNone] * \
                             (len(common_subkpis) or 1)
                     else:
-                        vals = [cell.val for cell in cell_tuple
-                                if not common_subkpis or
-                                cell.subcol.subkpi in common_subkpis]
-                    if base_cell_tuple is None:
+                        vals = [val for val, m in izip(vals, col_mask) if m]
+                    if base_vals is None:
                         base_vals = [AccountingNone] * \
                             (len(common_subkpis) or 1)
                     else:
-                        base_vals = [cell.val for cell in base_cell_tuple
-                                     if not common_subkpis or
-                                     cell.subcol.subkpi in common_subkpis]
-                    comparison_cell_tuple = []
-                    for val, base_val, comparison_subcol in \
-                            izip(vals,
-                                 base_vals,
-                                 comparison_col.iter_subcols()):
+                        base_vals = [val for val, m in
+                                     izip(base_vals, base_col_mask) if m]
+                    deltas = []
+                    styles_r = []
+                    for val, base_val in izip(vals, base_vals):
                         # TODO FIXME average factors
-                        delta, delta_r, style_r = \
-                            self._style_model.compare_and_render(
-                                self.lang, row.style_props,
-                                row.kpi.type, row.kpi.compare_method,
-                                val, base_val, 1, 1)
-                        comparison_cell_tuple.append(KpiMatrixCell(
-                            row, comparison_subcol, delta, delta_r, None,
-                            style_r, None))
-                    comparison_col._set_cell_tuple(row, comparison_cell_tuple)
+                        delta, style_r = self._style_model.compare(
+                            row.style_props,
+                            row.kpi.type, row.kpi.compare_method,
+                            val, base_val, 1, 1)
+                        deltas.append(delta)
+                        styles_r.append(self.style_registry.intern(style_r))
+                    comparison_col._set_values(
+                        row, deltas, styles_r, [None] * len(deltas))
                 self._comparison_cols[pos_col_key].append(comparison_col)
 
     def iter_rows(self):
@@ -394,7 +544,7 @@ class KpiMatrix(object):
                                   row.parent_row.row_id or None),
                 'label': row.label,
                 'description': row.description,
-                'style': self._style_model.to_css_style(
+                'style': self.style_registry.to_css_style(
                     row.style_props),
                 'cells': []
             }
@@ -412,7 +562,7 @@ class KpiMatrix(object):
                         'val': val,
                         'val_r': cell.val_rendered,
                         'val_c': cell.val_comment,
-                        'style': self._style_model.to_css_style(
+                        'style': self.style_registry.to_css_style(
                             cell.style_props, no_indent=True),
                     }
                     if cell.drilldown_arg:
@@ -442,6 +592,195 @@ def _is_valid_python_var(name):
     return re.match("[_A-Za-z][_a-zA-Z0-9]*$", name)
 
 
+# {expression: names used by the expression}
+_expr_names = LRU(8192)
+
+
+def _get_expr_names(expr):
+    """ Return the python names used by a KPI expression """
+    try:
+        return _expr_names[expr]
+    except KeyError:
+        pass
+    try:
+        tree = ast.parse(AEP._ACC_RE.sub('AccountingNone', expr).strip(),
+                         mode='eval')
+    except SyntaxError:
+        names = frozenset()
+    else:
+        names = frozenset(node.id for node in ast.walk(tree)
+                          if isinstance(node, ast.Name))
+    _expr_names[expr] = names
+    return names
+
+
+class SubKpiSnapshot(object):
+    """ A read-only copy of a mis.report.subkpi """
+
+    __slots__ = ('id', 'name', 'description', 'sequence')
+
+    def __init__(self, id, name, description, sequence):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.sequence = sequence
+
+
+class KpiSnapshot(object):
+    """ A read-only copy of a mis.report.kpi, with its expressions
+    and the style properties of its rows.
+
+    It has the same attributes and expression methods as the record,
+    without going through the ORM for each access.
+    """
+
+    __slots__ = ('id', 'name', 'description', 'multi', 'type',
+                 'compare_method', 'style_expression',
+                 'auto_expand_accounts', 'sequence', 'expression',
+                 'expression_names', 'style_props',
+                 'auto_expand_accounts_style_props',
+                 '_expressions', '_expressions_by_subkpi')
+
+    def __init__(self, values, expressions, style_props,
+                 auto_expand_accounts_style_props):
+        """
+        :param values: the values of the kpi, as returned by read()
+        :param expressions: the expressions of the kpi, in order,
+                            as (SubKpiSnapshot or None, name) tuples
+        :param style_props: the style properties of the kpi row
+        :param auto_expand_accounts_style_props: the style properties of
+                                                 the account detail rows
+        """
+        self.id = values['id']
+        self.name = values['name']
+        self.description = values['description']
+        self.multi = values['multi']
+        self.type = values['type']
+        self.compare_method = values['compare_method']
+        self.style_expression = values['style_expression']
+        self.auto_expand_accounts = values['auto_expand_accounts']
+        self.sequence = values['sequence']
+        self.style_props = style_props
+        self.auto_expand_accounts_style_props = \
+            auto_expand_accounts_style_props
+        self._expressions = expressions
+        # {subkpi id: expression}, the first one as in the record
+        self._expressions_by_subkpi = {}
+        l = []
+        for subkpi, name in expressions:
+            if subkpi:
+                self._expressions_by_subkpi.setdefault(
+                    subkpi.id, name or 'AccountingNone')
+                l.append(u'{}\xa0=\xa0{}'.format(subkpi.name, name))
+            else:
+                l.append(name or 'AccountingNone')
+        self.expression = ',\n'.join(l)
+        self.expression_names = [name for _, name in expressions if name]
+
+    def _get_expression_for_subkpi(self, subkpi):
+        return self._expressions_by_subkpi.get(subkpi.id, 'AccountingNone')
+
+    def _get_expressions(self, subkpis):
+        if subkpis and self.multi:
+            return [
+                self._get_expression_for_subkpi(subkpi)
+                for subkpi in subkpis
+            ]
+        else:
+            if self._expressions:
+                assert len(self._expressions) == 1
+                assert not self._expressions[0][0]
+                return [self._expressions[0][1] or 'AccountingNone']
+            else:
+                return ['AccountingNone']
+
+
+class MisReportSnapshot(object):
+    """ A read-only, plain python copy of a report template: its KPIs,
+    with their expressions and styles, and its sub KPIs.
+
+    It is loaded with a few bulk reads by MisReport._get_snapshot(),
+    once for each computation, so evaluating and rendering KPIs
+    do not go through the ORM.
+    """
+
+    def __init__(self, report_id, kpis, subkpis):
+        self.id = report_id
+        self.kpis = kpis  # in display order
+        self.subkpis = subkpis  # in sequence order
+        self._kpis_by_id = {kpi.id: kpi for kpi in kpis}
+        self._kpis_compute_order = None
+
+    def get_kpi(self, kpi_id):
+        """ Return the KpiSnapshot of a kpi id """
+        return self._kpis_by_id[kpi_id]
+
+    def filter_subkpis(self, subkpis_filter=None):
+        """ Return the sub KPIs that are in subkpis_filter, a list
+        of sub KPIs (records or snapshots), or all sub KPIs if it is empty.
+        """
+        if subkpis_filter:
+            subkpi_ids = set(subkpi.id for subkpi in subkpis_filter)
+            return [subkpi for subkpi in self.subkpis
+                    if subkpi.id in subkpi_ids]
+        else:
+            return self.subkpis
+
+    def get_kpis_compute_order(self):
+        """ Sort KPIs by dependencies.
+
+        Dependencies are obtained from the names used in KPI expressions.
+
+        Returns the list of KPIs that can be computed, each one after the
+        KPIs it uses, and the list of KPIs involved in circular references.
+        """
+        if self._kpis_compute_order is not None:
+            return self._kpis_compute_order
+        kpis = self.kpis
+        kpi_by_name = {kpi.name: kpi for kpi in kpis}
+        # {kpi: number of kpis it uses that are not computed yet}
+        pending = {}
+        # {kpi: [kpis using it]}
+        used_by = defaultdict(list)
+        for kpi in kpis:
+            names = set()
+            for expression in kpi.expression_names:
+                names.update(_get_expr_names(expression))
+            used_kpis = set(kpi_by_name[name] for name in names
+                            if name in kpi_by_name)
+            pending[kpi] = len(used_kpis)
+            for used_kpi in used_kpis:
+                used_by[used_kpi].append(kpi)
+        # topological sort, in display order when there is a choice
+        index = {kpi: i for i, kpi in enumerate(kpis)}
+        ready = [index[kpi] for kpi in kpis if not pending[kpi]]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            kpi = kpis[heapq.heappop(ready)]
+            ordered.append(kpi)
+            for using_kpi in used_by[kpi]:
+                pending[using_kpi] -= 1
+                if not pending[using_kpi]:
+                    heapq.heappush(ready, index[using_kpi])
+        # remaining kpis are in cycles, or use kpis in cycles
+        remaining = set(kpi for kpi in kpis if pending[kpi])
+        using_cycles = []
+        changed = True
+        while changed:
+            changed = False
+            for kpi in kpis:
+                if kpi in remaining and \
+                        not remaining.intersection(used_by[kpi]):
+                    remaining.remove(kpi)
+                    using_cycles.append(kpi)
+                    changed = True
+        ordered.extend(reversed(using_cycles))
+        cyclic = [kpi for kpi in kpis if kpi in remaining]
+        self._kpis_compute_order = ordered, cyclic
+        return self._kpis_compute_order
+
+
 class MisReportKpi(models.Model):
     """ A KPI is an element (ie a line) of a MIS report.
 
@@ -506,6 +845,10 @@ class MisReportKpi(models.Model):
                 raise UserError(_('The name must be a valid python '
                                   'identifier'))
 
+    @api.constrains('name', 'report_id')
+    def _check_circular_references(self):
+        self.mapped('report_id')._check_circular_references()
+
     @api.onchange('name')
     def _onchange_name(self):
         if self.name and not _is_valid_python_var(self.name):
@@ -669,6 +1012,10 @@ class MisReportKpiExpression(models.Model):
          'Sub KPI must be used once and only once for each KPI'),
     ]
 
+    @api.constrains('name', 'kpi_id')
+    def _check_circular_references(self):
+        self.mapped('kpi_id.report_id')._check_circular_references()
+
 
 class MisReportQuery(models.Model):
     """ A query to fetch arbitrary data for a MIS report.
@@ -799,22 +1146,112 @@ class MisReport(models.Model):
     # TODO: kpi name cannot be start with query name
 
     @api.multi
-    def prepare_kpi_matrix(self):
+    def _get_kpis_compute_order(self):
+        """ Sort KPIs by dependencies, see
+        MisReportSnapshot.get_kpis_compute_order() """
+        self.ensure_one()
+        return self._get_snapshot().get_kpis_compute_order()
+
+    @api.multi
+    def _check_circular_references(self):
+        for report in self:
+            cyclic = report._get_kpis_compute_order()[1]
+            if cyclic:
+                raise UserError(
+                    _('Circular references between KPIs: %s') %
+                    ', '.join(kpi.name for kpi in cyclic))
+
+    @api.multi
+    def _get_snapshot(self):
+        """ Return a MisReportSnapshot of the report template,
+        loaded with a few bulk reads. """
         self.ensure_one()
+        subkpis = [
+            SubKpiSnapshot(values['id'], values['name'],
+                           values['description'], values['sequence'])
+            for values in self.env['mis.report.subkpi'].search_read(
+                [('report_id', '=', self.id)],
+                ['name', 'description', 'sequence'])
+        ]
+        subkpis_by_id = {subkpi.id: subkpi for subkpi in subkpis}
+        kpis_values = self.env['mis.report.kpi'].search_read(
+            [('report_id', '=', self.id)],
+            ['name', 'description', 'multi', 'type', 'compare_method',
+             'style_expression', 'auto_expand_accounts', 'sequence',
+             'style_id', 'auto_expand_accounts_style_id'])
+        # {kpi id: [(subkpi, expression)]}
+        expressions = defaultdict(list)
+        for values in self.env['mis.report.kpi.expression'].search_read(
+                [('kpi_id', 'in', [v['id'] for v in kpis_values])],
+                ['name', 'kpi_id', 'subkpi_id']):
+            subkpi = values['subkpi_id'] and \
+                subkpis_by_id.get(values['subkpi_id'][0])
+            expressions[values['kpi_id'][0]].append(
+                (subkpi or None, values['name']))
+        # style properties, merged once for each style
+        style_model = self.env['mis.report.style']
+        style_ids = set([self.style_id.id])
+        for values in kpis_values:
+            for field_name in ('style_id', 'auto_expand_accounts_style_id'):
+                if values[field_name]:
+                    style_ids.add(values[field_name][0])
+        styles_props = {
+            style.id: style_model.merge([style])
+            for style in style_model.browse(list(style_ids - {False}))
+        }
+        report_style_props = styles_props.get(self.style_id.id)
+        kpis = []
+        for values in kpis_values:
+            style_props = style_model.merge([
+                report_style_props,
+                values['style_id'] and
+                styles_props[values['style_id'][0]]])
+            auto_expand_accounts_style_props = style_model.merge([
+                report_style_props,
+                values['auto_expand_accounts_style_id'] and
+                styles_props[values['auto_expand_accounts_style_id'][0]]])
+            kpis.append(KpiSnapshot(
+                values, expressions[values['id']],
+                style_props, auto_expand_accounts_style_props))
+        return MisReportSnapshot(self.id, kpis, subkpis)
+
+    @api.multi
+    def prepare_kpi_matrix(self, snapshot=None):
+        """ Prepare a KpiMatrix with a row for each KPI of a snapshot
+        of the report, loaded by _get_snapshot() if not given. """
+        self.ensure_one()
+        if snapshot is None:
+            snapshot = self._get_snapshot()
         kpi_matrix = KpiMatrix(self.env)
-        for kpi in self.kpi_ids:
+        kpi_matrix.snapshot = snapshot
+        for kpi in snapshot.kpis:
             kpi_matrix.declare_kpi(kpi)
         return kpi_matrix
 
     @api.multi
-    def _prepare_aep(self, company):
+    def _get_matrix_snapshot(self, kpi_matrix):
+        """ Return the snapshot of a KpiMatrix, loading it if the matrix
+        was not prepared with prepare_kpi_matrix() and no kpi record
+        was declared in it. """
         self.ensure_one()
+        if kpi_matrix.snapshot is None:
+            kpi_matrix.snapshot = self._get_snapshot()
+        return kpi_matrix.snapshot
+
+    @api.multi
+    def _prepare_aep(self, company, snapshot=None):
+        self.ensure_one()
+        if snapshot is None:
+            snapshot = self._get_snapshot()
         aep = AEP(company)
-        for kpi in self.kpi_ids:
-            for expression in kpi.expression_ids:
-                if expression.name:
-                    aep.parse_expr(expression.name)
+        for kpi in snapshot.kpis:
+            for expression in kpi.expression_names:
+                aep.parse_expr(expression)
         aep.done_parsing()
+        # substitute accounting variables once for all periods
+        for kpi in snapshot.kpis:
+            for expression in kpi.expression_names:
+                aep.substitute_vars(expression)
         return aep
 
     def prepare_locals_dict(self):
@@ -833,68 +1270,286 @@ class MisReport(models.Model):
                        get_additional_query_filter=None):
         self.ensure_one()
         res = {}
+        for query in self.query_ids:
+            res[query.name] = self._fetch_query(
+                query, date_from, date_to, get_additional_query_filter)
+        return res
+
+    @api.multi
+    def _get_query_domain(self, query, get_additional_query_filter=None):
+        """ Return the domain of a query, without dates """
+        self.ensure_one()
+        eval_context = {
+            'env': self.env,
+            'time': time,
+            'datetime': datetime,
+            'dateutil': dateutil,
+            # deprecated
+            'uid': self.env.uid,
+            'context': self.env.context,
+        }
+        domain = query.domain and \
+            safe_eval(query.domain, eval_context) or []
+        if get_additional_query_filter:
+            domain.extend(get_additional_query_filter(query))
+        return domain
+
+    @api.multi
+    def _get_query_date_domain(self, query, date_from, date_to):
+        """ Return the domain selecting the records of a query
+        in a period """
+        self.ensure_one()
+        if query.date_field.ttype == 'date':
+            return [(query.date_field.name, '>=', date_from),
+                    (query.date_field.name, '<=', date_to)]
+        else:
+            datetime_from = _utc_midnight(
+                date_from, self._context.get('tz', 'UTC'))
+            datetime_to = _utc_midnight(
+                date_to, self._context.get('tz', 'UTC'), add_day=1)
+            return [(query.date_field.name, '>=', datetime_from),
+                    (query.date_field.name, '<', datetime_to)]
+
+    @api.multi
+    def _fetch_query(self, query, date_from, date_to,
+                     get_additional_query_filter=None):
+        self.ensure_one()
+        model = self.env[query.model_id.model]
+        domain = self._get_query_domain(query, get_additional_query_filter)
+        domain.extend(self._get_query_date_domain(query, date_from, date_to))
+        field_names = [f.name for f in query.field_ids]
+        all_stored = all([model._fields[f].store for f in field_names])
+        if not query.aggregate:
+            data = model.search_read(domain, field_names)
+            return [AutoStruct(**d) for d in data]
+        elif query.aggregate == 'sum' and all_stored:
+            # use read_group to sum stored fields
+            data = model.read_group(
+                domain, field_names, [])
+            s = AutoStruct(count=data[0]['__count'])
+            for field_name in field_names:
+                try:
+                    v = data[0][field_name]
+                except KeyError:
+                    _logger.error('field %s not found in read_group '
+                                  'for %s; not summable?',
+                                  field_name, model._name)
+                    v = AccountingNone
+                setattr(s, field_name, v)
+            return s
+        else:
+            data = model.search_read(domain, field_names)
+            s = AutoStruct(count=len(data))
+            if query.aggregate == 'min':
+                agg = _min
+            elif query.aggregate == 'max':
+                agg = _max
+            elif query.aggregate == 'avg':
+                agg = _avg
+            elif query.aggregate == 'sum':
+                agg = _sum
+            for field_name in field_names:
+                setattr(s, field_name,
+                        agg([d[field_name] for d in data]))
+            return s
+
+    @api.multi
+    def _fetch_queries_multi(self, periods):
+        """ Fetch non-accounting queries for several periods at once.
+
+        :param periods: a list of (date_from, date_to,
+                        get_additional_query_filter) tuples
+        :returns: a list with the result of _fetch_queries()
+                  for each period
+
+        For each aggregated query, and each distinct additional filter,
+        one query computes the count and aggregates of all periods in
+        the database, using conditional aggregation on dates.
+        Queries without aggregate, and queries with fields that are not
+        stored numbers, are fetched period by period by _fetch_query().
+        """
+        self.ensure_one()
+        res = [{} for _ in periods]
         for query in self.query_ids:
             model = self.env[query.model_id.model]
-            eval_context = {
-                'env': self.env,
-                'time': time,
-                'datetime': datetime,
-                'dateutil': dateutil,
-                # deprecated
-                'uid': self.env.uid,
-                'context': self.env.context,
-            }
-            domain = query.domain and \
-                safe_eval(query.domain, eval_context) or []
-            if get_additional_query_filter:
-                domain.extend(get_additional_query_filter(query))
-            if query.date_field.ttype == 'date':
-                domain.extend([(query.date_field.name, '>=', date_from),
-                               (query.date_field.name, '<=', date_to)])
-            else:
-                datetime_from = _utc_midnight(
-                    date_from, self._context.get('tz', 'UTC'))
-                datetime_to = _utc_midnight(
-                    date_to, self._context.get('tz', 'UTC'), add_day=1)
-                domain.extend([(query.date_field.name, '>=', datetime_from),
-                               (query.date_field.name, '<', datetime_to)])
-            field_names = [f.name for f in query.field_ids]
-            all_stored = all([model._fields[f].store for f in field_names])
-            if not query.aggregate:
-                data = model.search_read(domain, field_names)
-                res[query.name] = [AutoStruct(**d) for d in data]
-            elif query.aggregate == 'sum' and all_stored:
-                # use read_group to sum stored fields
-                data = model.read_group(
-                    domain, field_names, [])
-                s = AutoStruct(count=data[0]['__count'])
-                for field_name in field_names:
-                    try:
-                        v = data[0][field_name]
-                    except KeyError:
-                        _logger.error('field %s not found in read_group '
-                                      'for %s; not summable?',
-                                      field_name, model._name)
-                        v = AccountingNone
-                    setattr(s, field_name, v)
-                res[query.name] = s
-            else:
-                data = model.search_read(domain, field_names)
-                s = AutoStruct(count=len(data))
-                if query.aggregate == 'min':
-                    agg = _min
-                elif query.aggregate == 'max':
-                    agg = _max
-                elif query.aggregate == 'avg':
-                    agg = _avg
-                elif query.aggregate == 'sum':
-                    agg = _sum
-                for field_name in field_names:
-                    setattr(s, field_name,
-                            agg([d[field_name] for d in data]))
-                res[query.name] = s
+            query_fields = [model._fields[f.name] for f in query.field_ids]
+            sql_aggregate = query.aggregate and all(
+                field.store and not field.inherited and
+                field.type in ('integer', 'float', 'monetary')
+                for field in query_fields)
+            # {repr(additional filter): (additional filter, [period index])}
+            periods_by_filter = OrderedDict()
+            for i, (date_from, date_to, get_additional_query_filter) in \
+                    enumerate(periods):
+                if not sql_aggregate:
+                    res[i][query.name] = self._fetch_query(
+                        query, date_from, date_to,
+                        get_additional_query_filter)
+                    continue
+                additional_filter = get_additional_query_filter and \
+                    get_additional_query_filter(query) or []
+                filter_key = repr(additional_filter)
+                if filter_key not in periods_by_filter:
+                    periods_by_filter[filter_key] = (additional_filter, [])
+                periods_by_filter[filter_key][1].append(i)
+            for additional_filter, indexes in periods_by_filter.values():
+                values = self._fetch_query_aggregates(
+                    query, additional_filter,
+                    [periods[i][:2] for i in indexes])
+                if values is None:
+                    values = [self._fetch_query(query, periods[i][0],
+                                                periods[i][1],
+                                                periods[i][2])
+                              for i in indexes]
+                for i, value in izip(indexes, values):
+                    res[i][query.name] = value
         return res
 
+    @api.multi
+    def _fetch_query_aggregates(self, query, additional_filter,
+                                date_ranges):
+        """ Return the count and aggregates of a query for each date range,
+        as AutoStruct, or None if dates can not be used as conditions.
+
+        Null values count as 0, as when the records are read. """
+        self.ensure_one()
+        model = self.env[query.model_id.model]
+        model.check_access_rights('read')
+        table = '"%s"' % model._table
+        conditions = []
+        for date_from, date_to in date_ranges:
+            date_domain = self._get_query_date_domain(
+                query, date_from, date_to)
+            from_clause, where_clause, where_params = model._where_calc(
+                date_domain, active_test=False).get_sql()
+            if from_clause != table:
+                return None
+            conditions.append((where_clause or 'TRUE', where_params))
+        domain = self._get_query_domain(query) + additional_filter
+        where_query = model._where_calc(domain)
+        model._apply_ir_rules(where_query, 'read')
+        from_clause, where_clause, where_params = where_query.get_sql()
+        agg = {
+            'sum': 'SUM',
+            'min': 'MIN',
+            'max': 'MAX',
+            'avg': 'AVG',
+        }[query.aggregate]
+        field_names = [f.name for f in query.field_ids]
+        select_sql = []
+        select_params = []
+        for condition, condition_params in conditions:
+            select_sql.append("COUNT(CASE WHEN {c} THEN 1 END)".
+                              format(c=condition))
+            select_params.extend(condition_params)
+            for field_name in field_names:
+                select_sql.append(
+                    '{agg}(CASE WHEN {c} THEN COALESCE({t}."{f}", 0) END)'.
+                    format(agg=agg, c=condition, t=table, f=field_name))
+                select_params.extend(condition_params)
+        sql = "SELECT {select} " \
+              "FROM {from_clause} " \
+              "WHERE {where} AND ({any})".format(
+                  select=', '.join(select_sql),
+                  from_clause=from_clause,
+                  where=where_clause or 'TRUE',
+                  any=' OR '.join(c[0] for c in conditions))
+        any_params = [p for c in conditions for p in c[1]]
+        self.env.cr.execute(sql, select_params + where_params + any_params)
+        row = iter(self.env.cr.fetchone())
+        res = []
+        for i in range(len(conditions)):
+            s = AutoStruct(count=next(row))
+            for field_name in field_names:
+                setattr(s, field_name, next(row))
+            res.append(s)
+        return res
+
+    @api.multi
+    def _get_template_version(self):
+        """ Return the last modification date of the report template,
+        with the number of its KPIs, expressions, subkpis, queries and
+        styles, which change when one of them is deleted """
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT
+                GREATEST(
+                    (SELECT write_date FROM mis_report
+                     WHERE id = %(report_id)s),
+                    (SELECT MAX(write_date) FROM mis_report_kpi
+                     WHERE report_id = %(report_id)s),
+                    (SELECT MAX(e.write_date) FROM mis_report_kpi_expression e
+                     INNER JOIN mis_report_kpi k ON e.kpi_id = k.id
+                     WHERE k.report_id = %(report_id)s),
+                    (SELECT MAX(write_date) FROM mis_report_subkpi
+                     WHERE report_id = %(report_id)s),
+                    (SELECT MAX(write_date) FROM mis_report_query
+                     WHERE report_id = %(report_id)s),
+                    (SELECT MAX(write_date) FROM mis_report_style)
+                ),
+                (SELECT COUNT(*) FROM mis_report_kpi
+                 WHERE report_id = %(report_id)s),
+                (SELECT COUNT(*) FROM mis_report_kpi_expression e
+                 INNER JOIN mis_report_kpi k ON e.kpi_id = k.id
+                 WHERE k.report_id = %(report_id)s),
+                (SELECT COUNT(*) FROM mis_report_subkpi
+                 WHERE report_id = %(report_id)s),
+                (SELECT COUNT(*) FROM mis_report_query
+                 WHERE report_id = %(report_id)s),
+                (SELECT COUNT(*) FROM mis_report_style)
+        """, {'report_id': self.id})
+        return self.env.cr.fetchone()
+
+    @api.model
+    def _get_period_partial(self, kpi_matrix, col_key):
+        """ Return the partial result of a period computed by
+        declare_and_compute_period(), which declare_period_from_partial()
+        uses to declare the period in another KpiMatrix without
+        evaluating it again.
+
+        The partial result holds the evaluated locals (accounting variables
+        and KPI values) and the values of the matrix cells in tuples, but no
+        record nor mutable container, so it can be kept across transactions
+        and shared by threads without being copied. Reports with queries,
+        whose results are mutable objects, are not supported.
+        """
+        base_locals_dict = self.prepare_locals_dict()
+        locals_dict = {
+            name: value
+            for name, value in kpi_matrix.get_col(col_key).locals_dict.items()
+            if name not in base_locals_dict
+        }
+        values = tuple(
+            (kpi.id, account_id, tuple(vals),
+             tuple(arg and tuple(arg.items()) for arg in drilldown_args))
+            for kpi, account_id, vals, drilldown_args in
+            kpi_matrix.iter_col_values(col_key)
+        )
+        return locals_dict, values
+
+    @api.multi
+    def declare_period_from_partial(self, kpi_matrix,
+                                    col_key,
+                                    col_label,
+                                    col_description,
+                                    partial,
+                                    subkpis_filter=None):
+        """ Declare a period in a KpiMatrix, with the partial result
+        obtained from _get_period_partial() instead of evaluating it.
+        """
+        self.ensure_one()
+        snapshot = self._get_matrix_snapshot(kpi_matrix)
+        locals_dict = self.prepare_locals_dict()
+        locals_dict.update(partial[0])
+        kpi_matrix.declare_col(col_key,
+                               col_label, col_description,
+                               locals_dict,
+                               snapshot.filter_subkpis(subkpis_filter))
+        for kpi_id, account_id, vals, drilldown_args in partial[1]:
+            kpi_matrix.set_values_detail_account(
+                snapshot.get_kpi(kpi_id), col_key, account_id, list(vals),
+                [arg and dict(arg) for arg in drilldown_args])
+
     @api.multi
     def declare_and_compute_period(self, kpi_matrix,
                                    col_key,
@@ -906,7 +1561,8 @@ class MisReport(models.Model):
                                    subkpis_filter=None,
                                    get_additional_move_line_filter=None,
                                    get_additional_query_filter=None,
-                                   locals_dict=None):
+                                   locals_dict=None,
+                                   fetched_queries=None):
         """ Evaluate a report for a given period, populating a KpiMatrix.
 
         :param kpi_matrix: the KpiMatrix object to be populated created
@@ -926,6 +1582,9 @@ class MisReport(models.Model):
                                             underlying model
         :param locals_dict: personalized locals dictionary used as evaluation
                             context for the KPI expressions
+        :param fetched_queries: the result of _fetch_queries() for the
+                                period, if already fetched, eg with
+                                _fetch_queries_multi()
         """
         self.ensure_one()
 
@@ -936,8 +1595,10 @@ class MisReport(models.Model):
         locals_dict.update(self.prepare_locals_dict())
 
         # fetch non-accounting queries
-        locals_dict.update(self._fetch_queries(
-            date_from, date_to, get_additional_query_filter))
+        if fetched_queries is None:
+            fetched_queries = self._fetch_queries(
+                date_from, date_to, get_additional_query_filter)
+        locals_dict.update(fetched_queries)
 
         # use AEP to do the accounting queries
         additional_move_line_filter = None
@@ -946,98 +1607,94 @@ class MisReport(models.Model):
         aep.do_queries(date_from, date_to,
                        target_move,
                        additional_move_line_filter)
+        locals_dict.update(aep.get_vars_values())
 
-        if subkpis_filter:
-            subkpis = [subkpi for subkpi in self.subkpi_ids
-                       if subkpi in subkpis_filter]
-        else:
-            subkpis = self.subkpi_ids
+        snapshot = self._get_matrix_snapshot(kpi_matrix)
+        subkpis = snapshot.filter_subkpis(subkpis_filter)
         col = kpi_matrix.declare_col(col_key,
                                      col_label, col_description,
                                      locals_dict, subkpis)
 
-        compute_queue = self.kpi_ids
-        recompute_queue = []
-        while True:
-            for kpi in compute_queue:
-                # build the list of expressions for this kpi
-                expressions = kpi._get_expressions(subkpis)
+        # evaluate kpis once, each one after the kpis it uses
+        kpis, cyclic_kpis = snapshot.get_kpis_compute_order()
+        cycle_error = None
+        if cyclic_kpis:
+            cycle_error = NameDataError(
+                '#NAME', _('Circular references between KPIs: %s') %
+                ', '.join(kpi.name for kpi in cyclic_kpis))
+        for kpi in kpis + cyclic_kpis:
+            # build the list of expressions for this kpi
+            expressions = kpi._get_expressions(subkpis)
+
+            vals = []
+            drilldown_args = []
+            name_error = False
+            substituted_exprs = [aep.substitute_vars(expression)
+                                 for expression in expressions]
+            for expression, (expr, var_names) in \
+                    izip(expressions, substituted_exprs):
+                if kpi in cyclic_kpis:
+                    vals.append(cycle_error)
+                else:
+                    vals.append(mis_safe_eval(expr, locals_dict))
+                if isinstance(vals[-1], NameDataError):
+                    name_error = True
+                if var_names:
+                    drilldown_args.append({
+                        'period_id': col_key,
+                        'expr': expression,
+                    })
+                else:
+                    drilldown_args.append(None)
+            if not name_error:
+                # no error, set it in locals_dict so it can be used
+                # in computing other kpis
+                if len(expressions) == 1:
+                    locals_dict[kpi.name] = vals[0]
+                else:
+                    locals_dict[kpi.name] = SimpleArray(vals)
+
+            # even in case of name error we set the result in the matrix
+            # so the name error is displayed
+            if len(expressions) == 1 and col.colspan > 1:
+                if isinstance(vals[0], tuple):
+                    vals = vals[0]
+                    assert len(vals) == col.colspan
+                elif isinstance(vals[0], DataError):
+                    vals = (vals[0],) * col.colspan
+                else:
+                    raise UserError(_("Probably not your fault... but I'm "
+                                      "really curious to know how you "
+                                      "managed to raise this error so "
+                                      "I can handle one more corner "
+                                      "case!"))
+            if len(drilldown_args) != col.colspan:
+                drilldown_args = [None] * col.colspan
+            kpi_matrix.set_values(
+                kpi, col_key, vals, drilldown_args)
+
+            if not kpi.auto_expand_accounts or name_error:
+                continue
 
+            all_var_names = set()
+            for expr, var_names in substituted_exprs:
+                all_var_names.update(var_names)
+            for account_id, vars_values in \
+                    aep.iter_vars_values_by_account_id(all_var_names):
+                account_locals_dict = ChainedDict(locals_dict, vars_values)
                 vals = []
                 drilldown_args = []
-                name_error = False
-                for expression in expressions:
-                    replaced_expr = aep.replace_expr(expression)
-                    vals.append(
-                        mis_safe_eval(replaced_expr, locals_dict))
-                    if isinstance(vals[-1], NameDataError):
-                        name_error = True
-                    if replaced_expr != expression:
+                for expression, (expr, var_names) in \
+                        izip(expressions, substituted_exprs):
+                    vals.append(mis_safe_eval(expr, account_locals_dict))
+                    if var_names:
                         drilldown_args.append({
                             'period_id': col_key,
                             'expr': expression,
+                            'account_id': account_id
                         })
                     else:
                         drilldown_args.append(None)
-                if name_error:
-                    recompute_queue.append(kpi)
-                else:
-                    # no error, set it in locals_dict so it can be used
-                    # in computing other kpis
-                    if len(expressions) == 1:
-                        locals_dict[kpi.name] = vals[0]
-                    else:
-                        locals_dict[kpi.name] = SimpleArray(vals)
-
-                # even in case of name error we set the result in the matrix
-                # so the name error will be displayed if it cannot be
-                # resolved by recomputing later
-                if len(expressions) == 1 and col.colspan > 1:
-                    if isinstance(vals[0], tuple):
-                        vals = vals[0]
-                        assert len(vals) == col.colspan
-                    elif isinstance(vals[0], DataError):
-                        vals = (vals[0],) * col.colspan
-                    else:
-                        raise UserError(_("Probably not your fault... but I'm "
-                                          "really curious to know how you "
-                                          "managed to raise this error so "
-                                          "I can handle one more corner "
-                                          "case!"))
-                if len(drilldown_args) != col.colspan:
-                    drilldown_args = [None] * col.colspan
-                kpi_matrix.set_values(
-                    kpi, col_key, vals, drilldown_args)
-
-                if not kpi.auto_expand_accounts or name_error:
-                    continue
+                kpi_matrix.set_values_detail_account(
+                    kpi, col_key, account_id, vals, drilldown_args)
 
-                for account_id, replaced_exprs in \
-                        aep.replace_exprs_by_account_id(expressions):
-                    vals = []
-                    drilldown_args = []
-                    for expression, replaced_expr in \
-                            izip(expressions, replaced_exprs):
-                        vals.append(mis_safe_eval(replaced_expr, locals_dict))
-                        if replaced_expr != expression:
-                            drilldown_args.append({
-                                'period_id': col_key,
-                                'expr': expression,
-                                'account_id': account_id
-                            })
-                        else:
-                            drilldown_args.append(None)
-                    kpi_matrix.set_values_detail_account(
-                        kpi, col_key, account_id, vals, drilldown_args)
-
-            if len(recompute_queue) == 0:
-                # nothing to recompute, we are done
-                break
-            if len(recompute_queue) == len(compute_queue):
-                # could not compute anything in this iteration
-                # (ie real Name errors or cyclic dependency)
-                # so we stop trying
-                break
-            # try again
-            compute_queue = recompute_queue
-            recompute_queue = []
@@ -3,11 +3,23 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
 from odoo import api, fields, models, _
+from odoo.tools import config
 
 import datetime
+from itertools import izip
 import logging
+from multiprocessing.pool import ThreadPool
 
 from .aep import AccountingExpressionProcessor as AEP
+from .kpi_matrix_cache import (
+    drilldown_cache,
+    kpi_matrix_cache,
+    period_cache,
+    compact_ledger_version,
+    create_ledger_version,
+    get_ledger_version,
+    is_ledger_changed,
+)
 
 _logger = logging.getLogger(__name__)
 
@@ -230,6 +242,16 @@ class MisReportInstance(models.Model):
     date_from = fields.Date(string="From")
     date_to = fields.Date(string="To")
     temporary = fields.Boolean(default=False)
+    parallel_compute = fields.Boolean(
+        string='Compute periods in parallel',
+        help='Query the accounting data of periods concurrently, '
+             'using several database connections. The number of '
+             'connections is bounded by the mis_builder_compute_workers '
+             'configuration option (4 by default).')
+
+    @api.model_cr
+    def init(self):
+        create_ledger_version(self.env.cr)
 
     @api.multi
     def save_report(self):
@@ -244,6 +266,10 @@ class MisReportInstance(models.Model):
             })
         return res
 
+    @api.model
+    def _compact_ledger_version(self):
+        compact_ledger_version(self.env.cr)
+
     @api.model
     def _vacuum_report(self, hours=24):
         clear_date = fields.Datetime.to_string(
@@ -356,40 +382,263 @@ class MisReportInstance(models.Model):
             'target': 'current',
         }
 
+    @api.multi
+    def _query_periods_parallel(self, aep, periods):
+        """ Query accounting data of periods with a pool of threads,
+        each with its own cursor sharing the database snapshot of the
+        current transaction. """
+        self.ensure_one()
+        workers = min(int(config.get('mis_builder_compute_workers', 4)),
+                      len(periods))
+        chunks = [periods[i::workers] for i in range(workers)]
+        self.env.cr.execute("SELECT pg_export_snapshot()")
+        snapshot_id = self.env.cr.fetchone()[0]
+        uid, context = self.env.uid, self.env.context
+        target_move = self.target_move
+
+        def query_chunk(chunk):
+            with api.Environment.manage():
+                with self.pool.cursor() as cr:
+                    cr.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id, ))
+                    env = api.Environment(cr, uid, context)
+                    aep.with_env(env).do_queries_multi(chunk, target_move)
+
+        pool = ThreadPool(workers)
+        try:
+            pool.map(query_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    @api.multi
+    def _query_periods(self, aep, periods=None):
+        """ Query accounting data for all periods (or the given ones)
+        at once, before KPIs are evaluated period by period. """
+        self.ensure_one()
+        if periods is None:
+            periods = self.period_ids
+        periods = [
+            (period.date_from, period.date_to,
+             period._get_additional_move_line_filter())
+            for period in periods
+            if period.date_from and period.date_to
+        ]
+        # other cursors can not see uncommitted journal items
+        if self.parallel_compute and len(periods) > 1 and \
+                not is_ledger_changed(self.env.cr):
+            self._query_periods_parallel(aep, periods)
+        else:
+            aep.do_queries_multi(periods, self.target_move)
+
     @api.multi
     def _compute_matrix(self):
         self.ensure_one()
-        aep = self.report_id._prepare_aep(self.company_id)
-        kpi_matrix = self.report_id.prepare_kpi_matrix()
-        for period in self.period_ids:
+        report = self.report_id
+        # the report template is read once for all periods
+        snapshot = report._get_snapshot()
+        aep = report._prepare_aep(self.company_id, snapshot)
+        self._set_drilldown_aep(aep)
+        kpi_matrix = report.prepare_kpi_matrix(snapshot)
+        # reuse the partial results of the periods that did not change
+        cache_keys = self._get_period_cache_keys()
+        partials = {}
+        if cache_keys is not None:
+            for period, cache_key in izip(self.period_ids, cache_keys):
+                partial = period_cache.get(cache_key)
+                if partial is not None:
+                    partials[period.id] = partial
+        periods_to_compute = self.period_ids.filtered(
+            lambda p: p.id not in partials)
+        self._query_periods(aep, periods_to_compute)
+        fetched_queries_by_period = dict(izip(
+            periods_to_compute.ids,
+            report._fetch_queries_multi([
+                (period.date_from, period.date_to,
+                 period._get_additional_query_filter)
+                for period in periods_to_compute
+            ])))
+        # evaluate periods in column order
+        for i, period in enumerate(self.period_ids):
             if period.date_from == period.date_to:
                 comment = self._format_date(period.date_from)
             else:
                 date_from = self._format_date(period.date_from)
                 date_to = self._format_date(period.date_to)
                 comment = _('from %s to %s') % (date_from, date_to)
-            self.report_id.declare_and_compute_period(
-                kpi_matrix,
-                period.id,
-                period.name,
-                comment,
-                aep,
-                period.date_from,
-                period.date_to,
-                self.target_move,
-                period.subkpi_ids,
-                period._get_additional_move_line_filter,
-                period._get_additional_query_filter)
+            if period.id in partials:
+                report.declare_period_from_partial(
+                    kpi_matrix,
+                    period.id,
+                    period.name,
+                    comment,
+                    partials[period.id],
+                    period.subkpi_ids)
+            else:
+                report.declare_and_compute_period(
+                    kpi_matrix,
+                    period.id,
+                    period.name,
+                    comment,
+                    aep,
+                    period.date_from,
+                    period.date_to,
+                    self.target_move,
+                    period.subkpi_ids,
+                    period._get_additional_move_line_filter,
+                    period._get_additional_query_filter,
+                    fetched_queries=fetched_queries_by_period[period.id])
+                if cache_keys is not None:
+                    period_cache.set(cache_keys[i], report._get_period_partial(
+                        kpi_matrix, period.id))
             for comparison_column in period.comparison_column_ids:
                 kpi_matrix.declare_comparison(period.id, comparison_column.id)
         kpi_matrix.compute_comparisons()
         return kpi_matrix
 
+    @api.multi
+    def _get_period_cache_keys(self):
+        """ Return the keys of the partial results of the periods in the
+        period cache, or None if they must not be cached.
+
+        The keys contain the effective dates and filters of the periods,
+        but not the modification date of the instance, so modifying a period
+        does not invalidate the partial results of the other ones. """
+        self.ensure_one()
+        cr = self.env.cr
+        report = self.report_id
+        if report.query_ids:
+            # queries read models whose changes do not
+            # modify the ledger version
+            return None
+        if is_ledger_changed(cr):
+            # do not share results including uncommitted journal items
+            return None
+        instance_key = (
+            cr.dbname,
+            self.id,
+            self.company_id.id,
+            self.target_move,
+            self.env.uid,
+            self.env.context.get('tz'),
+            # record rules of journal items depend on the user company
+            self.env.user.company_id.id,
+            tuple(self.env.user.company_ids.ids),
+            report._get_template_version(),
+            get_ledger_version(cr),
+        )
+        return [
+            instance_key + (
+                period.id,
+                period.date_from,
+                period.date_to,
+                tuple(period.subkpi_ids.ids),
+                repr(period._get_additional_move_line_filter()),
+            )
+            for period in self.period_ids
+        ]
+
+    @api.multi
+    def _get_template_version(self):
+        """ Return the last modification date of the instance and its
+        periods, and the version of the report template """
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT GREATEST(
+                (SELECT write_date FROM mis_report_instance
+                 WHERE id = %(instance_id)s),
+                (SELECT MAX(write_date) FROM mis_report_instance_period
+                 WHERE report_instance_id = %(instance_id)s)
+            )
+        """, {'instance_id': self.id})
+        return (self.env.cr.fetchone()[0],
+                self.report_id._get_template_version())
+
+    @api.multi
+    def _get_cache_key(self):
+        """ Return the key of the result of compute() in the kpi matrix
+        cache, or None if the result must not be cached. """
+        self.ensure_one()
+        cr = self.env.cr
+        if self.report_id.query_ids:
+            # queries read models whose changes do not
+            # modify the ledger version
+            return None
+        if is_ledger_changed(cr):
+            # do not share results including uncommitted journal items
+            return None
+        periods = tuple(
+            (period.id, period.date_from, period.date_to,
+             repr(period._get_additional_move_line_filter()))
+            for period in self.period_ids
+        )
+        return (
+            cr.dbname,
+            self.id,
+            periods,
+            self.target_move,
+            # record rules of journal items depend on the user
+            # and their current company
+            self.env.uid,
+            self.env.user.company_id.id,
+            self.env.user.lang,
+            self.env.context.get('lang'),
+            tuple(self.env.user.company_ids.ids),
+            self._get_template_version(),
+            get_ledger_version(cr),
+        )
+
     @api.multi
     def compute(self):
         self.ensure_one()
+        cache_key = self._get_cache_key()
+        if cache_key is not None:
+            res = kpi_matrix_cache.get(cache_key)
+            if res is not None:
+                return res
         kpi_matrix = self._compute_matrix()
-        return kpi_matrix.as_dict()
+        res = kpi_matrix.as_dict()
+        if cache_key is not None:
+            kpi_matrix_cache.set(cache_key, res)
+        return res
+
+    @api.multi
+    def _get_drilldown_cache_key(self):
+        """ Return the current account ids of the company, which must be
+        the ones the cached accounts were resolved with, and the key of the
+        resolved accounts in the drilldown cache. """
+        self.ensure_one()
+        # the sorted account codes are cached until accounts change
+        account_ids = self.env['account.account']._get_mis_sorted_codes(
+            self.company_id.id)[1]
+        return account_ids, (
+            self.env.cr.dbname,
+            self.report_id.id,
+            self.company_id.id,
+            self.report_id._get_template_version(),
+        )
+
+    @api.multi
+    def _set_drilldown_aep(self, aep):
+        """ Keep the accounts resolved by the processor used to compute
+        the report, for drilldown. """
+        account_ids, cache_key = self._get_drilldown_cache_key()
+        drilldown_cache.set(cache_key,
+                            (account_ids, aep.get_account_ids_index()))
+
+    @api.multi
+    def _get_drilldown_aep(self):
+        """ Return a processor to build drilldown domains, reusing the
+        accounts resolved when the report was computed if they did not
+        change since. """
+        account_ids, cache_key = self._get_drilldown_cache_key()
+        cached = drilldown_cache.get(cache_key)
+        if cached is None or cached[0] is not account_ids:
+            aep = self.report_id._prepare_aep(self.company_id)
+            self._set_drilldown_aep(aep)
+            return aep
+        aep = AEP(self.company_id)
+        aep.set_account_ids_index(cached[1])
+        return aep
 
     @api.multi
     def drilldown(self, arg):
@@ -399,9 +648,7 @@ class MisReportInstance(models.Model):
         account_id = arg.get('account_id')
         if period_id and expr and AEP.has_account_var(expr):
             period = self.env['mis.report.instance.period'].browse(period_id)
-            aep = AEP(self.company_id)
-            aep.parse_expr(expr)
-            aep.done_parsing()
+            aep = self._get_drilldown_aep()
             domain = aep.get_aml_domain_for_expr(
                 expr,
                 period.date_from, period.date_to,
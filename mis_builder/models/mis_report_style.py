@@ -3,12 +3,18 @@
 # © 2016 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models, _
+import ast
+import logging
+import re
+
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import UserError
 
 from .accounting_none import AccountingNone
 from .data_error import DataError
 
+_logger = logging.getLogger(__name__)
+
 
 class PropertyDict(dict):
 
@@ -19,6 +25,150 @@ class PropertyDict(dict):
         return PropertyDict(self)
 
 
+class StyleRegistry(object):
+    """ The styles used by a KpiMatrix and its exports.
+
+    All styles are loaded once, and merged style properties as well
+    as their css and xlsx conversions are memoized, so styling many cells
+    does not search styles nor merge them again.
+    """
+
+    def __init__(self, style_model):
+        self._style_model = style_model
+        # {style name: mis.report.style}
+        self._styles_by_name = None
+        # {(props key, style name): PropertyDict or None}
+        self._merged = {}
+        # {props key: PropertyDict}
+        self._interned = {}
+        # {(props key, no_indent): css style}
+        self._css_styles = {}
+        # {(props key, no_indent): xlsx style dict}
+        self._xlsx_styles = {}
+
+    @staticmethod
+    def props_key(props):
+        """ A hashable key identifying style properties """
+        return tuple(sorted(props.items()))
+
+    def intern(self, props):
+        """ Return a shared PropertyDict equal to props, so that
+        cells with the same style properties reference the same one.
+        The result must not be modified. """
+        return self._interned.setdefault(self.props_key(props), props)
+
+    def get_style(self, name):
+        """ Return the style with a given name, or None """
+        if self._styles_by_name is None:
+            self._styles_by_name = {}
+            for style in self._style_model.search([]):
+                self._styles_by_name.setdefault(style.name, style)
+        return self._styles_by_name.get(name)
+
+    def merge_named(self, props, style_name):
+        """ Merge style properties with the style named style_name,
+        giving priority to the latter.
+
+        Returns a PropertyDict, or None if there is no such style.
+        The result is shared and must not be modified.
+        """
+        key = (self.props_key(props), style_name)
+        try:
+            return self._merged[key]
+        except KeyError:
+            pass
+        style = self.get_style(style_name)
+        if style:
+            res = self.intern(self._style_model.merge([props, style]))
+        else:
+            _logger.error("Style '%s' not found.", style_name)
+            res = None
+        self._merged[key] = res
+        return res
+
+    def to_css_style(self, props, no_indent=False):
+        key = (self.props_key(props), no_indent)
+        try:
+            return self._css_styles[key]
+        except KeyError:
+            pass
+        res = self._style_model.to_css_style(props, no_indent)
+        self._css_styles[key] = res
+        return res
+
+    def to_xlsx_style(self, props, no_indent=False):
+        """ Return a new dictionary of xlsx format properties """
+        key = (self.props_key(props), no_indent)
+        try:
+            res = self._xlsx_styles[key]
+        except KeyError:
+            res = self._style_model.to_xlsx_style(props, no_indent)
+            self._xlsx_styles[key] = res
+        return dict(res)
+
+
+class NumberRenderer(object):
+    """ Render numbers like MisReportKpiStyle.render_num() does with
+    res.lang.format(), with the format string, grouping and separators
+    of the language computed once.
+
+    >>> r = NumberRenderer('[3,0]', ',', '.', dp=2, suffix='EUR')
+    >>> r(-1234567.891) == u'\N{NON-BREAKING HYPHEN}1,234,567.89\xa0EUR'
+    True
+    >>> r = NumberRenderer('[3,2,-1]', '.', ',', divider=1000, sign='+')
+    >>> r(123456789) == u'+1.23.457'
+    True
+    >>> NumberRenderer('[]', '', '.', dp=1)(1234.56) == u'1234.6'
+    True
+    """
+
+    _intersperse_re = re.compile('([^0-9]*)([^ ]*)(.*)')
+
+    def __init__(self, grouping, thousands_sep, decimal_point,
+                 divider=1.0, dp=0, prefix=None, suffix=None, sign='-'):
+        self.counts = ast.literal_eval(grouping)
+        self.thousands_sep = thousands_sep or u''
+        self.decimal_point = decimal_point
+        self.divider = float(divider or 1)
+        self.dp = dp or 0
+        self.fmt = '%%%s.%df' % (sign, self.dp)
+        self.prefix = prefix and prefix + u'\N{NO-BREAK SPACE}' or u''
+        self.suffix = suffix and u'\N{NO-BREAK SPACE}' + suffix or u''
+
+    def _group(self, s):
+        # same as res_lang.intersperse(s, self.counts, self.thousands_sep)
+        left, rest, right = self._intersperse_re.match(s).groups()
+        groups = []
+        end = len(rest)
+        saved_count = end
+        for count in self.counts:
+            if end <= 0 or count == -1:
+                break
+            if count == 0:
+                while end > 0:
+                    groups.append(rest[max(end - saved_count, 0):end])
+                    end -= saved_count
+                break
+            groups.append(rest[max(end - count, 0):end])
+            end -= count
+            saved_count = count
+        if end > 0:
+            groups.append(rest[:end])
+        groups.reverse()
+        return left + self.thousands_sep.join(groups) + right
+
+    def __call__(self, value):
+        if value is None or value is AccountingNone:
+            return u''
+        value = round(value / self.divider, self.dp) or 0
+        int_part, dot, dec_part = (self.fmt % value).partition('.')
+        r = self._group(int_part)
+        if dot:
+            r = r + self.decimal_point + dec_part
+        r = r.replace('-', u'\N{NON-BREAKING HYPHEN}')
+        return self.prefix + r + self.suffix
+
+
 PROPS = [
     'color',
     'background_color',
@@ -171,14 +321,15 @@ class MisReportKpiStyle(models.Model):
         # format number following user language
         if value is None or value is AccountingNone:
             return u''
-        value = round(value / float(divider or 1), dp or 0) or 0
-        r = lang.format('%%%s.%df' % (sign, dp or 0), value, grouping=True)
-        r = r.replace('-', u'\N{NON-BREAKING HYPHEN}')
-        if prefix:
-            r = prefix + u'\N{NO-BREAK SPACE}' + r
-        if suffix:
-            r = r + u'\N{NO-BREAK SPACE}' + suffix
-        return r
+        return self._get_number_renderer(
+            lang, divider, dp, prefix, suffix, sign)(value)
+
+    @tools.ormcache('lang.id', 'divider', 'dp', 'prefix', 'suffix', 'sign')
+    def _get_number_renderer(self, lang, divider, dp, prefix, suffix, sign):
+        # the cache is cleared when languages are modified
+        return NumberRenderer(lang.grouping, lang.thousands_sep,
+                              lang.decimal_point,
+                              divider, dp, prefix, suffix, sign)
 
     @api.model
     def render_pct(self, lang, value, dp=1, sign='-'):
@@ -195,10 +346,32 @@ class MisReportKpiStyle(models.Model):
     def compare_and_render(self, lang, style_props, type, compare_method,
                            value, base_value,
                            average_value=1, average_base_value=1):
+        delta, style_r = self.compare(style_props, type, compare_method,
+                                      value, base_value,
+                                      average_value, average_base_value)
+        if delta is not AccountingNone:
+            delta_r = self.render_num(
+                lang, delta,
+                style_r.divider, style_r.dp,
+                style_r.prefix, style_r.suffix,
+                sign='+')
+            return delta, delta_r, style_r
+        else:
+            return AccountingNone, '', style_r
+
+    @api.model
+    def compare(self, style_props, type, compare_method,
+                value, base_value,
+                average_value=1, average_base_value=1):
+        """ Compare value to base_value, without rendering the result.
+
+        Returns the delta and the style properties to render it with
+        render_num(..., sign='+').
+        """
         delta = AccountingNone
         style_r = style_props.copy()
         if isinstance(value, DataError) or isinstance(base_value, DataError):
-            return AccountingNone, '', style_r
+            return AccountingNone, style_r
         if value is None:
             value = AccountingNone
         if base_value is None:
@@ -229,15 +402,7 @@ class MisReportKpiStyle(models.Model):
                             divider=0.01, dp=1, prefix='', suffix='%'))
                     else:
                         delta = AccountingNone
-        if delta is not AccountingNone:
-            delta_r = self.render_num(
-                lang, delta,
-                style_r.divider, style_r.dp,
-                style_r.prefix, style_r.suffix,
-                sign='+')
-            return delta, delta_r, style_r
-        else:
-            return AccountingNone, '', style_r
+        return delta, style_r
 
     @api.model
     def to_xlsx_style(self, props, no_indent=False):
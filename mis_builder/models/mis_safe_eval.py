@@ -2,32 +2,59 @@
 # © 2016 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
-import traceback
-
+from odoo.tools.lru import LRU
 from odoo.tools.safe_eval import test_expr, _SAFE_OPCODES, _BUILTINS
 
 from .data_error import DataError, NameDataError
 
 
-__all__ = ['mis_safe_eval']
+__all__ = ['mis_safe_eval', 'mis_safe_compile']
+
+
+# {expression: code object}
+_compiled_exprs = LRU(8192)
+
+
+def mis_safe_compile(expr):
+    """ Compile an expression, checking it with safe_eval's opcode
+    whitelist.
+
+    The resulting code object is cached by expression text, so
+    a given expression is parsed and validated only once.
+
+    Raises the same exceptions as safe_eval's test_expr.
+    """
+    try:
+        return _compiled_exprs[expr]
+    except KeyError:
+        pass
+    c = test_expr(expr, _SAFE_OPCODES, mode='eval')
+    _compiled_exprs[expr] = c
+    return c
 
 
 def mis_safe_eval(expr, locals_dict):
     """ Evaluate an expression using safe_eval
 
+    expr may be an expression string or a code object obtained
+    with mis_safe_compile().
+
     Returns the evaluated value or DataError.
 
     Raises NameError if the evaluation depends on a variable that is not
     present in local_dict.
     """
     try:
-        c = test_expr(expr, _SAFE_OPCODES, mode='eval')
+        if isinstance(expr, basestring):
+            c = mis_safe_compile(expr)
+        else:
+            c = expr
         globals_dict = {'__builtins__': _BUILTINS}
         val = eval(c, globals_dict, locals_dict)  # pylint: disable=eval-used
     except NameError:
-        val = NameDataError('#NAME', traceback.format_exc())
+        val = NameDataError.from_exc('#NAME')
     except ZeroDivisionError:
-        val = DataError('#DIV/0', traceback.format_exc())
+        val = DataError.from_exc('#DIV/0')
     except:
-        val = DataError('#ERR', traceback.format_exc())
+        val = DataError.from_exc('#ERR')
     return val
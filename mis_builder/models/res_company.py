@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# © 2017 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+from .kpi_matrix_cache import signal_ledger_change
+
+# res.company fields used to compute reports
+LEDGER_FIELDS = {
+    'currency_id',
+    'fiscalyear_last_day',
+    'fiscalyear_last_month',
+    'parent_id',
+}
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    @api.multi
+    def write(self, vals):
+        if LEDGER_FIELDS.intersection(vals):
+            signal_ledger_change(self.env.cr)
+        return super(ResCompany, self).write(vals)
@@ -50,10 +50,14 @@ SimpleArray((6.0, 7.0, 8.0))
 SimpleArray((1.0, DataError(), 3.0))
 >>> a / 0.0
 SimpleArray((DataError(), DataError(), DataError()))
+>>> (a / ((1.0, 0.0, 1.0)))[1].name
+'#DIV/0'
+>>> (SimpleArray((DataError('#ERR', ''), 1.0)) + 1)[1]
+2.0
 """
 
+from itertools import izip
 import operator
-import traceback
 
 from .data_error import DataError
 
@@ -64,23 +68,33 @@ __all__ = ['SimpleArray']
 # TODO named tuple-like behaviour, so expressions can work on subkpis
 
 
+def _op_element(op, x, y):
+    try:
+        return op(x, y)
+    except ZeroDivisionError:
+        return DataError.from_exc('#DIV/0')
+    except:
+        return DataError.from_exc('#ERR')
+
+
 class SimpleArray(tuple):
 
     def _op(self, op, other):
-        def _o2(x, y):
-            try:
-                return op(x, y)
-            except ZeroDivisionError:
-                return DataError('#DIV/0', traceback.format_exc())
-            except:
-                return DataError('#ERR', traceback.format_exc())
-
         if isinstance(other, tuple):
             if len(other) != len(self):
                 raise TypeError("tuples must have same length for %s" % op)
-            return SimpleArray(map(_o2, self, other))
+            try:
+                # fast path, when no element raises an error
+                return SimpleArray(map(op, self, other))
+            except:
+                return SimpleArray(
+                    [_op_element(op, x, y) for x, y in izip(self, other)])
         else:
-            return SimpleArray(map(lambda z: _o2(z, other), self))
+            try:
+                return SimpleArray([op(x, other) for x in self])
+            except:
+                return SimpleArray(
+                    [_op_element(op, x, other) for x in self])
 
     def __add__(self, other):
         return self._op(operator.add, other)
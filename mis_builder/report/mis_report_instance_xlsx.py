@@ -28,6 +28,35 @@ MIN_COL_WIDTH = 10  # characters
 MAX_COL_WIDTH = 50  # characters
 
 
+class XlsxFormatPool(object):
+    """ The formats of a workbook, created once for each distinct
+    resolved style, instead of once for each cell. """
+
+    def __init__(self, workbook, style_registry):
+        self._workbook = workbook
+        self._style_registry = style_registry
+        # {(props key, no_indent, extra items): format}
+        self._formats = {}
+
+    def get_format(self, style_props, no_indent=False, **extra):
+        """ Return the format of style properties, with extra xlsx
+        format properties """
+        key = (self._style_registry.props_key(style_props), no_indent,
+               tuple(sorted(extra.items())))
+        try:
+            return self._formats[key]
+        except KeyError:
+            pass
+        xlsx_style = self._style_registry.to_xlsx_style(
+            style_props, no_indent)
+        xlsx_style.update(extra)
+        fmt = self._formats[key] = self._workbook.add_format(xlsx_style)
+        return fmt
+
+    def __len__(self):
+        return len(self._formats)
+
+
 class MisBuilderXlsx(ReportXlsx):
 
     def __init__(self, name, table, rml=False, parser=False, header=True,
@@ -35,11 +64,15 @@ class MisBuilderXlsx(ReportXlsx):
         super(MisBuilderXlsx, self).__init__(
             name, table, rml, parser, header, store)
 
+    def get_workbook_options(self):
+        # rows are written in order, so they can be flushed as we go
+        return {'constant_memory': True}
+
     def generate_xlsx_report(self, workbook, data, objects):
 
         # get the computed result of the report
         matrix = objects._compute_matrix()
-        style_obj = self.env['mis.report.style']
+        formats = XlsxFormatPool(workbook, matrix.style_registry)
 
         # create worksheet
         report_name = u'{} - {}'.format(
@@ -49,7 +82,7 @@ class MisBuilderXlsx(ReportXlsx):
         col_pos = 0
         # width of the labels column
         label_col_width = MIN_COL_WIDTH
-        # {col_pos: max width in characters}
+        # {col_pos: max width in characters}, updated as rows are written
         col_width = defaultdict(lambda: MIN_COL_WIDTH)
 
         # document title
@@ -97,8 +130,7 @@ class MisBuilderXlsx(ReportXlsx):
 
         # rows
         for row in matrix.iter_rows():
-            row_xlsx_style = style_obj.to_xlsx_style(row.style_props)
-            row_format = workbook.add_format(row_xlsx_style)
+            row_format = formats.get_format(row.style_props)
             col_pos = 0
             label = row.label
             if row.description:
@@ -114,10 +146,8 @@ class MisBuilderXlsx(ReportXlsx):
                     # TODO col/subcol format
                     sheet.write(row_pos, col_pos, '', row_format)
                     continue
-                cell_xlsx_style = style_obj.to_xlsx_style(
-                    cell.style_props, no_indent=True)
-                cell_xlsx_style['align'] = 'right'
-                cell_format = workbook.add_format(cell_xlsx_style)
+                cell_format = formats.get_format(
+                    cell.style_props, no_indent=True, align='right')
                 if isinstance(cell.val, DataError):
                     val = cell.val.name
                     # TODO display cell.val.msg as Excel comment?
@@ -130,12 +160,14 @@ class MisBuilderXlsx(ReportXlsx):
                                          len(cell.val_rendered or ''))
             row_pos += 1
 
-        # adjust col widths
+        # adjust col widths; column definitions are written when the
+        # workbook is closed, so this works in constant memory mode
         sheet.set_column(0, 0, min(label_col_width, MAX_COL_WIDTH) * COL_WIDTH)
         data_col_width = min(MAX_COL_WIDTH, max(col_width.values()))
         min_col_pos = min(col_width.keys())
         max_col_pos = max(col_width.keys())
         sheet.set_column(min_col_pos, max_col_pos, data_col_width * COL_WIDTH)
+        _logger.debug("%s formats for %s rows", len(formats), row_pos)
 
 
 MisBuilderXlsx('report.mis.report.instance.xlsx',
@@ -117,6 +117,22 @@ class TestAEP(common.TransactionCase):
             res[account_id] = safe_eval(replaced_exprs[0], eval_dict)
         return res
 
+    def _eval_substituted(self, expr):
+        substituted_expr, _ = self.aep.substitute_vars(expr)
+        eval_dict = {'AccountingNone': AccountingNone}
+        eval_dict.update(self.aep.get_vars_values())
+        return safe_eval(substituted_expr, eval_dict)
+
+    def _eval_substituted_by_account_id(self, expr):
+        res = {}
+        substituted_expr, var_names = self.aep.substitute_vars(expr)
+        for account_id, vars_values in \
+                self.aep.iter_vars_values_by_account_id(var_names):
+            eval_dict = {'AccountingNone': AccountingNone}
+            eval_dict.update(vars_values)
+            res[account_id] = safe_eval(substituted_expr, eval_dict)
+        return res
+
     def test_sanity_check(self):
         self.assertEquals(self.company.fiscalyear_last_day, 31)
         self.assertEquals(self.company.fiscalyear_last_month, 12)
@@ -192,6 +208,107 @@ class TestAEP(common.TransactionCase):
             self.account_ar.id: 900,
             self.account_in.id: -800,
         })
+        # each account only contributes to the variables involving it
+        variation = self._eval_by_account_id('balp[400AR] + balp[700IN]')
+        self.assertEquals(variation, {
+            self.account_ar.id: 500,
+            self.account_in.id: -500,
+        })
+        variation = self._eval_by_account_id('balp[400AR] - balp[]')
+        self.assertEquals(variation, {
+            self.account_ar.id: 0,
+            self.account_in.id: 500,
+        })
+
+    def test_aep_substitute_vars(self):
+        exprs = [
+            'bali[400AR]', 'balp[400AR]', 'bale[400AR]',
+            'bali[700IN]', 'balp[700IN]', 'bale[700IN]',
+            'crdp[700I%]', 'debp[400A%]', 'bal_700IN', 'bals[700IN]',
+            'balu[]', 'balp[400AR] + bale[700IN] * 2',
+        ]
+        substituted_expr, var_names = \
+            self.aep.substitute_vars('balp[400AR] + bale[700IN] * 2')
+        self.assertEquals(len(var_names), 2)
+        self.assertFalse(AEP.has_account_var(substituted_expr))
+        # the same variable always gets the same name
+        self.assertEquals(self.aep.substitute_vars('bale[700IN]')[1],
+                          var_names[1:])
+        for month in (1, 3):
+            self._do_queries(
+                datetime.date(self.curr_year, month, 1),
+                datetime.date(self.curr_year, month, 31))
+            for expr in exprs:
+                self.assertEquals(self._eval_substituted(expr),
+                                  self._eval(expr))
+            for expr in ('balp[]', 'bale[]', 'balp[700IN]',
+                         'balp[400AR] + bale[700IN] * 2'):
+                self.assertEquals(self._eval_substituted_by_account_id(expr),
+                                  self._eval_by_account_id(expr))
+
+    def test_aep_multi_periods(self):
+        periods = [
+            (datetime.date(self.prev_year, 12, 1),
+             datetime.date(self.prev_year, 12, 31)),
+            (datetime.date(self.curr_year, 1, 1),
+             datetime.date(self.curr_year, 1, 31)),
+            (datetime.date(self.curr_year, 1, 1),
+             datetime.date(self.curr_year, 3, 31)),
+            (datetime.date(self.curr_year, 3, 1),
+             datetime.date(self.curr_year, 3, 31)),
+        ]
+        # reference data, queried period by period
+        expected = []
+        for date_from, date_to in periods:
+            self._do_queries(date_from, date_to)
+            expected.append({key: value
+                             for key, value in self.aep._data.items()
+                             if value})
+        # same data, queried with one query for all periods
+        self.aep.do_queries_multi([
+            (fields.Date.to_string(date_from),
+             fields.Date.to_string(date_to),
+             None)
+            for date_from, date_to in periods
+        ], 'posted')
+        for (date_from, date_to), data in zip(periods, expected):
+            self._do_queries(date_from, date_to)
+            self.assertEquals({key: value
+                               for key, value in self.aep._data.items()
+                               if value}, data)
+
+    def test_aep_account_codes(self):
+        # same accounts as a search on account codes
+        for account_code in ('400AR', '400A%', '4%', '%AR', '7_0%', '%',
+                             '400', '400AR%', '999%'):
+            aep = AEP(self.company)
+            aep._load_account_codes([account_code])
+            self.assertEquals(
+                aep._account_ids_by_code[account_code],
+                set(self.account_model.search([
+                    ('code', '=like', account_code),
+                    ('company_id', '=', self.company.id)]).ids),
+                account_code)
+        # without %, _ is not a wildcard, as 400_R is not a like pattern
+        aep = AEP(self.company)
+        aep._load_account_codes(['400_R'])
+        self.assertFalse(aep._account_ids_by_code['400_R'])
+        # a new account invalidates the cached account codes
+        account_ar2 = self.account_model.create({
+            'company_id': self.company.id,
+            'code': '400AR2',
+            'name': 'Receivable 2',
+            'user_type_id': self.account_ar.user_type_id.id,
+            'reconcile': True})
+        aep = AEP(self.company)
+        aep._load_account_codes(['400A%', '400AR2', None])
+        self.assertEquals(aep._account_ids_by_code['400A%'],
+                          {self.account_ar.id, account_ar2.id})
+        self.assertEquals(aep._account_ids_by_code['400AR2'],
+                          {account_ar2.id})
+        self.assertEquals(aep._account_ids_by_code[None],
+                          set(self.account_model.search([
+                              ('company_id', '=', self.company.id)]).ids))
 
     def test_aep_convenience_methods(self):
         initial = AEP.get_balances_initial(
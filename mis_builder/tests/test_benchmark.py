@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import logging
+import operator
+import sys
+import time
+import timeit
+
+import odoo.tests.common as common
+
+from ..models.aep import AccountingExpressionProcessor as AEP
+from ..models.accounting_none import AccountingNone
+from ..models.data_error import DataError
+from ..models.simple_array import SimpleArray, _op_element
+from ..models.mis_report import KpiMatrix
+from ..models.mis_safe_eval import _compiled_exprs, mis_safe_eval
+
+_logger = logging.getLogger(__name__)
+
+
+def _storage_size(obj, shared):
+    """ Size of the containers and cell objects of a storage, without
+    the values they reference (numbers, rows, styles, drilldown arguments),
+    which are the same whatever the storage. """
+    if id(obj) in shared:
+        return 0
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + \
+            sum(_storage_size(v, shared) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + \
+            sum(_storage_size(v, shared) for v in obj)
+    if isinstance(obj, _DictCell):
+        return sys.getsizeof(obj) + _storage_size(obj.__dict__, shared)
+    return 0
+
+
+class _DictCell(object):
+    # KpiMatrixCell, as it was stored before the columnar storage
+
+    def __init__(self, cell):
+        self.row = cell.row
+        self.subcol = cell.subcol
+        self.val = cell.val
+        self.val_rendered = None
+        self.val_comment = None
+        self.style_props = cell.style_props
+        self.drilldown_arg = cell.drilldown_arg
+
+
+class TestBenchmark(common.TransactionCase):
+    """ Compare the performance of alternative evaluation strategies.
+
+    Timings are logged, and the tests only check that all strategies
+    give the same results, so they remain reliable on slow machines.
+    """
+
+    PERIODS = 24
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.company = self.env.ref('base.main_company')
+        self.exprs = []
+        for code in ('1', '2', '4', '6', '7'):
+            self.exprs.extend([
+                'balp[{c}%]'.format(c=code),
+                'bale[{c}%] - bali[{c}%]'.format(c=code),
+                'crdp[{c}%] + debp[{c}%] * 2'.format(c=code),
+                '(balp[{c}%] or 1) / (bale[{c}%] or 1)'.format(c=code),
+            ])
+        self.aep = AEP(self.company)
+        for expr in self.exprs:
+            self.aep.parse_expr(expr)
+        self.aep.done_parsing()
+        self.aep.do_queries('2016-01-01', '2016-12-31', 'all')
+
+    def _time(self, label, f):
+        start = time.time()
+        res = f()
+        _logger.info('%s: %.3fs', label, time.time() - start)
+        return res
+
+    def test_benchmark_compiled_exprs(self):
+        def replace_path():
+            res = []
+            for _ in range(self.PERIODS):
+                # the replaced expressions hold the values of each period,
+                # so they used to be compiled again for each period
+                _compiled_exprs.clear()
+                locals_dict = {'AccountingNone': AccountingNone}
+                res.append([
+                    mis_safe_eval(self.aep.replace_expr(expr), locals_dict)
+                    for expr in self.exprs
+                ])
+            return res
+
+        def substitute_path():
+            res = []
+            for _ in range(self.PERIODS):
+                locals_dict = {'AccountingNone': AccountingNone}
+                substituted_exprs = [self.aep.substitute_vars(expr)[0]
+                                     for expr in self.exprs]
+                locals_dict.update(self.aep.get_vars_values())
+                res.append([
+                    mis_safe_eval(expr, locals_dict)
+                    for expr in substituted_exprs
+                ])
+            return res
+
+        res1 = self._time('string replace path', replace_path)
+        res2 = self._time('compiled expressions path', substitute_path)
+        self.assertEquals(res1, res2)
+
+    def test_benchmark_parse_cache(self):
+        stats = AEP.parse_stats
+        hits, misses = stats['hits'], stats['misses']
+        # what a report instance does, with one processor per computation
+        for _ in range(self.PERIODS):
+            aep = AEP(self.company)
+            for expr in self.exprs:
+                aep.parse_expr(expr)
+            aep.done_parsing()
+            for expr in self.exprs:
+                aep.substitute_vars(expr)
+                aep.get_aml_domain_for_expr(
+                    expr, '2016-01-01', '2016-12-31', 'all')
+        hits = stats['hits'] - hits
+        misses = stats['misses'] - misses
+        _logger.info('accounting variables parse cache: '
+                     '%s parses saved, %s parses done', hits, misses)
+        # each distinct variable is parsed at most once
+        variables = set(mo.group(0)
+                        for expr in self.exprs
+                        for mo in AEP._ACC_RE.finditer(expr))
+        self.assertTrue(misses <= len(variables))
+        self.assertTrue(hits > misses)
+
+    def test_benchmark_simple_array(self):
+        a = SimpleArray((1.0, 2.0, AccountingNone))
+        b = SimpleArray((4.0, AccountingNone, 6.0))
+        c = SimpleArray((0.0, 1.0, DataError('#ERR', '')))
+        for op in (operator.add, operator.sub, operator.mul,
+                   operator.div, operator.truediv):
+            for x, y in ((a, b), (a, c), (a, 2.0), (a, 0.0)):
+                # same results as the element by element path
+                expected = SimpleArray(
+                    [_op_element(op, xi, yi) for xi, yi in
+                     zip(x, y if isinstance(y, tuple) else [y] * len(x))])
+                res = x._op(op, y)
+                self.assertEquals(len(res), len(expected))
+                for r, e in zip(res, expected):
+                    if isinstance(e, DataError):
+                        self.assertEquals(r.name, e.name)
+                    else:
+                        self.assertEquals(r, e)
+            _logger.info(
+                'SimpleArray %s: %.3fs (arrays), %.3fs (scalar), '
+                '%.3fs (errors)', op.__name__,
+                timeit.timeit(lambda: op(a, b), number=10000),
+                timeit.timeit(lambda: op(a, 2.0), number=10000),
+                timeit.timeit(lambda: op(a, c), number=10000))
+
+    def test_benchmark_matrix_memory(self):
+        report = self.env['mis.report'].create(dict(
+            name='benchmark report',
+            kpi_ids=[(0, 0, dict(
+                name='k1',
+                description='kpi 1',
+                expression='balp[%]',
+                auto_expand_accounts=True,
+            ))],
+        ))
+        # kpi records are still accepted
+        kpi = report.kpi_ids
+        matrix = KpiMatrix(self.env)
+        matrix.declare_kpi(kpi)
+        for period in range(self.PERIODS):
+            matrix.declare_col(period, str(period), '', {}, None)
+        for period in range(self.PERIODS):
+            if period:
+                matrix.declare_comparison(period, period - 1)
+        for account_id in range(1, 1001):
+            for period in range(self.PERIODS):
+                matrix.set_values_detail_account(
+                    kpi, period, account_id, [float(account_id * period)],
+                    [{'period_id': period, 'account_id': account_id}])
+        matrix.compute_comparisons()
+        cols = list(matrix.iter_cols())
+        shared = set()
+        for col in cols:
+            for subcol in col.iter_subcols():
+                shared.update(id(v) for v in subcol._styles_props)
+                shared.update(id(v) for v in subcol._drilldown_args)
+        columnar_size = sum(
+            _storage_size(col._row_index, shared) +
+            _storage_size(col._rows, shared) +
+            sum(_storage_size(subcol._vals, shared) +
+                _storage_size(subcol._vals_rendered, shared) +
+                _storage_size(subcol._styles_props, shared) +
+                _storage_size(subcol._drilldown_args, shared)
+                for subcol in col.iter_subcols())
+            for col in cols)
+        # the same cells, as one object per cell in dicts by row
+        cells_by_row_by_col = [
+            {cell_tuple[0].row: tuple(_DictCell(c) for c in cell_tuple)
+             for cell_tuple in col.iter_cell_tuples()}
+            for col in cols]
+        objects_size = _storage_size(cells_by_row_by_col, shared)
+        _logger.info('KpiMatrix storage of %s cells: %.1f MB as objects, '
+                     '%.1f MB as columns',
+                     sum(len(c) for c in cells_by_row_by_col),
+                     objects_size / 1e6, columnar_size / 1e6)
+        self.assertTrue(columnar_size < objects_size)
+        # comparison styles are interned
+        styles = set(id(cell.style_props) for col in cols
+                     for subcol in col.iter_subcols()
+                     for cell in subcol.iter_cells())
+        self.assertTrue(len(styles) < 10)
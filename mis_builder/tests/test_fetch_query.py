@@ -38,3 +38,58 @@ class TestFetchQuery(common.TransactionCase):
                    },
                   ],
              }, data)
+
+    def test_fetch_queries_multi(self):
+        analytic_account = self.env['account.analytic.account'].create(dict(
+            name='mis test',
+        ))
+        for date, amount, unit_amount in [('2017-01-05', 10.0, 1.0),
+                                          ('2017-01-20', -4.0, 0.0),
+                                          ('2017-02-10', 7.5, 3.0),
+                                          ('2017-03-31', 1.0, 2.0)]:
+            self.env['account.analytic.line'].create(dict(
+                name='mis test',
+                account_id=analytic_account.id,
+                date=date,
+                amount=amount,
+                unit_amount=unit_amount,
+            ))
+        fields = self.env['ir.model.fields'].search([
+            ('model', '=', 'account.analytic.line'),
+            ('name', 'in', ('amount', 'unit_amount', 'date')),
+        ])
+        date_field = fields.filtered(lambda f: f.name == 'date')
+        model = self.env.ref('analytic.model_account_analytic_line')
+        report = self.env['mis.report'].create(dict(
+            name='test report',
+            query_ids=[(0, 0, dict(
+                name='q' + aggregate,
+                model_id=model.id,
+                field_ids=[(6, 0, (fields - date_field).ids)],
+                date_field=date_field.id,
+                aggregate=aggregate,
+                domain="[('account_id', '=', %d)]" % analytic_account.id,
+            )) for aggregate in ('sum', 'min', 'max', 'avg')],
+        ))
+        periods = [('2017-01-01', '2017-01-31'),
+                   ('2017-01-01', '2017-03-31'),
+                   ('2017-02-01', '2017-02-28'),
+                   ('2016-01-01', '2016-12-31')]
+        res = report._fetch_queries_multi([
+            (date_from, date_to, None) for date_from, date_to in periods])
+        # same results as when querying period by period in python
+        for (date_from, date_to), r in zip(periods, res):
+            expected = report._fetch_queries(date_from, date_to)
+            self.assertEquals(sorted(r.keys()), sorted(expected.keys()))
+            for name in expected:
+                self.assertEquals(r[name].count, expected[name].count)
+                if not r[name].count:
+                    continue
+                for field_name in ('amount', 'unit_amount'):
+                    self.assertAlmostEqual(
+                        getattr(r[name], field_name),
+                        getattr(expected[name], field_name))
+        self.assertEquals(res[1]['qmin'].amount, -4.0)
+        self.assertEquals(res[1]['qavg'].unit_amount, 1.5)
+        self.assertEquals(res[3]['qsum'].count, 0)
+        self.assertTrue(res[3]['qmax'].amount is None)
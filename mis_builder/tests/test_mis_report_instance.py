@@ -2,9 +2,27 @@
 # © 2016 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import io
+
+import xlsxwriter
+
 import odoo.tests.common as common
+from odoo.exceptions import UserError
 from odoo.tools import test_reports
 
+from ..models.aep import AccountingExpressionProcessor as AEP
+from ..models.data_error import DataError
+from ..models.kpi_matrix_cache import (
+    compact_ledger_version,
+    drilldown_cache,
+    get_ledger_version,
+    is_ledger_changed,
+    kpi_matrix_cache,
+    period_cache,
+    signal_ledger_change,
+)
+from ..report.mis_report_instance_xlsx import XlsxFormatPool
+
 
 class TestMisReportInstance(common.TransactionCase):
     """ Basic integration test to exercise mis.report.instance.
@@ -128,6 +146,252 @@ class TestMisReportInstance(common.TransactionCase):
     def test_json(self):
         self.report_instance.compute()
 
+    def test_kpis_compute_order(self):
+        kpis, cyclic_kpis = self.report._get_kpis_compute_order()
+        # k4 uses k3, which comes after it in display order
+        self.assertEquals([kpi.name for kpi in kpis],
+                          ['k1', 'k2', 'k3', 'k4', 'k5'])
+        self.assertFalse(cyclic_kpis)
+        self.env['mis.report.kpi'].create(dict(
+            report_id=self.report.id,
+            description='kpi 6',
+            name='k6',
+            expression='k7 + 1',
+        ))
+        with self.assertRaises(UserError):
+            self.env['mis.report.kpi'].create(dict(
+                report_id=self.report.id,
+                description='kpi 7',
+                name='k7',
+                expression='k6 * 2',
+            ))
+
+    def test_snapshot(self):
+        self.report.style_id = self.env['mis.report.style'].create(dict(
+            name='report style',
+            font_weight_inherit=False,
+            font_weight='bold',
+        ))
+        snapshot = self.report._get_snapshot()
+        self.assertEquals([subkpi.id for subkpi in snapshot.subkpis],
+                          self.report.subkpi_ids.ids)
+        sk1 = self.report.subkpi_ids[0]
+        self.assertEquals([subkpi.id for subkpi in
+                           snapshot.filter_subkpis(sk1)], sk1.ids)
+        self.assertEquals([kpi.id for kpi in snapshot.kpis],
+                          self.report.kpi_ids.ids)
+        # same expressions and styles as the records
+        style_model = self.env['mis.report.style']
+        for kpi, kpi_record in zip(snapshot.kpis, self.report.kpi_ids):
+            self.assertEquals(kpi.name, kpi_record.name)
+            self.assertEquals(kpi.expression, kpi_record.expression)
+            for subkpis in ([], snapshot.subkpis, snapshot.subkpis[1:]):
+                self.assertEquals(
+                    kpi._get_expressions(subkpis),
+                    kpi_record._get_expressions(
+                        self.report.subkpi_ids.browse(
+                            [subkpi.id for subkpi in subkpis])))
+            self.assertEquals(kpi.style_props, style_model.merge([
+                self.report.style_id, kpi_record.style_id]))
+            self.assertEquals(kpi.style_props.font_weight, 'bold')
+
+    def test_json_parallel(self):
+        res = self.report_instance._compute_matrix().as_dict()
+        self.report_instance.parallel_compute = True
+        period_cache.clear()
+        self.assertEquals(
+            self.report_instance._compute_matrix().as_dict(), res)
+
+    def test_json_incremental(self):
+        period_cache.clear()
+        # reports with queries are not cached
+        self.report_instance._compute_matrix()
+        self.assertEquals(period_cache.stats()['size'], 0)
+        self.report.query_ids.unlink()
+        self.report_instance._compute_matrix()
+        self.assertEquals(period_cache.stats(),
+                          {'hits': 0, 'misses': 2, 'size': 2})
+        # only the modified period is evaluated again
+        self.report_instance.period_ids[1].manual_date_to = '2014-06-30'
+        res = self.report_instance._compute_matrix().as_dict()
+        self.assertEquals(period_cache.stats(),
+                          {'hits': 1, 'misses': 3, 'size': 3})
+        period_cache.clear()
+        self.assertEquals(
+            self.report_instance._compute_matrix().as_dict(), res)
+
+    def test_drilldown(self):
+        matrix = self.report_instance._compute_matrix()
+        drilldown_args = [cell.drilldown_arg for row in matrix.iter_rows()
+                          for cell in row.iter_cells()
+                          if cell and cell.drilldown_arg]
+        self.assertTrue(drilldown_args)
+        hits = drilldown_cache.hits
+        for arg in drilldown_args:
+            action = self.report_instance.drilldown(arg)
+            # same domain as with a processor parsing the expression
+            period = self.env['mis.report.instance.period'].browse(
+                arg['period_id'])
+            aep = AEP(self.report_instance.company_id)
+            aep.parse_expr(arg['expr'])
+            aep.done_parsing()
+            self.assertEquals(action['domain'], aep.get_aml_domain_for_expr(
+                arg['expr'], period.date_from, period.date_to,
+                self.report_instance.target_move, arg.get('account_id')))
+        # the accounts resolved by the computation are reused
+        self.assertEquals(drilldown_cache.hits - hits, len(drilldown_args))
+
+    def test_render_on_demand(self):
+        matrix = self.report_instance._compute_matrix()
+        cells = [cell for row in matrix.iter_rows()
+                 for cell in row.iter_cells() if cell]
+        self.assertTrue(cells)
+        # nothing is rendered while computing
+        self.assertTrue(all(cell._val_rendered is None for cell in cells))
+        style_model = self.env['mis.report.style']
+        errors = [cell for cell in cells if cell.row.kpi.name == 'k5' and
+                  isinstance(cell.val, DataError)]
+        # k5.sk1 in both periods
+        self.assertEquals(len(errors), 2)
+        self.assertEquals(errors[0].val_rendered, '#NAME')
+        self.assertTrue('NameError' in errors[0].val_comment)
+        for cell in cells:
+            if isinstance(cell.val, DataError):
+                self.assertEquals(cell.val_rendered, cell.val.name)
+                self.assertEquals(cell.val_comment, cell.val.msg)
+            elif cell.subcol.col.locals_dict:
+                self.assertEquals(cell.val_rendered, style_model.render(
+                    matrix.lang, cell.row.style_props, cell.row.kpi.type,
+                    cell.val))
+                self.assertTrue(cell.val_comment.startswith(
+                    cell.row.kpi.name))
+            else:
+                # comparison
+                self.assertEquals(cell.val_rendered, style_model.render_num(
+                    matrix.lang, cell.val, cell.style_props.divider,
+                    cell.style_props.dp, cell.style_props.prefix,
+                    cell.style_props.suffix, sign='+'))
+                self.assertTrue(cell.val_comment is None)
+        # cells built again reuse the values rendered once
+        self.assertTrue(all(cell._val_rendered is not None
+                            for row in matrix.iter_rows()
+                            for cell in row.iter_cells() if cell))
+
+    def test_json_cache(self):
+        kpi_matrix_cache.clear()
+        # reports with queries are not cached
+        self.report_instance.compute()
+        self.assertEquals(kpi_matrix_cache.stats()['size'], 0)
+        self.report.query_ids.unlink()
+        res1 = self.report_instance.compute()
+        res2 = self.report_instance.compute()
+        self.assertEquals(res1, res2)
+        self.assertEquals(kpi_matrix_cache.hits, 1)
+        self.assertEquals(kpi_matrix_cache.misses, 1)
+        # results are not shared between users, who may not read
+        # the same journal items
+        user = self.env['res.users'].create({
+            'name': 'MIS user',
+            'login': 'mis_user',
+            'groups_id': [(6, 0, [
+                self.ref('account.group_account_manager')])],
+        })
+        self.assertNotEqual(
+            self.report_instance.sudo(user)._get_cache_key(),
+            self.report_instance._get_cache_key())
+        # results including uncommitted journal items
+        # are neither read from nor stored in the cache
+        company = self.env.ref('base.main_company')
+        accounts = self.env['account.account'].search([
+            ('company_id', '=', company.id)], limit=2)
+        journal = self.env['account.journal'].search([
+            ('company_id', '=', company.id)], limit=1)
+        self.env['account.move'].create({
+            'journal_id': journal.id,
+            'line_ids': [(0, 0, {
+                'name': '/',
+                'debit': 100,
+                'account_id': accounts[0].id,
+            }), (0, 0, {
+                'name': '/',
+                'credit': 100,
+                'account_id': accounts[1].id,
+            })]})
+        self.report_instance.compute()
+        self.assertEquals(kpi_matrix_cache.hits, 1)
+        self.assertEquals(kpi_matrix_cache.misses, 1)
+
+    def test_json_cache_unlink(self):
+        kpi_matrix_cache.clear()
+        self.report.query_ids.unlink()
+        self.report_instance.compute()
+        # deleting a KPI, without writing the report, gives a new key
+        kpi = self.report.kpi_ids.filtered(lambda k: k.name == 'k5')
+        kpi.unlink()
+        res = self.report_instance.compute()
+        self.assertEquals(kpi_matrix_cache.hits, 0)
+        self.assertEquals(kpi_matrix_cache.misses, 2)
+        self.assertNotIn(u'kpi 5', [
+            row['label'] for row in res['body']])
+        # and so does deleting an expression
+        self.report.kpi_ids.mapped('expression_ids')[0].unlink()
+        self.report_instance.compute()
+        self.assertEquals(kpi_matrix_cache.hits, 0)
+        self.assertEquals(kpi_matrix_cache.misses, 3)
+
+    def test_ledger_version_snapshot(self):
+        # a change committed by another transaction after the report
+        # transaction started does not change the stamp it reads, since
+        # its results do not include that change
+        with self.registry.cursor() as report_cr:
+            version = get_ledger_version(report_cr)
+            with self.registry.cursor() as cr:
+                signal_ledger_change(cr)
+                cr.commit()
+                self.assertEquals(get_ledger_version(cr), version + 1)
+            self.assertEquals(get_ledger_version(report_cr), version)
+            report_cr.commit()
+            self.assertEquals(get_ledger_version(report_cr), version + 1)
+            # compacting the stamp does not change it
+            compact_ledger_version(report_cr)
+            self.assertEquals(get_ledger_version(report_cr), version + 1)
+
+    def test_ledger_change(self):
+        company = self.env.ref('base.main_company')
+        accounts = self.env['account.account'].search([
+            ('company_id', '=', company.id)], limit=2)
+        journal = self.env['account.journal'].search([
+            ('company_id', '=', company.id)], limit=1)
+        with self.registry.cursor() as cr:
+            env = self.env(cr=cr)
+            move = env['account.move'].create({
+                'journal_id': journal.id,
+                'line_ids': [(0, 0, {
+                    'name': '/',
+                    'debit': 100,
+                    'account_id': accounts[0].id,
+                }), (0, 0, {
+                    'name': '/',
+                    'credit': 100,
+                    'account_id': accounts[1].id,
+                })]})
+            self.assertTrue(is_ledger_changed(cr))
+            cr.commit()
+            self.assertFalse(is_ledger_changed(cr))
+            try:
+                # labels do not change the balances of reports
+                version = get_ledger_version(cr)
+                move.line_ids.write({'name': 'label'})
+                self.assertFalse(is_ledger_changed(cr))
+                move.line_ids[0].write({'partner_id': self.ref(
+                    'base.res_partner_2')})
+                self.assertTrue(is_ledger_changed(cr))
+                cr.commit()
+                self.assertEquals(get_ledger_version(cr), version + 1)
+            finally:
+                move.unlink()
+                cr.commit()
+
     def test_qweb(self):
         test_reports.try_report(self.env.cr, self.env.uid,
                                 'mis_builder.report_mis_report_instance',
@@ -139,3 +403,20 @@ class TestMisReportInstance(common.TransactionCase):
                                 'mis.report.instance.xlsx',
                                 [self.report_instance.id],
                                 report_type='xlsx')
+
+    def test_xlsx_format_pool(self):
+        matrix = self.report_instance._compute_matrix()
+        workbook = xlsxwriter.Workbook(io.BytesIO(), {'constant_memory': True})
+        formats = XlsxFormatPool(workbook, matrix.style_registry)
+        cells = [cell for row in matrix.iter_rows()
+                 for cell in row.iter_cells() if cell]
+        for cell in cells:
+            fmt = formats.get_format(
+                cell.style_props, no_indent=True, align='right')
+            self.assertTrue(fmt is formats.get_format(
+                cell.style_props.copy(), no_indent=True, align='right'))
+        # one format for each distinct style
+        styles = set(matrix.style_registry.props_key(cell.style_props)
+                     for cell in cells)
+        self.assertEquals(len(formats), len(styles))
+        workbook.close()
@@ -17,6 +17,8 @@ class TestMisSafeEval(common.TransactionCase):
         val = mis_safe_eval('1/0', {})  # division by zero
         self.assertTrue(isinstance(val, DataError))
         self.assertEqual(val.name, '#DIV/0')
+        # the message is the type and value of the exception
+        self.assertTrue('ZeroDivisionError' in val.msg)
         val = mis_safe_eval('1a', {})  # syntax error
         self.assertTrue(isinstance(val, DataError))
         self.assertEqual(val.name, '#ERR')
@@ -2,14 +2,23 @@
 # © 2016 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import doctest
+import itertools
+
 import odoo.tests.common as common
+from odoo.addons.mis_builder.models import mis_report_style
 
 from ..models.accounting_none import AccountingNone
 from ..models.mis_report_style import (
-    TYPE_NUM, TYPE_PCT, TYPE_STR, CMP_DIFF, CMP_PCT
+    TYPE_NUM, TYPE_PCT, TYPE_STR, CMP_DIFF, CMP_PCT, StyleRegistry
 )
 
 
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(mis_report_style))
+    return tests
+
+
 class TestRendering(common.TransactionCase):
 
     def setUp(self):
@@ -94,6 +103,50 @@ class TestRendering(common.TransactionCase):
         self.style.dp = 2
         self.assertEquals(u'51.23\xa0%', self._render(0.5123, TYPE_PCT))
 
+    def _render_num_lang_format(self, lang, value,
+                                divider, dp, prefix, suffix, sign):
+        # render_num() before it used NumberRenderer
+        value = round(value / float(divider or 1), dp or 0) or 0
+        r = lang.format('%%%s.%df' % (sign, dp or 0), value, grouping=True)
+        r = r.replace('-', u'\N{NON-BREAKING HYPHEN}')
+        if prefix:
+            r = prefix + u'\N{NO-BREAK SPACE}' + r
+        if suffix:
+            r = r + u'\N{NO-BREAK SPACE}' + suffix
+        return r
+
+    def test_render_num_languages(self):
+        langs = self.env['res.lang'].search([])
+        langs |= self.env['res.lang'].create(dict(
+            name='MIS test language',
+            code='mis_TEST',
+            grouping='[3,2,-1]',
+            thousands_sep="'",
+            decimal_point=',',
+        ))
+        values = [0, 1, -1, 0.5, -0.5, 1.5, 0.004, -0.004, 999.999,
+                  12345.678, -1234567.891, 1e9, -1e12]
+        for lang in langs:
+            for divider, dp, prefix, suffix, sign in itertools.product(
+                    [None, '1e-6', '1', '1e3', 0.01],
+                    [None, 0, 1, 3],
+                    [None, u'$'],
+                    [None, u'%'],
+                    ['-', '+']):
+                for value in values:
+                    self.assertEquals(
+                        self.style_obj.render_num(
+                            lang, value, divider, dp, prefix, suffix, sign),
+                        self._render_num_lang_format(
+                            lang, value, divider, dp, prefix, suffix, sign))
+        # renderers follow changes of languages
+        lang = langs[-1]
+        self.assertEquals(self.style_obj.render_num(lang, 1234567.8, dp=1),
+                          u"12'34'567,8")
+        lang.write(dict(grouping='[3,0]', thousands_sep=' '))
+        self.assertEquals(self.style_obj.render_num(lang, 1234567.8, dp=1),
+                          u"1 234 567,8")
+
     def test_render_string(self):
         self.assertEquals(u'', self._render('', TYPE_STR))
         self.assertEquals(u'', self._render(None, TYPE_STR))
@@ -156,3 +209,25 @@ class TestRendering(common.TransactionCase):
     def test_compare_pct(self):
         self.assertEquals((0.25, u'+25\xa0pp'),
                           self._compare_and_render(0.75, 0.50, TYPE_PCT))
+
+    def test_style_registry(self):
+        self.style.dp_inherit = False
+        self.style.dp = 2
+        registry = StyleRegistry(self.style_obj)
+        base_props = self.style_obj.merge([{'font_style': 'italic'}])
+        props = registry.merge_named(base_props, 'teststyle')
+        self.assertEquals(props, self.style_obj.merge(
+            [base_props, self.style]))
+        self.assertTrue(props is registry.merge_named(
+            base_props.copy(), 'teststyle'))
+        self.assertTrue(registry.merge_named(base_props, 'nostyle') is None)
+        # styles are loaded once
+        self.style_obj.create(dict(name='newstyle'))
+        self.assertTrue(registry.get_style('newstyle') is None)
+        # xlsx styles can be modified by callers
+        xlsx_style = registry.to_xlsx_style(props)
+        self.assertEquals(xlsx_style, self.style_obj.to_xlsx_style(props))
+        xlsx_style['align'] = 'right'
+        self.assertTrue('align' not in registry.to_xlsx_style(props))
+        self.assertEquals(registry.to_css_style(props, no_indent=True),
+                          self.style_obj.to_css_style(props, no_indent=True))